@@ -4,13 +4,17 @@ rem		Delete old files
 rem
 del /Q bootloader.sna 
 del /Q ..\files\bootloader.sna
+del /Q lzbootloader.sna
+del /Q ..\files\lzbootloader.sna
 rem
 rem		Assemble bootloader
 rem
 ..\bin\snasm bootloader.asm 
+..\bin\snasm lzbootloader.asm
 rem
 rem		Copy to file area if exists
 rem
 if exist bootloader.sna copy bootloader.sna ..\files
+if exist lzbootloader.sna copy lzbootloader.sna ..\files
 
 
@@ -0,0 +1,201 @@
+; ***************************************************************************************
+; ***************************************************************************************
+;
+;		Name : 		lzbootloader.asm
+;		Author :	Paul Robson (paul@robsons.org.uk)
+;		Date : 		2nd February 2019
+;		Purpose :	Boot-Loads code from "boot.lz", which has only the pages used,
+;					packed, as written by scripts/lzpack.py
+;
+; ***************************************************************************************
+; ***************************************************************************************
+
+		opt 	zxnextreg
+		org 	$7F00
+
+Start:	ld 		sp,Start-1 									; set up the stack.
+		ld 		ix,ImageName 								; read the image into memory
+		call 	ReadPackedMemory
+		jp	 	$8000 										; run.
+
+; ***************************************************************************************
+;
+;								 Access the default drive
+;
+; ***************************************************************************************
+
+FindDefaultDrive:
+		xor 	a
+		rst 	$08 										; set the default drive.
+		db 		$89
+		ld 		(DefaultDrive),a
+		ret
+
+; ***************************************************************************************
+;
+;		Read pages, each is a page number (0 = $8000-$BFFF, else $C000-$FFFF) and
+;		the packed length, followed by the data. Length 0 is 16k not packed. Packed
+;		data is read into $4000 and depacked from there. Page $FF ends the list.
+;
+; ***************************************************************************************
+
+ReadPackedMemory:
+		call 	FindDefaultDrive 							; get default drive
+		call 	OpenFileRead 								; open for reading
+__ReadPageLoop:
+		ld 		ix,PageHeader 								; read page and length
+		ld 		bc,3
+		call 	ReadBlock
+		ld 		a,(PageHeader)
+		cp 		$FF 										; end of pages
+		jr 		z,__ReadPagesDone
+		ld 		ix,$8000 									; page 0 is $8000-$BFFF
+		or 		a
+		jr 		z,__ReadPageUnpaged
+		ld 		b,a 										; others $C000-$FFFF
+		call 	SetPaging
+		ld 		ix,$C000
+__ReadPageUnpaged:
+		ld 		bc,(PageLength) 							; packed ?
+		ld 		a,b
+		or 		c
+		jr 		nz,__ReadPagePacked
+		ld 		bc,$4000 									; no, read it in.
+		call 	ReadBlock
+		jr 		__ReadPageLoop
+__ReadPagePacked:
+		push 	ix 											; where it goes
+		ld 		ix,$4000 									; read packed data
+		call 	ReadBlock
+		pop 	de 											; and depack it
+		ld 		hl,$4000
+		call 	Depack
+		jr 		__ReadPageLoop
+__ReadPagesDone:
+		call 	CloseFile 									; close file.
+		ret
+
+; ***************************************************************************************
+;
+;		Depack from HL to DE. Each block is a control byte, $00-$7F copies the
+;		next control+1 bytes, $80-$FF copies control-$80+3 bytes from the offset
+;		in the following word back. Offset 0 ends it.
+;
+; ***************************************************************************************
+
+Depack:
+		ld 		a,(hl) 										; get control byte
+		inc 	hl
+		cp 		$80
+		jr 		nc,__DepackMatch
+		ld 		c,a 										; copy bytes following
+		ld 		b,0
+		inc 	bc
+		ldir
+		jr 		Depack
+__DepackMatch:
+		and 	$7F 										; count to copy
+		add 	a,3
+		ld 		c,a
+		ld 		b,0
+		ld 		a,(hl) 										; read offset
+		inc 	hl
+		push 	hl
+		ld 		h,(hl)
+		ld 		l,a
+		or 		h 											; zero, end
+		jr 		z,__DepackExit
+		ld 		a,e 										; copy from DE-offset
+		sub 	l
+		ld 		l,a
+		ld 		a,d
+		sbc 	a,h
+		ld 		h,a
+		ldir
+		pop 	hl 											; past the offset
+		inc 	hl
+		jr 		Depack
+__DepackExit:
+		pop 	hl
+		ret
+
+; ***************************************************************************************
+;
+;						   Map $C000-$FFFF onto blocks b and b+1
+;
+; ***************************************************************************************
+
+SetPaging:
+		ld 		a,b 										; set $56
+		db 		$ED,$92,$56
+		inc 	a 											; set $57
+		db 		$ED,$92,$57
+		ret
+
+; ***************************************************************************************
+;
+;									Open file read
+;
+; ***************************************************************************************
+
+OpenFileRead:
+		push 	af
+		push 	bc
+		push 	ix
+		ld 		b,1
+__OpenFile:
+		ld 		a,(DefaultDrive)
+		rst 	$08
+		db 		$9A
+		ld 		(FileHandle),a
+		pop 	ix
+		pop 	bc
+		pop 	af
+		ret
+
+; ***************************************************************************************
+;
+;								Read BC bytes to IX
+;
+; ***************************************************************************************
+
+ReadBlock:
+		push 	af
+		push 	bc
+		push 	ix
+		ld 		a,(FileHandle)
+		rst 	$08
+		db 		$9D
+		pop 	ix
+		pop 	bc
+		pop 	af
+		ret
+
+; ***************************************************************************************
+;
+;										Close open file
+;
+; ***************************************************************************************
+
+CloseFile:
+		push 	af
+		ld 		a,(FileHandle)
+		rst 	$08
+		db 		$9B
+		pop 	af
+		ret
+
+DefaultDrive:
+		db 		0
+FileHandle:
+		db 		0
+PageHeader:
+		db 		0
+PageLength:
+		dw 		0
+
+		org 	$7FF0
+ImageName:
+		db 		"boot.lz",0
+
+		savesna	"lzbootloader.sna",Start
@@ -0,0 +1,147 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		asmbench.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		30th January 2019
+#		Purpose :	Assembler throughput benchmarks, on generated programs, against a
+#					stored baseline.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import contextlib,json,os,sys,time,tracemalloc
+from assembler import *
+from democodegen import *
+from z80codegen import *
+
+# ***************************************************************************************
+#
+#		Programs are generated varying one thing at a time from a default : the number
+#		of procedures, statements per procedure, terms per expression, depth of nested
+#		if/while/for and string constants per procedure. Each is assembled with each
+#		code generator, recording lines per second (best of several) and the peak
+#		memory allocated while assembling.
+#
+#		python asmbench.py [-update] [-tolerance=<percent>]
+#
+#		Without -update, a result more than tolerance (default 50%) slower or larger
+#		than the baseline is a failure. Timings depend on the machine, so the baseline
+#		should be made on the machine that checks against it.
+#
+# ***************************************************************************************
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),"benchmarks","throughput.json")
+
+DEFAULTS = { "procedures":10,"statements":10,"expression":4,"depth":2,"strings":2 }
+
+AXES = {																	# the Z80 code has to fit in $8000-$BFFF
+	"procedures":	[ 5,10,20,30 ],
+	"statements":	[ 5,10,20,40 ],
+	"expression":	[ 2,4,8,16 ],
+	"depth":		[ 0,2,8,16 ],
+	"strings":		[ 0,2,8,16 ],
+}
+
+CODEGENERATORS = { "demo":DemoCodeGenerator,"z80":Z80CodeGenerator }
+
+# ***************************************************************************************
+#									Generate a program
+# ***************************************************************************************
+
+def createProgram(procedures,statements,expression,depth,strings):
+	src = []
+	operators = "+-&|^"
+	structures = [ ("if (v{0} # 0)","endif"),("while (v{0} < 0)","endwhile"),("for (v{0} & 15)","next") ]
+	for proc in range(0,procedures):
+		src.append("defproc proc{0}(a,b)".format(proc))
+		for n in range(0,strings):
+			src.append("\ts{0} = \"string {0} in procedure {1}\"".format(n,proc))
+		for level in range(0,depth):										# open nested structures
+			src.append("\t"*(level+1)+structures[level % 3][0].format(level % 8))
+		indent = "\t"*(depth+1)
+		for n in range(0,statements):
+			terms = [ "a","b","v{0}".format((n+1) % 8),"$g{0}".format(n % 4),str(n+1) ]
+			expr = terms[n % len(terms)]
+			for t in range(1,expression):
+				expr = expr+" "+operators[(n+t) % len(operators)]+" "+terms[(n+t) % len(terms)]
+			src.append(indent+"v{0} = {1}".format(n % 8,expr))
+		for level in range(depth-1,-1,-1):									# and close them
+			src.append("\t"*(level+1)+structures[level % 3][1])
+		if proc > 0:
+			src.append("\tproc{0}(v0,v1)".format(proc-1))
+		src.append("endproc")
+		src.append("")
+	return src
+
+# ***************************************************************************************
+#						Time assembling a program with a code generator
+# ***************************************************************************************
+
+def assembleProgram(codeGenClass,src):
+	worker = AssemblerWorker(codeGenClass())
+	with open(os.devnull,"w") as sink:
+		with contextlib.redirect_stdout(sink):
+			worker.assemble(src)
+			if hasattr(worker.codeGen,"flush"):
+				worker.codeGen.flush()
+#
+#		Returns lines per second, the best of at least repeats runs taking at least
+#		minimum seconds, and peak memory in bytes.
+#
+def measure(codeGenClass,src,repeats = 5,minimum = 0.5):
+	best = None
+	runs,total = 0,0.0
+	while runs < repeats or total < minimum:
+		start = time.perf_counter()
+		assembleProgram(codeGenClass,src)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best,elapsed)
+		runs,total = runs+1,total+elapsed
+	tracemalloc.start()
+	assembleProgram(codeGenClass,src)
+	peak = tracemalloc.get_traced_memory()[1]
+	tracemalloc.stop()
+	return len(src) / best,peak
+#
+#		Run all the benchmarks, returns results by name.
+#
+def runBenchmarks():
+	results = {}
+	for axis in sorted(AXES.keys()):
+		for value in AXES[axis]:
+			settings = dict(DEFAULTS)
+			settings[axis] = value
+			src = createProgram(**settings)
+			for name in sorted(CODEGENERATORS.keys()):
+				linesPerSecond,peak = measure(CODEGENERATORS[name],src)
+				results["{0} {1}={2}".format(name,axis,value)] = { "lines":len(src),"lps":round(linesPerSecond),"peak":peak }
+	return results
+
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	update = "-update" in args
+	tolerance = 50.0
+	for arg in args:
+		if arg.startswith("-tolerance="):
+			tolerance = float(arg[11:])
+	baseline = json.load(open(BASELINE)) if os.path.exists(BASELINE) else {}
+	results = runBenchmarks()
+	failures = []
+	print("{0:<24} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}".format("benchmark","lines","lines/s","baseline","peak","baseline"))
+	for name in sorted(results.keys()):
+		result,previous = results[name],baseline.get(name,{})
+		print("{0:<24} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}".format(name,result["lines"],result["lps"],
+									previous.get("lps",""),result["peak"],previous.get("peak","")))
+		if "lps" in previous and result["lps"] < previous["lps"] * (1 - tolerance / 100):
+			failures.append("{0} is slower, {1} lines/s against {2}".format(name,result["lps"],previous["lps"]))
+		if "peak" in previous and result["peak"] > previous["peak"] * (1 + tolerance / 100):
+			failures.append("{0} uses more memory, {1} bytes against {2}".format(name,result["peak"],previous["peak"]))
+	if update:
+		with open(BASELINE,"w") as h:
+			json.dump(results,h,indent = 1,sort_keys = True)
+	elif len(failures) > 0:
+		print()
+		for failure in failures:
+			print("***** REGRESSION "+failure+" *****")
+		sys.exit(1)
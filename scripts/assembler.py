@@ -10,17 +10,57 @@
 # ***************************************************************************************
 
 from democodegen import *
-import re
+from lexer import *
+from tracesink import *
+import sys,time
 
 # ***************************************************************************************
 #									Exception for HLA
 # ***************************************************************************************
 
 class AssemblerException(Exception):
+	LINE = 0 																# line being assembled
 	def __init__(self,message):
 		Exception.__init__(self)
 		self.message = message
-		print("*****",message,AssemblerException.LINE,"*****")
+		self.line = AssemblerException.LINE
+		if Trace.sink.level >= TRACE_ERRORS:
+			Trace.sink.event("error","{0} {1}".format(message,self.line))
+
+# ***************************************************************************************
+#
+#		Locals, including parameters, are overlaid. As procedures can only call
+#		procedures defined before them, there is no recursion, and a procedure's
+#		locals are only in use while it and the procedures it calls are running.
+#		So a procedure's locals go in the words after those of everything it calls,
+#		and procedures which are never running at the same time share words. The
+#		words needed are those of the deepest chain of calls, not all the locals.
+#		Locals do not keep their values from one call to the next.
+#
+# ***************************************************************************************
+
+class FrameAllocator(object):
+	def __init__(self,allocVar):
+		self.allocVar = allocVar 											# allocates a word
+		self.slots = []														# words shared by locals
+		self.ends = {}														# procedure => words it and its calls use
+		self.next = 0
+	#
+	#		Start the locals of a procedure which calls the procedures given.
+	#
+	def startFrame(self,calls):
+		self.next = max([self.ends[name] for name in calls if name in self.ends]+[0])
+	#
+	#		Get the word for the next local.
+	#
+	def allocate(self,name = None):
+		if self.next == len(self.slots):
+			self.slots.append(self.allocVar(name))
+		self.next += 1
+		return self.slots[self.next-1]
+	#
+	def endFrame(self,procedure):
+		self.ends[procedure] = self.next
 
 # ***************************************************************************************
 #									 Worker Object
@@ -30,188 +70,539 @@ class AssemblerWorker(object):
 	def __init__(self,codeGen):
 		self.codeGen = codeGen 												# code generator.
 		self.globals = {}													# global identifiers.
-		self.rxIdentifier = "[\$a-z][a-z0-9\_]*"							# identifier rx match
-		self.keywords = "defproc,endproc,if(,endif,while(,endwhile,for(,next"
-		self.keywords = [x for x in self.keywords.split(",") if x != ""]
+		self.lexer = HLALexer()												# lexical analyser.
+		self.operators = { x for x in "+-*/%&|^?!" }						# binary operators
 		self.testMap = { "=":"nz","#":"z","<":"p" }							# maps = # < onto inverse tests
+		self.structureWords = { "if(","while(","for(","endif","endwhile","next" }
+		self.blockOperations = { "memcopy":3,"memfill":3,"memcompare":4 }	# intrinsics => parameters
+		self.maxParameters = 4 												# passed in HL DE BC IX
+		self.powers = { 1 << n:n for n in range(1,16) }						# powers of 2 for shifts.
+		self.loopLines = []													# (first,last) lines of loops
+		self.frames = FrameAllocator(lambda name: self.codeGen.allocVar(name))
 	#
-	#		Assemble an array of strings.
+	#		Assemble an array of strings, or any other iterable of lines such as an open
+	#		file or a generator. Lines are read as they are needed, so only the procedure
+	#		being assembled is held in memory.
 	#
-	def assemble(self,src):
-		#
-		src = [x.replace("\t"," ").rstrip() for x in src]					# tidy up
-		src = [x if x.find("//") < 0 else x[:x.find("//")] for x in src]	# remove comments
-		#
-		for l in range(0,len(src)):											# remove quoted strings
-			if src[l].find('"') >= 0:										# any quotes ?
-				if src[l].count('"') % 2 != 0:		
-					AssemblerWorker = l + 1
-					raise AssemblerException("Imbalance in quotes")					
-				src[l] = self.processQuotes(src[l])							# Replace quotes with addresses
-		#
-		src = (":~:".join(src)).replace(" ","").lower()						# make one long string.
-		#
-		src = re.split("(defproc"+self.rxIdentifier+"\(.*?\))",src)			# split around proc defs
-		#
-		AssemblerException.LINE = 1
-		if not src[0].startswith("defproc"):								# stuff at front.
-			if src[0].replace(":","").replace("~","") != "":				# check no content
-				raise AssemblerException("Code before first procedure")
-			AssemblerException.LINE = src[0].count("~")+1					# set line correctly
-			del src[0]														# remove that part.
-		assert len(src) % 2 == 0											# pairs on defs / bodies
-		#
-		for i in range(0,len(src),2):										# scan through.
-			self.locals = {}												# new locals each procedure.
-			src[i] = self.processIdentifiers(src[i])						# pre-process identifiers out.
-			src[i+1] = self.processIdentifiers(src[i+1])					# at this point the procedure isn't defined.
-			self.processHeader(src[i])										# do the header.
-			self.structureStack = [ ["marker"] ]							# set up structure stack.
-			for cmd in [x for x in src[i+1].split(":") if x != ""]:			# work through body
-				if cmd == "~":												# handle line position
-					AssemblerException.LINE += 1
-				else:														# assemble the rest.
-					self.assembleCommand(cmd)
-			if len(self.structureStack) != 1:								# check structures balance
-				raise AssemblerException("Structure imbalance")
-	#
-	#		Process the header.
-	#
-	def processHeader(self,header):
-		m = re.match("^defproc("+self.rxIdentifier+"\()(.*)\)$",header)		# split it up
-		if m is None:
-			raise AssemblerException("Bad procedure definition "+header)
-		self.globals[m.group(1)] = self.codeGen.getAddress()				# create procedure
-		params = [x for x in m.group(2).split(",") if x != ""]				# write out parameters.
-		for i in range(0,len(params)):										# work through them
-			m = re.match("^\@(\d+)$",params[i])								# term ?
-			if m is None:
-				raise AssemblerException("Bad parameter "+params[i])
-			self.codeGen.storeParamRegister(i,int(m.group(1)))				# save param register
+	def assemble(self,src,firstLine = 1):
+		for header,body in self.procedures(src,firstLine):
+			self.assembleProcedure(header,body)
+	#
+	#		Assemble a source file, "-" is standard input.
+	#
+	def assembleFile(self,fileName):
+		if fileName == "-":
+			self.assemble(sys.stdin)
+		else:
+			with open(fileName) as h:
+				self.assemble(h)
+	#
+	#		Split a line source into procedures, yielding (header,body) one at a time.
+	#
+	def procedures(self,src,firstLine = 1):
+		AssemblerException.LINE = firstLine
+		header = None
+		body = []
+		try:
+			for cmd in self.lexer.tokenise(src,firstLine):					# work through command stream
+				if cmd[1][0][0] == "d":										# new procedure.
+					if header is not None:									# return the previous one
+						yield header,body
+					header = cmd
+					body = []
+				else:
+					if header is None:										# stuff at front.
+						AssemblerException.LINE = cmd[0]
+						raise AssemblerException("Code before first procedure")
+					body.append(cmd)
+		except LexerException as e:											# convert lexer errors
+			AssemblerException.LINE = e.line
+			raise AssemblerException(e.message)
+		if header is not None:												# return the last one
+			yield header,body
+	#
+	#		Assemble one procedure, header and body commands.
+	#
+	def assembleProcedure(self,header,body):
+		timed = Trace.sink.level >= TRACE_PHASES							# only time if wanted
+		listed = Trace.sink.level >= TRACE_COMMANDS
+		if timed:
+			start = time.perf_counter()
+		self.locals = {}													# new locals each procedure.
+		name = header[1][0][1]
+		self.lean = name.endswith("_lean")									# lean calling convention
+		calls = { value for cmd in body for kind,value in cmd[1] if kind == "c" } - self.blockOperations.keys()
+		if name in calls:													# find the calls, for the locals
+			AssemblerException.LINE = next(cmd[0] for cmd in body if ("c",name) in cmd[1])
+			raise AssemblerException("Recursive call "+name+"(")
+		self.frames.startFrame(calls)
+		for cmd in [header]+body:											# pre-process quotes and identifiers out.
+			AssemblerException.LINE = cmd[0]								# at this point the procedure isn't defined.
+			self.processTerms(cmd[1])
+		self.frames.endFrame(name)
+		if timed:
+			start = self.endPhase("terms",start)
+		AssemblerException.LINE = header[0]
+		live = self.processHeader(header[1],body)							# do the header.
+		if timed:
+			start = self.endPhase("headers",start)
+		self.structureStack = [ ["marker"] ]								# set up structure stack.
+		self.deadLevel = None 												# not in code never executed.
+		self.forgetValues()													# nothing known about accumulator
+		if live is not None:												# except a parameter in it
+			self.values = [[("load",False,live)]]
+		self.indexWrites = self.findIndexWrites(body)						# loops that must write index
+		self.body = body
+		self.tailCalled = None 												# endproc after a tail call
+		self.resumeAt = 0 													# after a loop done as a block
+		for self.commandNumber,cmd in enumerate(body):						# work through body
+			if self.commandNumber < self.resumeAt:
+				continue
+			AssemblerException.LINE = cmd[0]
+			if listed:
+				Trace.sink.event("command",self.commandText(cmd[1]))
+			self.assembleCommand(cmd[1])
+		if timed:
+			self.endPhase("commands",start)
+		if len(self.structureStack) != 1:									# check structures balance
+			raise AssemblerException("Structure imbalance")
+	#
+	#		Report the time a phase took to the trace sink, returns the time now.
+	#
+	def endPhase(self,name,start):
+		now = time.perf_counter()
+		Trace.sink.phase(name,now-start)
+		return now
+	#
+	#		Find the FOR commands which need to write index, because it might be read
+	#		before it is written again. That is any read after the FOR, or anywhere in
+	#		an enclosing loop, as that may go round again.
+	#
+	def findIndexWrites(self,body):
+		if "index" not in self.locals:
+			return set()
+		address = self.locals["index"]
+		reads = []
+		loops = {}
+		stack = []
+		for i in range(0,len(body)):
+			cmd = body[i][1]
+			if ("v",address) in cmd or ("n",address) in cmd:
+				for j in range(0,len(cmd)):									# any use except being assigned to
+					if cmd[j][1] == address and cmd[j][0] in "vn" and (j > 0 or cmd[1:2] != [("o","=")]):
+						reads.append(i)
+			if cmd[0] == ("k","for(") or cmd[0] == ("k","while("):
+				if cmd[0][1] == "for(":
+					loops[i] = stack[0] if len(stack) > 0 else i			# where the outermost loop starts
+				stack.append(i)
+			elif (cmd[0] == ("k","next") or cmd[0] == ("k","endwhile")) and len(stack) > 0:
+				stack.pop()
+		return { i for i in loops if any(r >= loops[i] for r in reads) }
+	#
+	#		Process the header. Returns the parameter left in the accumulator, if any.
+	#		Procedures ending _lean are called the same way, but don't store unused
+	#		parameters, or one used from its register (see liveParameter).
+	#
+	def processHeader(self,header,body = []):
+		if header[-1] != ("o",")"):											# defproc name( .... )
+			raise AssemblerException("Bad procedure definition "+header[0][1])
+		if header[0][1] in self.blockOperations:
+			raise AssemblerException("Reserved procedure name "+header[0][1]+"(")
+		self.globals[header[0][1]+"("] = self.codeGen.getAddress()			# create procedure
+		params = header[1:-1]
+		self.checkParameterCount(params)
+		live = self.liveParameter(params,body) if self.lean else None
+		for i in range(0,len(params),2):									# work through them
+			if params[i][0] != "v" or (i+1 < len(params) and params[i+1] != ("o",",")):
+				raise AssemblerException("Bad parameter "+str(params[i][1]))
+			if not self.lean or (params[i][1] != live and self.useCount(params[i][1],body) > 0):
+				self.codeGen.storeParamRegister(i >> 1,params[i][1])		# save param register
+		if live is not None:
+			self.codeGen.copyParamRegister(params.index(("v",live)) >> 1)	# into the accumulator
+		return live
+	#
+	#		Find a parameter only read as the first term of the first command, which
+	#		can be used from its register, as nothing has run before then.
+	#
+	def liveParameter(self,params,body):
+		cmd = body[0][1] if len(body) > 0 else []
+		if cmd[:1] == [("k","if(")] or cmd[:1] == [("k","for(")]:
+			first = cmd[1]
+		elif len(cmd) > 2 and cmd[0][0] == "v" and cmd[1] == ("o","="):
+			first = cmd[2]
+		else:
+			return None
+		if first not in params or first[0] != "v" or self.useCount(first[1],body) != 1:
+			return None
+		return first[1]
+	#
+	#		Count the uses of a variable, including its address, in commands.
+	#
+	def useCount(self,address,body):
+		return len([token for cmd in body for token in cmd[1] if token == ("v",address) or token == ("n",address)])
+	#
+	#		A call is a tail call in a lean procedure if it is followed by endproc, and
+	#		the loop count of a FOR loop isn't on the stack. It jumps to the procedure,
+	#		which returns for this one.
+	#
+	def isTailCall(self):
+		following = self.body[self.commandNumber+1][1] if self.commandNumber+1 < len(self.body) else []
+		return self.lean and following == [("k","endproc")] and all(info[0] != "for" for info in self.structureStack)
 	#
 	#		Assemble a single command.
 	#
 	def assembleCommand(self,cmd):
-		print("{0} {1} {0}".format("=========",cmd))
-		if cmd == "endproc":												# handle endproc
-			self.codeGen.returnSubroutine()
-			return
-		#
-		if cmd.startswith("if(") or cmd.startswith("while("):				# code shared as while is if with loop.
-			m = re.match("^(.*?)\((.*?)([\#\=\<])0\)$",cmd)					# split it up into bits.
-			if m is None:
-				raise AssemblerException("Syntax error in structure")
-			info = [m.group(1),self.codeGen.getAddress()]					# info is name and loop position (for while)
-			self.assembleExpression(m.group(2))								# value to be tested.
-			jadr = self.codeGen.jumpInstruction(self.testMap[m.group(3)])	# assemble jump instruction
-			info.append(jadr)												# add that patch address.
-			self.structureStack.append(info)								# push on stack
-			return
-		#
-		if cmd == "endif" or cmd == "endwhile":								# end of structure shared
-			info = self.structureStack.pop()								# get info
-			if cmd[3:] != info[0]:											# right ?
-				raise AssemblerException("{0} not closed".format(info[0]))	# no !
-			if cmd == "endwhile":											# loop back for while
-				jmp = self.codeGen.jumpInstruction("")
-				self.codeGen.setJumpAddress(jmp,info[1])
-			self.codeGen.setJumpAddress(info[2],self.codeGen.getAddress())	# patch forward jump
-			return
-		#
-		if cmd.startswith("for"):											# start of FOR
-			m = re.match("^for\((.*)\)$",cmd)								# split up and check
-			if m is None:
-				raise AssemblerException("Syntax error in FOR")
-			self.assembleExpression(m.group(1))								# loop count
-			self.structureStack.append(["for",self.codeGen.getAddress()])	# mark loop start
-			self.codeGen.binaryOperation("-",True,1)						# subtract 1
-			self.codeGen.pushA()											# save value.	
-			if "index" in self.locals:										# do we have an index local ?
-				self.codeGen.storeDirect(self.locals["index"])				# write out that index value
+		kind,value = cmd[0]
+		if self.deadLevel is not None and value not in self.structureWords:	# code that never runs
 			return
+		if kind == "k":
+			if value == "endproc":											# handle endproc
+				self.checkSize(cmd,1)
+				if self.tailCalled != self.commandNumber:					# tail call returns for it
+					self.codeGen.returnSubroutine()
+				self.forgetValues()
+				return
+			#
+			if value == "if(" or value == "while(":							# code shared as while is if with loop.
+				if len(cmd) < 5 or cmd[-1] != ("o",")") or cmd[-2] != ("n",0) or cmd[-3][0] != "o" or cmd[-3][1] not in self.testMap:
+					raise AssemblerException("Syntax error in structure")
+				info = [value[:-1],None,None,AssemblerException.LINE]		# info is name, loop position, patch, line
+				if self.deadLevel is None:
+					if value == "while(":									# loops back here
+						self.forgetValues()
+					expr = self.reduceExpression(cmd[1:-3])					# value to be tested.
+					if self.isConstantExpression(expr):						# known now, no test required
+						if self.testConstant(expr[0][2],cmd[-3][1]):		# always true, no test
+							info[1] = self.codeGen.getAddress()
+						else:												# never true, no code at all
+							self.deadLevel = len(self.structureStack)
+					else:
+						info[1] = self.codeGen.getAddress()					# loop position (for while)
+						self.emitExpression(expr)
+						info[2] = self.codeGen.jumpInstruction(self.testMap[cmd[-3][1]])	# assemble jump instruction
+				self.structureStack.append(info)							# push on stack
+				return
+			#
+			if value == "endif" or value == "endwhile":						# end of structure shared
+				self.checkSize(cmd,1)
+				info = self.structureStack.pop()							# get info
+				if value[3:] != info[0]:									# right ?
+					raise AssemblerException("{0} not closed".format(info[0]))	# no !
+				if self.deadLevel is not None:								# end of code never executed ?
+					if self.deadLevel == len(self.structureStack):
+						self.deadLevel = None
+					return
+				self.forgetValues()											# can be reached by a jump
+				if value == "endwhile":										# loop back for while
+					jmp = self.codeGen.jumpInstruction("")
+					self.codeGen.setJumpAddress(jmp,info[1])
+					self.loopLines.append((info[3],AssemblerException.LINE))
+				if info[2] is not None:										# patch forward jump
+					self.codeGen.setJumpAddress(info[2],self.codeGen.getAddress())
+				return
+			#
+			if value == "for(":												# start of FOR
+				if len(cmd) < 3 or cmd[-1] != ("o",")"):					# check
+					raise AssemblerException("Syntax error in FOR")
+				if self.deadLevel is not None:
+					self.structureStack.append(["for",None])
+					return
+				count = None 												# loop count, None if in A
+				expr = self.reduceExpression(cmd[1:-1])
+				if self.isConstantExpression(expr):
+					count = expr[0][2]
+					if self.assembleBlockLoop(count):						# done as a block copy or fill
+						return
+				else:
+					self.emitExpression(expr)
+				index = self.locals["index"] if self.commandNumber in self.indexWrites else None
+				self.structureStack.append(["for",self.codeGen.loopStart(count,index),AssemblerException.LINE])
+				self.forgetValues()
+				return
+			#
+			if value == "next":
+				self.checkSize(cmd,1)
+				info = self.structureStack.pop()							# pop stack and check
+				if info[0] != "for":
+					raise AssemblerException("next without for")
+				if self.deadLevel is not None:
+					return
+				self.codeGen.loopEnd(info[1])								# count down and loop
+				self.forgetValues()
+				self.loopLines.append((info[2],AssemblerException.LINE))
+				return
 		#
-		if cmd == "next":
-			info = self.structureStack.pop()								# pop stack and check
-			if info[0] != "for":
-				raise AssemblerException("next without for")
-			self.codeGen.popA()												# restore value
-			jmp = self.codeGen.jumpInstruction("nz")						# loop if non zero
-			self.codeGen.setJumpAddress(jmp,info[1])
-			return
-		#
-		m = re.match("^\@(\d+)=(.*)$",cmd)									# is it variable = expression
-		if m is not None:
-			self.assembleExpression(m.group(2))
-			self.codeGen.storeDirect(int(m.group(1)))
-			return
+		if kind == "v" and len(cmd) > 2:
+			if cmd[1] == ("o","="):											# is it variable = expression
+				self.assembleExpression(cmd[2:])
+				if [("load",False,value)] not in self.values:				# not there already
+					self.codeGen.storeDirect(value)
+					self.storedValue(value)
+				return
+			#
+			if cmd[1] == ("o","!") and len(cmd) > 4 and cmd[3] == ("o","="):	# is it variable!term = expression
+				isConstant = self.isConstantTerm(cmd[2])
+				self.assembleExpression(cmd[4:])							# calc result
+				self.codeGen.saveAccumulator()								# save result.
+				self.codeGen.loadDirect(False,value)						# evaluate LHS
+				self.codeGen.binaryOperation("+",isConstant,cmd[2][1])
+				self.codeGen.saveIndirect()									# and save.
+				self.forgetValues()											# could have written anything
+				return
 		#
-		m = re.match("^\@(\d+)\!(\@?)(\d+)=(.*)$",cmd)						# is it variable!term = expression
-		if m is not None:
-			self.assembleExpression(m.group(4))								# calc result
-			self.codeGen.saveAccumulator()									# save result.
-			self.codeGen.loadDirect(False,int(m.group(1)))					# evaluate LHS
-			self.codeGen.binaryOperation("+",m.group(2) == "",int(m.group(3)))
-			self.codeGen.saveIndirect()										# and save.
+		if kind == "p" and cmd[-1] == ("o",")"):							# is it procedure(parameters)
+			params = cmd[1:-1]												# parameter list
+			self.checkParameterCount(params)
+			for i in range(0,len(params),2):								# for each parameter
+				if i+1 < len(params) and params[i+1] != ("o",","):
+					raise AssemblerException("Bad Parameter")
+				self.codeGen.loadParamRegister(i >> 1,self.isConstantTerm(params[i]),params[i][1])
+			if self.isTailCall():
+				self.codeGen.tailCall(value)
+				self.tailCalled = self.commandNumber+1
+			else:
+				self.codeGen.callSubroutine(value)
+			self.forgetValues()
 			return
 		#
-		m = re.match("\@(\d+)\((.*)\)$",cmd)								# is it procedure(parameters)
-		if m is not None:
-			params = [x for x in m.group(2).split(",") if x != ""]			# parameter list
-			for i in range(0,len(params)):									# for each parameter
-				m2 = re.match("^(\@?)(\d+)$",params[i])						# analyse it
-				if m2 is None:
-					raise AssemblerException("Bad Parameter")
-				self.codeGen.loadParamRegister(i,m2.group(1) == "",int(m2.group(2)))
-			self.codeGen.callSubroutine(int(m.group(1)))
+		if kind == "b" and cmd[-1] == ("o",")"):							# is it intrinsic(parameters)
+			self.assembleBlockOperation(value,cmd[1:-1])
 			return
 		#
 		raise AssemblerException("Syntax Error")
 	#
+	#		Assemble memcopy(from,to,count), memfill(address,value,count), which fills
+	#		bytes, or memcompare(first,second,count,result), which sets result to 0 if
+	#		the blocks are the same. A copy goes upwards unless the blocks might overlap.
+	#
+	def assembleBlockOperation(self,name,params):
+		terms = params[0::2]
+		if len(params) != 2*self.blockOperations[name]-1 or any(params[i] != ("o",",") for i in range(1,len(params),2)):
+			raise AssemblerException("Bad Parameter")
+		constant = [self.isConstantTerm(t) and type(t[1]) == int for t in terms]
+		count = terms[2][1] & 0xFFFF if constant[2] else None
+		if count == 0 and name != "memcompare":								# nothing to do
+			return
+		for i in range(0,2 if count is not None else 3):
+			self.codeGen.loadParamRegister(i,self.isConstantTerm(terms[i]),terms[i][1])
+		if name == "memcopy":
+			upwards = constant[0] and constant[1] and count is not None and \
+							(terms[1][1] <= terms[0][1] or terms[1][1] >= terms[0][1]+count)
+			self.codeGen.copyMemory(count,"up" if upwards else "move")
+		elif name == "memfill":
+			self.codeGen.fillMemory(count,False)
+		else:
+			if terms[3][0] != "v":
+				raise AssemblerException("Syntax Error "+str(terms[3][1]))
+			self.codeGen.compareMemory(count)
+		self.forgetValues()
+		if name == "memcompare":
+			self.codeGen.storeDirect(terms[3][1])
+			self.storedValue(terms[3][1])
+	#
+	#		A FOR loop with a constant count whose body only copies or fills words
+	#		through variables stepped by 2 is done as a block copy or fill:
+	#
+	#			for(n):d!0 = s!0:s = s+2:d = d+2:next  	(the steps either way round)
+	#			for(n):p!0 = term:p = p+2:next
+	#
+	#		The variables are stepped after it. Returns True if the loop was done.
+	#
+	def assembleBlockLoop(self,count):
+		if count < 1 or count > 0x7FFF or self.commandNumber in self.indexWrites:
+			return False
+		cmds = [c[1] for c in self.body[self.commandNumber+1:self.commandNumber+5]]
+		step = lambda v: [("v",v),("o","="),("v",v),("o","+"),("n",2)]
+		write = lambda c: len(c) >= 5 and c[0][0] == "v" and c[1:4] == [("o","!"),("n",0),("o","=")]
+		if len(cmds) == 4 and write(cmds[0]) and len(cmds[0]) == 7 and cmds[0][4][0] == "v" and \
+						cmds[0][5:] == [("o","!"),("n",0)] and cmds[3] == [("k","next")]:
+			target,source = cmds[0][0][1],cmds[0][4][1]
+			if target == source or cmds[1:3] not in ([step(source),step(target)],[step(target),step(source)]):
+				return False
+			self.codeGen.loadParamRegister(0,False,source)
+			self.codeGen.loadParamRegister(1,False,target)
+			self.codeGen.copyMemory(count*2,"words")
+			stepped = [source,target]
+		elif len(cmds) >= 3 and write(cmds[0]) and len(cmds[0]) == 5 and cmds[0][4][0] in "vn" and \
+						cmds[0][4] != cmds[0][0] and cmds[1] == step(cmds[0][0][1]) and cmds[2] == [("k","next")]:
+			self.codeGen.loadParamRegister(0,False,cmds[0][0][1])
+			self.codeGen.loadParamRegister(1,cmds[0][4][0] == "n",cmds[0][4][1])
+			self.codeGen.fillMemory(count*2,True)
+			stepped = [cmds[0][0][1]]
+		else:
+			return False
+		self.forgetValues()
+		for address in stepped:
+			self.assembleCommand([("v",address),("o","="),("v",address),("o","+"),("n",count*2)])
+		self.resumeAt = self.commandNumber+len(stepped)+3
+		return True
+	#
+	#		Check a parameter list, terms and commas, isn't too long.
+	#
+	def checkParameterCount(self,params):
+		if len(params) > 2*self.maxParameters-1:
+			raise AssemblerException("Too many parameters, at most {0}".format(self.maxParameters))
+	#
+	#		Check a command has the right number of tokens
+	#
+	def checkSize(self,cmd,size):
+		if len(cmd) != size:
+			raise AssemblerException("Syntax Error")
+	#
+	#		Check a token is a term, return True if it is a constant
+	#
+	def isConstantTerm(self,token):
+		if token[0] == "n":
+			return True
+		if token[0] != "v":
+			raise AssemblerException("Syntax Error "+str(token[1]))
+		return False
+	#
 	#		Assemble an expression.
 	#
 	def assembleExpression(self,expr):
-		expr = [x for x in re.split("(\@?\d+)",expr) if x != ""]			# seperate around terms
-		pendingOp = None 													# no pending operation.
-		for term in expr:													# look at expr parts
-			m = re.match("^(\@?)(\d+)$",term)								# figure it out
-			if m is None:													# operator
-				if "+-*/%&|^?!".find(term) < 0 or pendingOp is not None:	# okay ?
-					raise AssemblerException("Syntax Error "+term)
-				pendingOp = term
+		self.emitExpression(self.reduceExpression(expr))
+	#
+	#		Convert an expression to a list of operations, (operator,isConstant,value),
+	#		the first of which is a load. Constant parts are worked out now, operations
+	#		that do nothing are removed, and multiply, divide and modulus by powers of 2
+	#		become shifts and masks. Expressions are evaluated left to right.
+	#
+	def reduceExpression(self,expr):
+		if len(expr) % 2 == 0:												# must be term (op term)*
+			raise AssemblerException("Syntax Error")
+		ops = [("load",self.isConstantTerm(expr[0]),expr[0][1])]			# load first term
+		for i in range(1,len(expr),2):										# then operator, term pairs
+			if expr[i][0] != "o" or expr[i][1] not in self.operators:
+				raise AssemblerException("Syntax Error "+str(expr[i][1]))
+			operator = expr[i][1]
+			isConstant = self.isConstantTerm(expr[i+1])
+			value = expr[i+1][1]
+			if not isConstant or type(value) != int or operator == "!" or operator == "?":
+				ops.append((operator,isConstant,value))						# not a constant, or a memory read
+				continue
+			value = value & 0xFFFF
+			if self.isConstantExpression(ops):								# constant operation on a constant
+				ops = [("load",True,self.foldConstant(operator,ops[0][2],value))]
+			elif (value == 0 and operator in "+-|^") or (value == 1 and operator in "*/") or (value == 0xFFFF and operator == "&"):
+				pass 														# does nothing
+			elif (value == 0 and operator in "*&") or (value == 1 and operator == "%"):
+				ops = [("load",True,0)]										# always zero
+			elif value == 0xFFFF and operator == "|":
+				ops = [("load",True,0xFFFF)]								# always $FFFF
+			elif value in self.powers and operator in "*/%":				# power of two
+				if operator == "%":
+					ops.append(("&",True,value-1))
+				else:
+					ops.append(("<<" if operator == "*" else ">>",True,self.powers[value]))
 			else:
-				if pendingOp is None:										# load operator
-					self.codeGen.loadDirect(m.group(1) == "",int(m.group(2)))
-				else:														# operation.
-					self.codeGen.binaryOperation(pendingOp,m.group(1) == "",int(m.group(2)))
-				pendingOp = None
-	#
-	#		Replace all quoted strings with addresses
-	#
-	def processQuotes(self,l):
-		l = re.split("(\".*?\")",l)											# split up into bits
-		for i in range(0,len(l)):
-			if l[i].startswith('"') and l[i].endswith('"'):					# string found.
-				l[i] = str(self.codeGen.createStringConstant(l[i][1:-1]))				
-		return "".join(l)
-	#
-	#		Process out all identifiers.
-	#
-	def processIdentifiers(self,src):
-		parts = re.split("("+self.rxIdentifier+"\(?)",src)					# split it up.
-		rxCheck = re.compile("^("+self.rxIdentifier+")(\(?)$")				# tester, is it an identifier.
-		for i in range(0,len(parts)):
-			if rxCheck.match(parts[i]) and parts[i] not in self.keywords:	# if identifier and not a keyword ?
-				if not (parts[i].startswith("defproc") and parts[i][-1] == "("):  # and not a definition, handled elsewhere
-					#
-					if parts[i][-1] != "(":									# if not a procedure call, define if required.
-						target = self.globals if parts[i].startswith("$") else self.locals
-						if parts[i] not in target:							# create variable if does not exist
-							target[parts[i]] = self.codeGen.allocVar(parts[i])
-					#														# where to find it, locals first then globals
-					lookup = self.locals if parts[i] in self.locals else self.globals
-					if parts[i] not in lookup:								# is it there ?
-						raise AssemblerException("Unknown identifier "+parts[i])
-																			# do substitution adding ( for procedures invoke
-					parts[i] = "@"+str(lookup[parts[i]])+("(" if parts[i].endswith("(") else "")		
-		return "".join(parts).replace("@@","")								# rebuild. replace does @variable operator.
-
+				ops.append((operator,True,value))
+		return ops
+	#
+	#		Check if an operation list is just a constant.
+	#
+	def isConstantExpression(self,ops):
+		return len(ops) == 1 and ops[0][1] and type(ops[0][2]) == int
+	#
+	#		Work out a binary operation on two 16 bit constants. / and % are unsigned.
+	#
+	def foldConstant(self,operator,left,right):
+		left = left & 0xFFFF
+		if (operator == "/" or operator == "%") and right == 0:
+			raise AssemblerException("Division by zero")
+		if operator == "+":
+			return (left + right) & 0xFFFF
+		if operator == "-":
+			return (left - right) & 0xFFFF
+		if operator == "*":
+			return (left * right) & 0xFFFF
+		if operator == "/":
+			return left // right
+		if operator == "%":
+			return left % right
+		if operator == "&":
+			return left & right
+		if operator == "|":
+			return left | right
+		return left ^ right
+	#
+	#		Check if a structure test on a constant passes.
+	#
+	def testConstant(self,value,test):
+		value = value & 0xFFFF
+		if test == "=":
+			return value == 0
+		if test == "#":
+			return value != 0
+		return (value & 0x8000) != 0
+	#
+	#		Generate code for an operation list. If the accumulator already holds the
+	#		value of the start of it, that part is not done again.
+	#
+	def emitExpression(self,ops):
+		known = max([len(v) for v in self.values if v == ops[:len(v)]]+[0])
+		if known == 0:
+			self.codeGen.loadDirect(ops[0][1],ops[0][2])
+		for operator,isConstant,value in ops[max(known,1):]:
+			self.codeGen.binaryOperation(operator,isConstant,value)
+		if known < len(ops):
+			self.values = [ops]
+		elif ops not in self.values:										# another way of getting it
+			self.values.append(ops)
+	#
+	#		The values the accumulator holds are kept between commands, as operation
+	#		lists any of which would load it. A variable holding it is a load of that
+	#		variable. This is forgotten at labels, calls and writes through memory.
+	#
+	def forgetValues(self):
+		self.values = []
+	#
+	#		The accumulator has been stored in a variable. Values which read that
+	#		variable, or read memory, may not be right any more.
+	#
+	def storedValue(self,address):
+		self.values = [v for v in self.values if not any(op == "!" or op == "?" or (not isConstant and value == address) for op,isConstant,value in v)]
+		self.values.append([("load",False,address)])
+	#
+	#		Convert a processed command back to text, for the listing.
+	#
+	def commandText(self,cmd):
+		text = []
+		for kind,value in cmd:
+			if kind == "v" or kind == "p":									# variables and procedures
+				text.append("@"+str(value)+("(" if kind == "p" else ""))
+			elif kind == "b":												# intrinsics
+				text.append(value+"(")
+			elif kind == "d":												# procedure definition
+				text.append("defproc"+value+"(")
+			else:
+				text.append(str(value))
+		return "".join(text)
+	#
+	#		Allocate a local variable.
+	#
+	def allocLocal(self,name):
+		return self.frames.allocate(name)
+	#
+	#		Replace all quoted strings with addresses, and process out all identifiers.
+	#
+	def processTerms(self,tokens):
+		for i,(kind,value) in enumerate(tokens):
+			if kind == "i" or kind == "a":									# variable or address of variable
+				if value in self.locals:									# where to find it, locals first then globals
+					address = self.locals[value]
+				elif value in self.globals:
+					address = self.globals[value]
+				elif value.startswith("$"):									# create variable if does not exist
+					address = self.globals[value] = self.codeGen.allocVar(value)
+				else:
+					address = self.locals[value] = self.allocLocal(value)
+				tokens[i] = ("v" if kind == "i" else "n",address)			# @variable is a constant
+			elif kind == "c" and value in self.blockOperations:				# intrinsic
+				tokens[i] = ("b",value)
+			elif kind == "c":												# procedure invoke
+				if value+"(" not in self.globals:							# is it there ?
+					raise AssemblerException("Unknown identifier "+value+"(")
+				tokens[i] = ("p",self.globals[value+"("])
+			elif kind == "s":												# string found.
+				tokens[i] = ("n",self.codeGen.createStringConstant(value))
@@ -0,0 +1,303 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		banklinker.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		1st February 2019
+#		Purpose :	Links Z80 procedures across the paged memory, keeping callers and
+#					the procedures they call often in the same page.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from assembler import *
+from objectfile import *
+from parallel import *
+from recordcodegen import *
+from z80codegen import *
+
+# ***************************************************************************************
+#
+#		Procedures are assembled into recordings (see objectfile.py), which are played
+#		into a scratch code generator to find their sizes. The calls between them
+#		make a graph, each call weighted by LOOPWEIGHT for each loop it is in.
+#
+#		Pairs of procedures are joined into clusters, heaviest calls first, as long
+#		as the cluster fits in a page. Clusters most called from other clusters go
+#		in unpaged memory, which is always there, the rest are packed into the 16k
+#		page pairs at $C000.
+#
+#		A call to a procedure in a page other than the caller's goes via a stub in
+#		unpaged memory, one per procedure called like that, which maps the page in,
+#		calls the procedure, and maps back what was there before. String constants
+#		are put in unpaged memory, so they can be passed to any procedure.
+#
+#		Procedures which can't be reached from the _boot procedures are not linked,
+#		nor are their strings and the globals only they use. If procedures are
+#		inlined (see inliner.py) that is done first, so those no longer called go.
+#
+# ***************************************************************************************
+
+LOOPWEIGHT = 10
+
+# ***************************************************************************************
+#					Code generator which can write to several pages
+# ***************************************************************************************
+
+class BankedCodeGenerator(Z80CodeGenerator):
+	ROUTINESIZE = 21 														# page read and restore routines
+	STUBSIZE = 19 															# each cross page stub
+	def __init__(self,optimise = True,target = "z80n"):
+		Z80CodeGenerator.__init__(self,optimise,target)
+		self.pointers = { 0:0x8000 }										# page => next free address
+		self.pageRoutines = None 											# (read page,restore page)
+		self.stubs = {}														# address => stub address
+	#
+	#		Carry on writing code in another page, where it was left.
+	#
+	def selectPage(self,page):
+		self.flush()
+		self.pointers[self.image.getCodePage()] = self.image.getCodeAddress()
+		self.setAddress((page << 16)+self.pointers.get(page,0x8000 if page == 0 else 0xC000))
+	#
+	#		Get the stub which calls a paged procedure from anywhere, creating it in
+	#		unpaged memory if there isn't one.
+	#
+	def stub(self,address):
+		if address not in self.stubs:
+			page = self.image.getCodePage()
+			self.selectPage(0)
+			if self.pageRoutines is None:
+				self.pageRoutines = self.createPageRoutines()
+			readPage,restorePage = self.pageRoutines
+			self.stubs[address] = self.getAddress()
+			self.emit("call nn",readPage)									# save the page at $C000
+			self.emit("push af")
+			self.emit("nextreg n,n",0x56+((address >> 16) << 8))			# map the procedure's in
+			self.emit("nextreg n,n",0x57+(((address >> 16)+1) << 8))
+			self.emit("call nn",address & 0xFFFF)
+			self.emit("pop af")
+			self.emit("jp nn",restorePage)									# map the saved page back
+			self.selectPage(page)
+		return self.stubs[address]
+	#
+	#		Routines to read the page at $C000 into A, and map A,A+1 in there.
+	#
+	def createPageRoutines(self):
+		readPage = self.getAddress() & 0xFFFF
+		self.emit("push bc")
+		self.emit("ld bc,nn",0x243B)										# select MMU6
+		self.emit("ld a,n",0x56)
+		self.emit("out (c),a")
+		self.emit("inc b")													# and read it
+		self.emit("in a,(c)")
+		self.emit("pop bc")
+		self.emit("ret")
+		restorePage = self.getAddress() & 0xFFFF
+		self.emit("nextreg n,a",0x56)
+		self.emit("inc a")
+		self.emit("nextreg n,a",0x57)
+		self.emit("ret")
+		return (readPage,restorePage)
+
+# ***************************************************************************************
+#									The linker
+# ***************************************************************************************
+
+class BankLinker(object):
+	def __init__(self,optimise = True,pageSize = 0x4000,removeUnused = True,target = "z80n",inline = False):
+		self.codeGen = BankedCodeGenerator(optimise,target)
+		self.optimise = optimise
+		self.target = target
+		self.inline = inline
+		self.inlined = {}													# procedure => [sites,T-states saved]
+		self.removeUnused = removeUnused 									# remove unreachable code
+		self.pageSize = pageSize 											# smaller to test paging
+		self.loopLines = []													# (first,last) lines of loops
+		self.procs = []														# [name,ops,entry,globals,calls]
+		self.loops = {}														# name => (first,last) of its loops
+		self.globals = {}
+		self.pages = {}														# name => page
+		self.sizes = {}														# name => code size measured
+		self.crossCalls = []												# (caller,callee,loop depth)
+		self.removed = ([],[])												# procedures,globals removed
+	#
+	#		Add an object module, or assemble source into one, to be linked later.
+	#
+	def addModule(self,module):
+		for name,ops,entry,globalsUsed,calls in module.procs:
+			self.procs.append((name,ops,entry,globalsUsed,calls))
+			self.loops[name] = module.loops[name]
+			self.loopLines += module.loops[name]
+	#
+	def assemble(self,src,firstLine = 1):
+		self.addModule(compileModule(src,firstLine = firstLine))
+	#
+	def assembleFile(self,fileName):
+		self.addModule(compileFile(fileName))
+	#
+	#		Place the procedures, then write them out.
+	#
+	def link(self):
+		if self.inline:
+			self.procs,self.inlined = inlineProcedures(self.procs,self.loops)
+		calls = self.callGraph()
+		if self.removeUnused:
+			self.procs,self.removed = removeUnreachable(self.procs)
+			self.loopLines[:] = [loop for p in self.procs for loop in self.loops[p[0]]]
+			calls = self.callGraph()
+		sizes = self.sizes = self.measure()
+		stubs = 0
+		while True:															# until enough room for stubs
+			self.pages = self.place(sizes,calls,stubs)
+			needed = len({callee for caller,callee in calls if self.isCrossPage(caller,callee)})
+			if needed <= stubs:
+				break
+			stubs = needed
+		self.crossCalls = [(caller,callee,depth) for name,ops,entry,globalsUsed,procCalls in self.procs \
+									for caller,callee,depth in self.callSites(name,procCalls) if self.isCrossPage(caller,callee)]
+		self.write()
+	#
+	#		Play each procedure into a scratch code generator, returning the code size
+	#		of each. Unpaged memory use is recorded too, including runtime routines.
+	#
+	def measure(self):
+		scratch = BankedCodeGenerator(self.optimise,self.target)
+		symbols = {}
+		for name,ops,entry,globalsUsed,calls in self.procs:
+			symbols[("proc",name)] = 0x8000
+			for g in globalsUsed:											# apart, as the peephole optimiser
+				if ("global",g) not in symbols:								# removes reloads of one
+					symbols[("global",g)] = scratch.allocVar(g)
+		sizes = {}
+		frames = FrameAllocator(lambda name: None)
+		self.dataSize = 2 * len({g for p in self.procs for g in p[3]})		# globals, locals, strings
+		for name,ops,entry,globalsUsed,calls in self.procs:
+			scratch.setAddress((MemoryImage.FIRSTPAGE << 16)+0xC000)
+			playBack(ops,scratch,symbols)
+			scratch.flush()
+			sizes[name] = scratch.image.getCodeAddress()-0xC000
+			for address in range(0xC000,0xC000+sizes[name]):				# so the next can't see it
+				scratch.image.write(MemoryImage.FIRSTPAGE,address,0)
+			frames.startFrame([callee for line,callee in calls])
+			for op in ops:
+				if op[0] == "allocVar":
+					frames.allocate()
+			frames.endFrame(name)
+		self.dataSize += 2 * len(frames.slots)								# locals are overlaid
+		self.dataSize += scratch.runtimeSize
+		self.stringSize = len(layoutStrings(self.strings())[0])
+		return sizes
+	#
+	#		The string constants used by the procedures.
+	#
+	def strings(self):
+		return recordedStrings(self.procs)
+	#
+	#		Calls made by a procedure, as (caller,callee,number of loops it is in).
+	#
+	def callSites(self,name,calls):
+		return [(name,callee,len([l for l in self.loops[name] if line >= l[0] and line <= l[1]])) for line,callee in calls]
+	#
+	#		Build the call graph, (caller,callee) => weight, checking the calls.
+	#
+	def callGraph(self):
+		graph = {}
+		known = set()
+		for name,ops,entry,globalsUsed,calls in self.procs:
+			for line,callee in calls:										# can only call earlier procs
+				if callee not in known:
+					unknownCall(self.procs,name,callee,line)
+			for caller,callee,depth in self.callSites(name,calls):
+				graph[(caller,callee)] = graph.get((caller,callee),0)+LOOPWEIGHT ** depth
+			known.add(name)
+		return graph
+	#
+	#		Place procedures into pages, leaving room in unpaged memory for stubs.
+	#		Returns name => page.
+	#
+	def place(self,sizes,calls,stubs):
+		cluster = { name:[name] for name in sizes.keys() }					# name => cluster it is in
+		for (caller,callee),weight in sorted(calls.items(),key = lambda c:-c[1]):
+			a,b = cluster[caller],cluster[callee]
+			if a is not b and sum(sizes[n] for n in a+b) <= self.pageSize:
+				a += b
+				for name in b:
+					cluster[name] = a
+		clusters = []
+		for name,ops,entry,globalsUsed,procCalls in self.procs:				# each once, in source order
+			if cluster[name][0] == name:
+				clusters.append(cluster[name])
+		incoming = {}														# calls from other clusters
+		for (caller,callee),weight in calls.items():
+			if cluster[caller] is not cluster[callee]:
+				incoming[id(cluster[callee])] = incoming.get(id(cluster[callee]),0)+weight
+		free = 0x4000 - self.dataSize - self.stringSize
+		if stubs > 0:
+			free -= BankedCodeGenerator.ROUTINESIZE + stubs * BankedCodeGenerator.STUBSIZE
+		pageFree = { 0:min(free,self.pageSize) }
+		pages = {}
+		for c in sorted(clusters,key = lambda c:-incoming.get(id(c),0)):	# unpaged, most called first
+			if sum(sizes[n] for n in c) <= pageFree[0]:
+				pageFree[0] -= sum(sizes[n] for n in c)
+				pages.update({ name:0 for name in c })
+		for c in sorted(clusters,key = lambda c:-sum(sizes[n] for n in c)):	# the rest, biggest first
+			if c[0] not in pages:
+				size = sum(sizes[n] for n in c)
+				if size > self.pageSize:
+					raise AssemblerException("Procedure "+c[0]+"( does not fit in a page")
+				page = next((p for p in range(MemoryImage.FIRSTPAGE,MemoryImage.LASTPAGE+1,2) \
+										if pageFree.get(p,self.pageSize) >= size),None)
+				if page is None:
+					raise AssemblerException("Out of code pages")
+				pageFree[page] = pageFree.get(page,self.pageSize) - size
+				pages.update({ name:page for name in c })
+		return pages
+	#
+	#		A call needs a stub if the procedure called is paged, and isn't in the
+	#		caller's page.
+	#
+	def isCrossPage(self,caller,callee):
+		return self.pages[callee] != 0 and self.pages[callee] != self.pages[caller]
+	#
+	#		Write the procedures out in source order, globals first.
+	#
+	def write(self):
+		symbols = {}
+		for name,ops,entry,globalsUsed,calls in self.procs:
+			for g in globalsUsed:
+				if ("global",g) not in symbols:
+					symbols[("global",g)] = self.codeGen.allocVar(g)
+					self.globals[g] = symbols[("global",g)]
+		self.codeGen.poolStrings(self.strings())
+		frames = FrameAllocator(self.codeGen.allocVar)
+		for name,ops,entry,globalsUsed,calls in self.procs:
+			procSymbols = symbols
+			for line,callee in calls:										# calls via a stub
+				if self.isCrossPage(name,callee):
+					procSymbols = dict(procSymbols) if procSymbols is symbols else procSymbols
+					procSymbols[("proc",callee)] = self.codeGen.stub(symbols[("proc",callee)])
+			self.codeGen.selectPage(self.pages[name])
+			start = self.codeGen.image.getCodeAddress()
+			frames.startFrame([callee for line,callee in calls])
+			labels = playBack(ops,self.codeGen,procSymbols,frames.allocate)
+			frames.endFrame(name)
+			self.codeGen.flush()
+			if self.codeGen.image.getCodeAddress()-start > self.sizes[name]:	# pages were filled by size
+				raise AssemblerException("Procedure "+name+"( is bigger than it was measured")
+			symbols[("proc",name)] = labels[entry]
+			self.globals[name+"("] = labels[entry]
+		self.codeGen.selectPage(0)
+	#
+	#		Report on the placement, as a list of text lines.
+	#
+	def report(self):
+		lines = []
+		self.codeGen.selectPage(0)											# so all the pointers are saved
+		for page in sorted(set(self.pages.values())):
+			names = [name for name in self.pages.keys() if self.pages[name] == page]
+			used = self.codeGen.pointers[page]-(0x8000 if page == 0 else 0xC000)
+			lines.append("page {0:<3} {1:>6} bytes used {2:>4} procedure(s)".format(page,used,len(names)))
+		lines.append("{0} cross page call(s), {1} in loops, {2} stub(s)".format(len(self.crossCalls),
+									len([c for c in self.crossCalls if c[2] > 0]),len(self.codeGen.stubs)))
+		return lines
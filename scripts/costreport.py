@@ -0,0 +1,114 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		costreport.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		28th January 2019
+#		Purpose :	Static size and T-state report for Z80 code, per procedure and
+#					per source line, as JSON or CSV.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import csv,json
+from z80opcodes import *
+
+# ***************************************************************************************
+#
+#		The code generator records which source line each piece of code came from.
+#		That code is decoded from the image using the opcode table, so the costs are
+#		those of what was actually written. T-states are those when jumps are taken.
+#		Calls to the runtime routines for * / and % include the routine's average
+#		T-states, from the table in mathlib.py.
+#
+#		Loops are given the cost of one time round, which is the total for the lines
+#		from the for( or while( to the next or endwhile. For FOR loops that includes
+#		setting up the count, which is only done once.
+#
+# ***************************************************************************************
+
+class CostReport(object):
+	def __init__(self,worker):
+		codeGen = worker.codeGen
+		codeGen.flush()
+		self.procedures = sorted((address,name[:-1]) for name,address in worker.globals.items() if name.endswith("("))
+		self.lines = {}														# (procedure,line) => [bytes,tstates]
+		for page,start,end,line in codeGen.lineCode:
+			procedure = self.findProcedure((page << 16)+start)
+			if (procedure,line) not in self.lines:
+				self.lines[(procedure,line)] = [0,0]
+			cost = self.lines[(procedure,line)]
+			address = start
+			while address < end:
+				mnemonic,size,tStates,tNotTaken = decodeInstruction(lambda a: codeGen.image.read(page,a),address)
+				cost[0] += size
+				cost[1] += tStates
+				if mnemonic == "call nn":
+					cost[1] += codeGen.runtimeCost(codeGen.image.readWord(page,address+1))
+				address += size
+		self.loops = []														# [procedure,first,last,bytes,tstates]
+		for first,last in sorted(worker.loopLines):
+			procedure = self.lineProcedure(first)
+			self.loops.append([procedure,first,last]+self.total(procedure,first,last))
+	#
+	#		Find the procedure an address is in, the last one starting before it.
+	#
+	def findProcedure(self,address):
+		name = None
+		for entry,procedure in self.procedures:
+			if entry <= address:
+				name = procedure
+		return name
+	#
+	#		Find the procedure a line has code in.
+	#
+	def lineProcedure(self,line):
+		for procedure,procLine in self.lines.keys():
+			if procLine == line:
+				return procedure
+		return None
+	#
+	#		Total cost of the lines first..last in a procedure.
+	#
+	def total(self,procedure,first,last):
+		costs = [cost for (proc,line),cost in self.lines.items() if proc == procedure and line >= first and line <= last]
+		return [sum(c[0] for c in costs),sum(c[1] for c in costs)]
+	#
+	#		Number of loops a line is in.
+	#
+	def loopDepth(self,procedure,line):
+		return len([loop for loop in self.loops if loop[0] == procedure and line >= loop[1] and line <= loop[2]])
+	#
+	#		Create the report as a list of records.
+	#
+	def records(self):
+		records = []
+		byProcedure = {}
+		for (procedure,line),(byteCount,tStates) in sorted(self.lines.items(),key = lambda x:x[0][1]):
+			records.append({ "kind":"line","procedure":procedure,"line":line,"last":line,
+							"bytes":byteCount,"tstates":tStates,"loops":self.loopDepth(procedure,line) })
+			if procedure not in byProcedure:
+				byProcedure[procedure] = [line,line,0,0]
+			cost = byProcedure[procedure]
+			cost[0],cost[1] = min(cost[0],line),max(cost[1],line)
+			cost[2] += byteCount
+			cost[3] += tStates
+		for procedure,(first,last,byteCount,tStates) in byProcedure.items():
+			records.append({ "kind":"procedure","procedure":procedure,"line":first,"last":last,
+							"bytes":byteCount,"tstates":tStates,"loops":0 })
+		for procedure,first,last,byteCount,tStates in self.loops:
+			records.append({ "kind":"loop","procedure":procedure,"line":first,"last":last,
+							"bytes":byteCount,"tstates":tStates,"loops":self.loopDepth(procedure,first) })
+		return records
+	#
+	#		Write the report, as JSON or CSV depending on the file name.
+	#
+	def write(self,fileName):
+		records = self.records()
+		with open(fileName,"w",newline = "") as h:
+			if fileName.lower().endswith(".csv"):
+				writer = csv.DictWriter(h,["kind","procedure","line","last","bytes","tstates","loops"])
+				writer.writeheader()
+				writer.writerows(records)
+			else:
+				json.dump(records,h,indent = 1)
@@ -9,6 +9,8 @@
 # ***************************************************************************************
 # ***************************************************************************************
 
+from tracesink import *
+
 # ***************************************************************************************
 #					This is a code generator for an idealised CPU
 # ***************************************************************************************
@@ -16,13 +18,25 @@
 class DemoCodeGenerator(object):
 	def __init__(self):
 		self.pc = 0x1000
-		self.ops = { "+":"add","-":"sub","*":"mul","/":"div","%":"mod","&":"and","|":"ora","^":"xor" }
+		self.strings = {}													# string => address
+		self.ops = { "+":"add","-":"sub","*":"mul","/":"div","%":"mod","&":"and","|":"ora","^":"xor","<<":"shl",">>":"shr" }
+	#
+	#		Send a listing line to the trace sink, only formatted if it is wanted.
+	#
+	def listing(self,format,*args):
+		if Trace.sink.level >= TRACE_LISTING:
+			Trace.sink.event("listing",format.format(*args))
 	#
 	#		Get current address
 	#
 	def getAddress(self):
 		return self.pc
 	#
+	#		Set current address
+	#
+	def setAddress(self,address):
+		self.pc = address
+	#
 	#		Get word size
 	#
 	def getWordSize(self):
@@ -31,85 +45,107 @@ class DemoCodeGenerator(object):
 	#		Load a constant or variable into the accumulator.
 	#
 	def loadDirect(self,isConstant,value):
-		src = ("#${0:04x}" if isConstant else "(${0:04x})").format(value)
-		print("${0:06x}  lda   {1}".format(self.pc,src))
+		self.listing("${0:06x}  lda   #${1:04x}" if isConstant else "${0:06x}  lda   (${1:04x})",self.pc,value)
 		self.pc += 1
 	#
 	#		store A to an address
 	#
 	def storeDirect(self,address):
-		print("${0:06x}  sta   (${1:04x})".format(self.pc,address))
+		self.listing("${0:06x}  sta   (${1:04x})",self.pc,address)
 		self.pc += 1
 	#
 	#		save A temporarily for writing later
 	#
 	def saveAccumulator(self):
-		print("${0:06x}  tab".format(self.pc))
+		self.listing("${0:06x}  tab",self.pc)
 		self.pc += 1
 	#
 	#		save value saved by 'save Accumulator' at address A.
 	#
 	def saveIndirect(self):
-		print("${0:06x}  stb.w [a]".format(self.pc))
+		self.listing("${0:06x}  stb.w [a]",self.pc)
 		self.pc += 1
 	#
 	#		Do a binary operation on a constant or variable on the accumulator
 	#							+ - * / % 		& | ^ 		!
+	#		<< and >> are shifts by a constant, created by the assembler.
 	#
 	def binaryOperation(self,operator,isConstant,value):
 		if operator == "!":
 			self.binaryOperation("+",isConstant,value)
-			print("${0:06x}  lda.w [a]".format(self.pc))
+			self.listing("${0:06x}  lda.w [a]",self.pc)
 			self.pc += 1
 		else:					
-			src = ("#${0:04x}" if isConstant else "(${0:04x})").format(value)
-			print("${0:06x}  {1}   {2}".format(self.pc,self.ops[operator],src))
+			self.listing("${0:06x}  {1}   #${2:04x}" if isConstant else "${0:06x}  {1}   (${2:04x})",self.pc,self.ops[operator],value)
 			self.pc += 1
 	#
-	#		Push and restore A on stack for FOR/NEXT
+	#		Start a FOR loop. The count is a constant, or None if it is in A. Index is
+	#		the address to write the count to, None if not needed. Returns the loop.
 	#
-	def pushA(self):
-		print("${0:06x}  push  a".format(self.pc))
+	def loopStart(self,count,index):
+		if count is not None:
+			self.loadDirect(True,count)
+		loop = self.getAddress()
+		self.binaryOperation("-",True,1)
+		self.listing("${0:06x}  push  a",self.pc)
 		self.pc += 1
+		if index is not None:
+			self.storeDirect(index)
+		return loop
 	#
-	def popA(self):
-		print("${0:06x}  pop   a".format(self.pc))
+	#		End a FOR loop, going round again if the count isn't zero.
+	#
+	def loopEnd(self,loop):
+		self.listing("${0:06x}  pop   a",self.pc)
 		self.pc += 1
+		self.setJumpAddress(self.jumpInstruction("nz"),loop)
 	#
 	#		Allocate count bytes of meory, default is word size
 	#
 	def allocVar(self,name = None):
 		addr = self.pc
 		self.pc += self.getWordSize()
-		print("${0:06x}  dw    $0000 ; {1} {0}".format(addr,"" if name is None else name))
+		self.listing("${0:06x}  dw    $0000 ; {1} {0}",addr,"" if name is None else name)
 		return addr
 	#
 	#		Load parameter constant/variable to a temporary area,
 	#
 	def loadParamRegister(self,regNumber,isConstant,value):
-		toLoad = "#${0:04x}" if isConstant else "(${0:04x})" 
-		print("${0:06x}  ldr   r{1},{2}".format(self.pc,regNumber,toLoad.format(value)))
+		self.listing("${0:06x}  ldr   r{1},#${2:04x}" if isConstant else "${0:06x}  ldr   r{1},(${2:04x})",self.pc,regNumber,value)
 		self.pc += 1
 	#
 	#		Copy parameter to an actual variable
 	#
 	def storeParamRegister(self,regNumber,address):
-		print("${0:06x}  str   r{1},(${2:04x})".format(self.pc,regNumber,address))
+		self.listing("${0:06x}  str   r{1},(${2:04x})",self.pc,regNumber,address)
 		self.pc += 1
 	#
-	#		Create a string constant (done outside procedures)
+	#		Copy parameter register to the accumulator
+	#
+	def copyParamRegister(self,regNumber):
+		self.listing("${0:06x}  ldr   a,r{1}",self.pc,regNumber)
+		self.pc += 1
+	#
+	#		Create a string constant (done outside procedures), each one only once.
 	#
 	def createStringConstant(self,string):
-		sAddr = self.pc
-		print("${0:06x}  db    \"{1}\",0".format(self.pc,string))
-		self.pc += len(string)+1
-		return sAddr
+		if string not in self.strings:
+			self.strings[string] = self.pc
+			self.listing("${0:06x}  db    \"{1}\",0",self.pc,string)
+			self.pc += len(string)+1
+		return self.strings[string]
+	#
+	#		Create all the strings a program uses.
+	#
+	def poolStrings(self,strings):
+		for string in strings:
+			self.createStringConstant(string)
 	#
 	#	Compile a loop instruction. Test are z, nz, p or "" (unconditional). No target
 	#	address is provided at compile time.
 	#
 	def jumpInstruction(self,test):
-		print("${0:06x}  jmp   {1}?????".format(self.pc,test+"," if test != "" else ""))
+		self.listing("${0:06x}  jmp   {1}?????",self.pc,test+"," if test != "" else "")
 		jumpAddress = self.pc
 		self.pc += 1
 		return jumpAddress
@@ -117,16 +153,37 @@ class DemoCodeGenerator(object):
 	#		Set Jump Address for a jump already compile.
 	#
 	def setJumpAddress(self,jumpAddress,target):
-		print("${0:06x}  patch to ${1:06x}".format(jumpAddress,target))
+		self.listing("${0:06x}  patch to ${1:06x}",jumpAddress,target)
 	#
 	#		Call a subroutine
 	#
 	def callSubroutine(self,address):
-		print("${0:06x}  call  ${1:06x}".format(self.pc,address))
+		self.listing("${0:06x}  call  ${1:06x}",self.pc,address)
+		self.pc += 1
+	#
+	#		Jump to a subroutine, which returns for this one.
+	#
+	def tailCall(self,address):
+		self.listing("${0:06x}  jmp   ${1:06x}",self.pc,address)
+		self.pc += 1
+	#
+	#		Block copy, fill and compare, from r0 to r1, count constant or r2.
+	#
+	def copyMemory(self,count,kind):
+		self.blockOperation("copy"+{ "move":"","up":"u","words":"w" }[kind],count)
+	#
+	def fillMemory(self,count,words):
+		self.blockOperation("fill"+("w" if words else ""),count)
+	#
+	def compareMemory(self,count):
+		self.blockOperation("cmp",count)
+	#
+	def blockOperation(self,mnemonic,count):
+		self.listing("${0:06x}  {1:<5} r0,r1,"+("#${2:04x}" if count is not None else "r2"),self.pc,mnemonic,count)
 		self.pc += 1
 	#
 	#		Return from subroutine.
 	#
 	def returnSubroutine(self):
-		print("${0:06x}  rts".format(self.pc))
+		self.listing("${0:06x}  rts",self.pc)
 		self.pc += 1
@@ -0,0 +1,131 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		hla.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		22nd January 2019
+#		Purpose :	Command line assembler. Assembles the files given, or standard
+#					input if there are none. -z80 generates Z80 code into boot.img
+#					-costs=<file> writes a size and T-state report, .json or .csv
+#					-trace=<file> writes the listing to a file instead of the console
+#					-trace=<level> is none, errors, phases, commands or listing
+#					-quiet is the same as -trace=errors
+#					-phases prints the time taken by each phase of assembly
+#					-nex=<file> writes a .nex file too, with only the pages used
+#					-lz=<file> writes the used pages packed, for lzbootloader.asm
+#					-banked links Z80 code across the memory pages
+#					-object=<file> assembles the files into an object file only
+#					-cache=<directory> keeps the source files as object files,
+#					only assembling them again when they change
+#					Files ending .hlo are object files, which are linked in
+#					-target=z80 uses only Z80 instructions for * / % and block
+#					copies, the default is z80n, which uses the Next's MUL D,E
+#					and zxnDMA
+#					-inline inlines small procedures and those called from only
+#					one place
+#					The files are linked, leaving out procedures, strings and
+#					globals the _boot procedures never reach, if there are any
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import sys
+from tracesink import *
+from assembler import *
+from democodegen import *
+from z80codegen import *
+from costreport import *
+from banklinker import *
+from lzpack import *
+from objectfile import *
+
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	values = lambda option: [x[len(option):] for x in args if x.startswith(option)]
+	banked = "-banked" in args
+	z80 = "-z80" in args or banked
+	costs = values("-costs=")
+	nex = values("-nex=")
+	packed = values("-lz=")
+	objectFile = values("-object=")
+	cacheDirectory = values("-cache=")
+	target = (values("-target=")+["z80n"])[0]
+	if target not in RUNTIMELIBRARY:
+		print("Unknown target "+target)
+		sys.exit(1)
+	level = TRACE_ERRORS if "-quiet" in args else TRACE_LISTING
+	traceFile = None
+	for option in values("-trace="):
+		if option in TRACE_LEVELS:
+			level = TRACE_LEVELS[option]
+		else:
+			traceFile = option
+	phases = "-phases" in args or level == TRACE_PHASES
+	if phases:
+		level = max(level,TRACE_PHASES)
+	files = [x for x in args if not x.startswith("-") or x == "-"]
+	files = files if len(files) > 0 else ["-"]
+	inline = "-inline" in args
+	installTraceSink(FileSink(traceFile,level))
+	if banked:
+		aw = BankLinker(target = target,inline = inline)
+	else:
+		aw = ObjectLinker(Z80CodeGenerator(target = target) if z80 else DemoCodeGenerator(),inline)
+	cache = ObjectCache(cacheDirectory[0]) if len(cacheDirectory) > 0 else None
+	try:
+		if len(objectFile) > 0:												# make an object file only
+			modules = [compileFile(f) for f in files]
+			module = ObjectModule(objectFile[0],[p for m in modules for p in m.procs],
+										{ name:m.loops[name] for m in modules for name in m.loops.keys() })
+			saveObject(module,objectFile[0])
+			Trace.sink.close()
+			for line in module.describe():
+				print(line)
+			sys.exit(0)
+		for fileName in files:
+			if fileName.endswith(".hlo"):
+				aw.addModule(loadObject(fileName))
+			elif cache is not None:
+				aw.addModule(cache.module(fileName))
+			else:
+				aw.assembleFile(fileName)
+		aw.link()
+		written = []														# reports on the files written
+		if z80:
+			aw.codeGen.flush()
+			aw.codeGen.image.save()
+			for fileName in nex:
+				aw.codeGen.image.saveNex(fileName)
+				written += aw.codeGen.image.loadReport()
+			for fileName in packed:
+				written += savePacked(aw.codeGen.image,fileName)
+	except AssemblerException as e:
+		Trace.sink.close()
+		sys.exit(1)
+	except MemoryImageException as e:										# the image is full, or won't pack
+		if Trace.sink.level >= TRACE_ERRORS:
+			Trace.sink.event("error",e.message)
+		Trace.sink.close()
+		sys.exit(1)
+	Trace.sink.close()
+	if phases:
+		for line in Trace.sink.phaseReport():
+			print(line)
+	if cache is not None:
+		print("{0} module(s) from the cache, {1} assembled".format(cache.hits,cache.misses))
+	print(aw.globals)
+	for line in removedReport(aw.removed):
+		print(line)
+	if inline:
+		for line in inlineReport(aw.inlined):
+			print(line)
+	if z80:
+		for line in written:
+			print(line)
+		for line in aw.codeGen.peephole.report():
+			print(line)
+		if banked:
+			for line in aw.report():
+				print(line)
+		for fileName in costs:
+			CostReport(aw).write(fileName)
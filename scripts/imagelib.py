@@ -0,0 +1,214 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		imagelib.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		25th January 2019
+#		Purpose :	Memory image, laid out as bootloader.asm loads boot.img
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+# ***************************************************************************************
+#
+#		boot.img is $8000-$BFFF, followed by 8k pages 32 to 95 in pairs, each pair
+#		loaded into $C000-$FFFF. Addresses are page and address. Page 0 is the
+#		unpaged memory $8000-$BFFF, otherwise the page is the even page which is
+#		mapped into $C000-$DFFF, the odd one following into $E000-$FFFF.
+#
+#		Code is written upwards from a code pointer. Data is allocated downwards
+#		from $BFFF, so it is always accessible.
+#
+#		String constants are pooled in the data, each one only once, and a string
+#		which is the end of another one shares it, as they both end in the same
+#		zero. Pooling all the strings at once shares the most.
+#
+#		It can also be written as a .nex file, holding only the pages used.
+#
+# ***************************************************************************************
+
+class MemoryImageException(Exception):
+	def __init__(self,message):
+		Exception.__init__(self,message)
+		self.message = message
+
+class MemoryImage(object):
+	FIRSTPAGE = 32 															# these are the pages for an
+	LASTPAGE = 95 															# unexpanded ZXNext.
+	#
+	def __init__(self):
+		self.pageCount = (MemoryImage.LASTPAGE-MemoryImage.FIRSTPAGE+1) // 2	# 16k page pairs
+		self.memory = bytearray(0x4000 * (self.pageCount+1))				# the whole image, zeroed.
+		self.view = memoryview(self.memory)
+		self.dataAddress = 0xC000 											# data allocated down from here
+		self.unpagedEnd = 0x8000 											# highest unpaged code
+		self.codePage = None
+		self.setCodePointer(0,0x8000)
+		self.strings = {}													# string => address in pool
+	#
+	#		Convert page/address to an offset in the image.
+	#
+	def offset(self,page,address):
+		if page == 0:
+			if address < 0x8000 or address >= 0xC000:
+				raise MemoryImageException("Bad unpaged address ${0:04x}".format(address))
+			return address - 0x8000
+		if page < MemoryImage.FIRSTPAGE or page > MemoryImage.LASTPAGE or (page & 1) != 0 or address < 0xC000 or address > 0xFFFF:
+			raise MemoryImageException("Bad paged address {0}:${1:04x}".format(page,address))
+		return ((page - MemoryImage.FIRSTPAGE) // 2 + 1) * 0x4000 + address - 0xC000
+	#
+	#		Get/Set the code pointer
+	#
+	def getCodePage(self):
+		return self.codePage
+	#
+	def getCodeAddress(self):
+		return self.codeAddress
+	#
+	def setCodePointer(self,page,address):
+		self.unpagedEnd = self.getUnpagedEnd()
+		self.codeOffset = self.offset(page,address)
+		self.codePage = page
+		self.codeAddress = address
+		self.codeLimit = self.dataAddress if page == 0 else 0x10000		# top of the code area
+	#
+	#		Compile bytes and words at the code pointer.
+	#
+	def cByte(self,byte):
+		if self.codeAddress >= self.codeLimit:
+			raise MemoryImageException("Code page {0} full".format(self.codePage))
+		self.memory[self.codeOffset] = byte
+		self.codeOffset += 1
+		self.codeAddress += 1
+	#
+	def cWord(self,word):
+		if self.codeAddress+2 > self.codeLimit:
+			raise MemoryImageException("Code page {0} full".format(self.codePage))
+		self.memory[self.codeOffset] = word & 0xFF
+		self.memory[self.codeOffset+1] = (word >> 8) & 0xFF
+		self.codeOffset += 2
+		self.codeAddress += 2
+	#
+	def cBytes(self,data):
+		if self.codeAddress+len(data) > self.codeLimit:
+			raise MemoryImageException("Code page {0} full".format(self.codePage))
+		self.memory[self.codeOffset:self.codeOffset+len(data)] = bytes(data)
+		self.codeOffset += len(data)
+		self.codeAddress += len(data)
+	#
+	#		Read and write anywhere, used for patching.
+	#
+	def read(self,page,address):
+		return self.memory[self.offset(page,address)]
+	#
+	def write(self,page,address,byte):
+		self.memory[self.offset(page,address)] = byte
+	#
+	def readWord(self,page,address):
+		offset = self.offset(page,address)
+		return self.memory[offset] + (self.memory[offset+1] << 8)
+	#
+	def writeWord(self,page,address,word):
+		offset = self.offset(page,address)
+		self.memory[offset] = word & 0xFF
+		self.memory[offset+1] = (word >> 8) & 0xFF
+	#
+	#		Highest address used by code in unpaged memory.
+	#
+	def getUnpagedEnd(self):
+		return max(self.unpagedEnd,self.codeAddress) if self.codePage == 0 else self.unpagedEnd
+	#
+	#		Allocate count bytes of data in unpaged memory, returns the address.
+	#
+	def allocateData(self,count):
+		if self.dataAddress - count < self.getUnpagedEnd():
+			raise MemoryImageException("Out of data memory")
+		self.dataAddress -= count
+		if self.codePage == 0:
+			self.codeLimit = self.dataAddress
+		return self.dataAddress
+	#
+	#		Add strings to the pool.
+	#
+	def poolStrings(self,strings):
+		text,offsets = layoutStrings([s for s in strings if self.findString(s) is None])
+		if len(text) > 0:
+			address = self.allocateData(len(text))
+			for i in range(0,len(text)):
+				self.write(0,address+i,ord(text[i]) & 0xFF)
+			self.strings.update({ string:address+offsets[string] for string in offsets.keys() })
+	#
+	#		Get the address of a string in the pool, adding it if it isn't there.
+	#
+	def stringAddress(self,string):
+		if self.findString(string) is None:
+			self.poolStrings([string])
+		return self.findString(string)
+	#
+	#		Find a string in the pool, or one it is the end of. None if not found.
+	#
+	def findString(self,string):
+		if string not in self.strings:
+			owner = next((s for s in self.strings.keys() if s.endswith(string)),None)
+			if owner is None:
+				return None
+			self.strings[string] = self.strings[owner]+len(owner)-len(string)
+		return self.strings[string]
+	#
+	#		Write the image out in one go.
+	#
+	def save(self,fileName = "boot.img"):
+		with open(fileName,"wb") as h:
+			h.write(self.view)
+	#
+	#		Pages which have something in them, 0 (unpaged memory) is always used.
+	#
+	def usedPages(self):
+		empty = bytes(0x4000)
+		return [0]+[page for page in range(MemoryImage.FIRSTPAGE,MemoryImage.LASTPAGE+1,2) \
+							if self.memory[self.offset(page,0xC000):self.offset(page,0xC000)+0x4000] != empty]
+	#
+	#		Write a .nex file with just the used pages, which the Next loads itself
+	#		without the bootloader. Unpaged memory is 16k bank 2, page n is bank n/2.
+	#		Banks follow the header in order, bank 2 first. The first used page is
+	#		mapped in at $C000 when it starts.
+	#
+	def saveNex(self,fileName = "boot.nex",start = 0x8000,stack = 0x7F00):
+		pages = self.usedPages()
+		header = bytearray(512)
+		header[0:8] = b"NextV1.2"
+		header[9] = len(pages)												# number of 16k banks
+		header[12:16] = bytes([stack & 0xFF,stack >> 8,start & 0xFF,start >> 8])
+		for page in pages:
+			header[18+(2 if page == 0 else page // 2)] = 1					# bank present
+		header[139] = pages[1] // 2 if len(pages) > 1 else 0				# bank at $C000
+		with open(fileName,"wb") as h:
+			h.write(header)
+			for page in pages:
+				offset = self.offset(page,0x8000 if page == 0 else 0xC000)
+				h.write(self.view[offset:offset+0x4000])
+		return 512+len(pages)*0x4000
+	#
+	#		What loading it takes, as boot.img and as a .nex file, as text lines.
+	#
+	def loadReport(self):
+		pages = len(self.usedPages())
+		return [ "boot.img {0:>8} bytes {1:>3} 16k blocks".format(len(self.memory),self.pageCount+1),
+				 "boot.nex {0:>8} bytes {1:>3} 16k blocks".format(512+pages*0x4000,pages) ]
+
+#
+#		Lay out strings as ASCIIZ, each once, with those that are the end of another
+#		sharing it. Returns the text and string => offset in it.
+#
+def layoutStrings(strings):
+	unique = sorted(set(strings),key = lambda s:s[::-1])					# ends of strings come before them
+	text = ""
+	offsets = {}
+	for i in range(len(unique)-1,-1,-1):
+		string = unique[i]
+		if i+1 < len(unique) and unique[i+1].endswith(string):				# end of the next one
+			offsets[string] = offsets[unique[i+1]]+len(unique[i+1])-len(string)
+		else:
+			offsets[string] = len(text)
+			text += string+"\x00"
+	return text,offsets
@@ -0,0 +1,180 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		inliner.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		5th February 2019
+#		Purpose :	Inlines small procedures, and those called from only one place, in
+#					recorded procedures before they are linked.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		Works on recordings (see recordcodegen.py), as procedures are linked, so the
+#		number of places each procedure is called from is known. A call is replaced
+#		by a copy of the procedure's recording if the procedure is no bigger than
+#		INLINESIZE operations, or INLINELOOPSIZE if the call is in a loop, or it is
+#		only called from one place. The bank linker leaves out procedures which are
+#		no longer called.
+#
+#		A call is only inlined if that is estimated to save time, which it may not
+#		in a loop, as each call the procedure makes has to keep the loop count.
+#
+#		A parameter the procedure only reads is replaced by the value passed, if it
+#		is a constant, or a variable the procedure can't change before it last
+#		reads it, by writing the variable, or through memory, or calling. Other
+#		parameters are copied in. The procedure's labels are renumbered, its code
+#		is listed against the line of the call, and the calls it makes become the
+#		caller's.
+#
+#		Procedures which return anywhere but at the end, or by a tail call, or don't
+#		store all their parameters, as lean procedures may not, and calls which pass
+#		the wrong number of parameters, are not inlined.
+#
+# ***************************************************************************************
+
+INLINESIZE = 8
+INLINELOOPSIZE = 24
+
+NOCODE = { "line","allocVar","createStringConstant","getAddress","setJumpAddress" }
+READS = { "loadDirect":1,"binaryOperation":2,"loadParamRegister":2 }		# op => position of isConstant
+WRITES = { "saveIndirect","callSubroutine","tailCall","copyMemory","fillMemory" }	# can change any variable
+
+#
+#		Inline calls in procedures, (name,ops,entry,globals used,calls), in source
+#		order. Loops is name => (first,last) lines of its loops. Returns the new
+#		procedures, and callee => [call sites inlined,T-states saved over one call at each].
+#
+def inlineProcedures(procs,loops):
+	sites = {}
+	for p in procs:
+		for line,callee in p[4]:
+			sites[callee] = sites.get(callee,0)+1
+	done = {}																# name => procedure, inlined
+	inlined = {}
+	for name,ops,entry,globalsUsed,calls in procs:
+		newOps = []
+		calls = list(calls)
+		globalsUsed = list(globalsUsed)
+		labelCount = max([value[1] for op in ops for value in op[1:] if isLabel(value)]+[0])
+		line = None
+		for op in ops:
+			if op[0] == "line":
+				line = op[1]
+			if op[0] == "callSubroutine" and op[1][0] == "proc" and op[1][1] in done:
+				callee = done[op[1][1]]
+				args = []
+				while len(newOps) > 0 and newOps[-1][0] == "loadParamRegister":
+					args.insert(0,newOps.pop())
+				depth = len([l for l in loops.get(name,[]) if line is not None and line >= l[0] and line <= l[1]])
+				saving = 0
+				if worthInlining(callee,sites[callee[0]],depth) and canInline(callee,args):
+					expanded,copied = expand(callee,[(a[2],a[3]) for a in args],labelCount)
+					saving = callSaving(args,copied,len(callee[4]),depth)
+				if saving > 0:
+					newOps += expanded
+					labelCount += max([value[1] for op in callee[1] for value in op[1:] if isLabel(value)]+[0])
+					site = next((c for c in calls if c == (line,callee[0])),None) or next(c for c in calls if c[1] == callee[0])
+					calls.remove(site)
+					calls += [(site[0],c) for l,c in callee[4]]						# the caller makes its calls
+					globalsUsed += [g for g in callee[3] if g not in globalsUsed]
+					info = inlined.setdefault(callee[0],[0,0])
+					info[0] += 1
+					info[1] += saving
+					continue
+				newOps += args
+			newOps.append(op)
+		done[name] = (name,newOps,entry,globalsUsed,calls)
+	return [done[p[0]] for p in procs],inlined
+#
+#		Report on inlining as text lines.
+#
+def inlineReport(inlined):
+	return ["inlined {0}( at {1} call site(s), {2} T-states saved over one call at each".format(name,sites,saved) \
+									for name,(sites,saved) in sorted(inlined.items())]
+
+# ***************************************************************************************
+#									Support
+# ***************************************************************************************
+
+def isLabel(value):
+	return type(value) == tuple and len(value) == 2 and value[0] == "label"
+#
+#		Operations which generate code.
+#
+def procedureSize(ops):
+	return len([op for op in ops if op[0] not in NOCODE])
+#
+def worthInlining(proc,siteCount,depth):
+	size = procedureSize(proc[1])
+	return siteCount == 1 or size <= INLINESIZE or (depth > 0 and size <= INLINELOOPSIZE)
+#
+#		A procedure can be inlined if it only returns at the end, and the call
+#		passes the parameters it stores.
+#
+def canInline(proc,args):
+	code = [op for op in proc[1] if op[0] not in NOCODE]
+	params = [op[1] for op in proc[1] if op[0] == "storeParamRegister"]
+	if [op for op in code if op[0] == "returnSubroutine"] != code[-1:] or code[-1:] != [("returnSubroutine",)]:
+		return False
+	return params == list(range(0,len(params))) and [a[1] for a in args] == params
+#
+#		Check a parameter is only read by a procedure, and the value passed can't be
+#		changed by it before the last read, so it can be used instead.
+#
+def canSubstitute(ops,address,isConstant,value):
+	lastRead = 0
+	for n in range(0,len(ops)):
+		op = ops[n]
+		for i in range(1,len(op)):
+			if op[i] == address and op[0] != "storeParamRegister" and op[0] != "allocVar":
+				if op[0] not in READS or i != len(op)-1 or op[READS[op[0]]]:	# not a read
+					return False
+				lastRead = n
+	if isConstant:
+		return True
+	return all(op[0] not in WRITES and op != ("storeDirect",value) for op in ops[:lastRead])
+#
+#		Copy a procedure's recording for a call with the parameters (isConstant,value).
+#		Returns the copy, and the parameters which are copied in.
+#
+def expand(proc,args,labelOffset):
+	name,ops,entry,globalsUsed,calls = proc
+	params = { op[2]:args[op[1]] for op in ops if op[0] == "storeParamRegister" }
+	substitute = { address:arg for address,arg in params.items() if canSubstitute(ops,address,arg[0],arg[1]) }
+	relabel = lambda v: ("label",v[1]+labelOffset) if isLabel(v) else v
+	expanded = []
+	copied = []
+	for op in ops:
+		if op[0] == "line" or op[0] == "returnSubroutine" or op == ("getAddress",entry):
+			continue
+		if op[0] == "allocVar" and op[1] in substitute:
+			continue
+		if op[0] == "storeParamRegister":
+			if op[2] not in substitute:
+				copied.append(params[op[2]])
+				expanded += [("loadDirect",)+params[op[2]],("storeDirect",relabel(op[2]))]
+		elif op[0] in READS and op[-1] in substitute and not op[READS[op[0]]]:	# reads a parameter
+			expanded.append(op[:READS[op[0]]]+substitute[op[-1]])
+		else:
+			expanded.append(tuple([op[0]]+[relabel(v) for v in op[1:]]))
+	return expanded,copied
+#
+#		Estimated T-states saved over one call on the Z80: the call and return, and
+#		loading and storing the parameter registers, less copying parameters in. In
+#		a loop each call keeps the count on the stack, so the calls the procedure
+#		makes cost more once it is inlined.
+#
+def callSaving(args,copied,calls,depth):
+	saving = instructionTime([("call nn",None),("ret",None)])
+	for op in args:
+		saving += instructionTime([("ld de,nn" if op[2] else "ld de,(nn)",None),("ld (nn),de",None)])
+	for isConstant,value in copied:
+		saving -= instructionTime([("ld hl,nn" if isConstant else "ld hl,(nn)",None),("ld (nn),hl",None)])
+	if depth > 0:
+		saving -= (calls-1) * instructionTime([("push bc",None),("pop bc",None)])
+	return saving
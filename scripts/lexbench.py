@@ -0,0 +1,163 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		lexbench.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		21st January 2019
+#		Purpose :	Compares lines/second of the tokenising front end against the older
+#					string join/re.split front end it replaced. Exits with 1 if the
+#					tokenising front end is the slower one.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import re,sys,time
+from assembler import *
+from democodegen import *
+
+#
+#		Each front end is timed this many times and the best kept, as timings are noisy.
+#
+RUNS = 3
+
+# ***************************************************************************************
+#			Code generator which just counts, so assembly itself is timed
+# ***************************************************************************************
+
+class CountingCodeGenerator(DemoCodeGenerator):
+	def loadDirect(self,isConstant,value):
+		self.pc += 1
+	def storeDirect(self,address):
+		self.pc += 1
+	def saveAccumulator(self):
+		self.pc += 1
+	def saveIndirect(self):
+		self.pc += 1
+	def binaryOperation(self,operator,isConstant,value):
+		self.pc += 1
+	def loopStart(self,count,index):
+		self.pc += 1
+		return self.pc
+	def loopEnd(self,loop):
+		self.pc += 1
+	def allocVar(self,name = None):
+		self.pc += 2
+		return self.pc - 2
+	def loadParamRegister(self,regNumber,isConstant,value):
+		self.pc += 1
+	def storeParamRegister(self,regNumber,address):
+		self.pc += 1
+	def createStringConstant(self,string):
+		self.pc += len(string)+1
+		return self.pc-len(string)-1
+	def jumpInstruction(self,test):
+		self.pc += 1
+		return self.pc - 1
+	def setJumpAddress(self,jumpAddress,target):
+		pass
+	def callSubroutine(self,address):
+		self.pc += 1
+	def returnSubroutine(self):
+		self.pc += 1
+
+# ***************************************************************************************
+#							Generate a program of about n lines
+# ***************************************************************************************
+
+def createSource(lineCount):
+	src = []
+	procCount = 0
+	while len(src) < lineCount:
+		src.append("defproc proc{0}(a,b)\t\t// procedure {0}".format(procCount))
+		src.append("\tcount = a + b * 2 - $total")
+		src.append("\tif (count < 0) : count = 0 - count : endif")
+		src.append("\tmsg = \"Procedure {0}\"".format(procCount))
+		src.append("\twhile (count # 0)")
+		src.append("\t\t$total = $total + count ! 2")
+		src.append("\t\tcount = count - 1")
+		src.append("\tendwhile")
+		src.append("\tfor (a & 15) : $buffer ! index = index : next")
+		if procCount > 0:
+			src.append("\tproc{0}(count,42)".format(procCount-1))
+		src.append("endproc")
+		src.append("")
+		procCount += 1
+	return src
+
+# ***************************************************************************************
+#
+#		The string join/re.split front end, as it was in AssemblerWorker, kept here to
+#		time against. It takes the source as far as the terms of each command, which
+#		the assembler matched with re as it went, so both end in the same place.
+#		Identifiers are numbered rather than allocated.
+#
+# ***************************************************************************************
+
+RXIDENTIFIER = r"[\$a-z][a-z0-9\_]*"
+KEYWORDS = [ "defproc","endproc","if(","endif","while(","endwhile","for(","next" ]
+
+def referenceFrontEnd(src):
+	src = [x.replace("\t"," ").rstrip() for x in src]						# tidy up
+	src = [x if x.find("//") < 0 else x[:x.find("//")] for x in src]		# remove comments
+	strings = []
+	for l in range(0,len(src)):												# remove quoted strings
+		if src[l].find('"') >= 0:
+			parts = re.split("(\".*?\")",src[l])
+			for i in range(0,len(parts)):
+				if parts[i].startswith('"') and parts[i].endswith('"'):
+					strings.append(parts[i][1:-1])
+					parts[i] = str(len(strings))
+			src[l] = "".join(parts)
+	src = (":~:".join(src)).replace(" ","").lower()						# make one long string.
+	src = re.split("(defproc"+RXIDENTIFIER+"\\(.*?\\))",src)				# split around proc defs
+	if not src[0].startswith("defproc"):
+		del src[0]
+	commands = []
+	for i in range(0,len(src),2):
+		names = {}															# identifiers in this procedure
+		for part in src[i:i+2]:
+			parts = re.split("("+RXIDENTIFIER+"\\(?)",part)
+			rxCheck = re.compile("^("+RXIDENTIFIER+")(\\(?)$")
+			for j in range(0,len(parts)):
+				if rxCheck.match(parts[j]) and parts[j] not in KEYWORDS and not parts[j].startswith("defproc"):
+					parts[j] = "@"+str(names.setdefault(parts[j],len(names)))+("(" if parts[j].endswith("(") else "")
+			for cmd in "".join(parts).split(":"):
+				if cmd != "" and cmd != "~":
+					terms = []
+					for term in [x for x in re.split("(\\@?\\d+)",cmd) if x != ""]:
+						m = re.match("^(\\@?)(\\d+)$",term)
+						terms.append(term if m is None else (m.group(1) == "",int(m.group(2))))
+					commands.append(terms)
+	return commands
+#
+#		The tokenising front end.
+#
+def currentFrontEnd(src):
+	return list(HLALexer().tokenise(src))
+
+# ***************************************************************************************
+#				Time a front end, returns the best lines per second of RUNS
+# ***************************************************************************************
+
+def timeFrontEnd(frontEnd,src):
+	best = None
+	for run in range(0,RUNS):
+		start = time.perf_counter()
+		frontEnd(src)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best,elapsed)
+	return len(src) / best
+
+if __name__ == "__main__":
+	print("{0:>8} {1:>14} {2:>14} {3:>8}".format("lines","current l/s","reference l/s","ratio"))
+	slower = []
+	for lines in [10000,25000,50000,100000]:
+		src = createSource(lines)
+		current = timeFrontEnd(currentFrontEnd,src)
+		old = timeFrontEnd(referenceFrontEnd,src)
+		print("{0:>8} {1:>14.0f} {2:>14.0f} {3:>8.2f}".format(len(src),current,old,current/old))
+		if current < old:
+			slower.append(len(src))
+	if len(slower) > 0:
+		print("***** Slower than the string front end for {0} lines *****".format(",".join(str(n) for n in slower)))
+		sys.exit(1)
@@ -0,0 +1,135 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		lexer.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		21st January 2019
+#		Purpose :	Next High Level Assembler, lexical analyser.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import re
+
+# ***************************************************************************************
+#									Exception for Lexer
+# ***************************************************************************************
+
+class LexerException(Exception):
+	def __init__(self,message,line):
+		Exception.__init__(self,message)
+		self.message = message
+		self.line = line
+
+# ***************************************************************************************
+#
+#		The lexer converts source lines into a stream of commands. Each command is a
+#		tuple (line number,tokens) where tokens is a list of (type,value) pairs.
+#
+#			d 	defproc <name>(			value is the procedure name
+#			k 	keyword 				value is the keyword e.g. "if(" "endwhile"
+#			i 	identifier 				value is the identifier (local or $global)
+#			c 	procedure call 			value is the procedure name
+#			a 	@identifier 			value is the identifier (its address)
+#			n 	constant 				value is an integer
+#			s 	string 					value is the string text, unquoted
+#			o 	operator/punctuation 	value is the character
+#
+#		Commands are seperated by : or new line. A procedure definition header is
+#		always a command in its own right.
+#
+# ***************************************************************************************
+
+class HLALexer(object):
+	def __init__(self):
+		ident = r"[\$a-z][a-z0-9\_]*"										# identifier rx match
+		self.rxToken = re.compile(r"(defproc"+ident+r"\()|(\@"+ident+r")|("+ident+r"\(?)|(\d+)|(\"[^\"]*\")|(\:)|([\+\-\*\/\%\&\|\^\?\!\=\#\<\(\)\,])|(.)")
+		self.rxString = re.compile(r'(".*?")')								# splits strings out
+		self.keywords = "defproc,endproc,if(,endif,while(,endwhile,for(,next"
+		self.keywords = { x for x in self.keywords.split(",") if x != "" }
+		self.rxProcedure = re.compile(r"^[ \t]*d[ \t]*e[ \t]*f[ \t]*p[ \t]*r[ \t]*o[ \t]*c",re.MULTILINE|re.IGNORECASE)
+	#
+	#		Tidy up a line. Removes comments and spaces outside of quoted strings and
+	#		makes everything lower case, except the quoted strings.
+	#
+	def tidy(self,line,lineNumber = 0):
+		line = line.replace("\t"," ").rstrip()
+		if line.find('"') < 0:												# no strings, simple case.
+			if line.find("//") >= 0:
+				line = line[:line.find("//")]
+			return line.replace(" ","").lower()
+		parts = self.rxString.split(line)
+		for i in range(0,len(parts)):
+			if not parts[i].startswith('"'):								# not a string
+				if parts[i].find("//") >= 0:								# comment ends the line
+					parts = parts[:i+1]
+					parts[i] = parts[i][:parts[i].find("//")]
+				if parts[i].find('"') >= 0:									# check quotes balance
+					raise LexerException("Imbalance in quotes",lineNumber)
+				parts[i] = parts[i].replace(" ","").lower()
+				if i == len(parts)-1:
+					break
+		return "".join(parts)
+	#
+	#		Convert a source line to a list of commands.
+	#
+	def tokeniseLine(self,line,lineNumber):
+		line = self.tidy(line,lineNumber)
+		commands = []
+		tokens = []
+		inHeader = False
+		for header,address,word,number,string,seperator,punctuation,error in self.rxToken.findall(line):
+			if word:														# identifier, keyword or call
+				if word in self.keywords:
+					tokens.append(("k",word))
+				elif word[-1] == "(":
+					tokens.append(("c",word[:-1]))
+				else:
+					tokens.append(("i",word))
+			elif punctuation:												# punctuation
+				tokens.append(("o",punctuation))
+				if inHeader and punctuation == ")":							# end of procedure header
+					commands.append((lineNumber,tokens))
+					tokens = []
+					inHeader = False
+			elif number:													# integer constant
+				tokens.append(("n",int(number)))
+			elif seperator:													# command seperator
+				if tokens:
+					commands.append((lineNumber,tokens))
+					tokens = []
+			elif address:													# @identifier
+				tokens.append(("a",address[1:]))
+			elif string:													# quoted string
+				tokens.append(("s",string[1:-1]))
+			elif header:													# defproc xxxx(
+				if tokens:
+					commands.append((lineNumber,tokens))
+				tokens = [("d",header[7:-1])]
+				inHeader = True
+			else:
+				raise LexerException("Syntax Error "+error,lineNumber)
+		if tokens:
+			commands.append((lineNumber,tokens))
+		return commands
+	#
+	#		Convert a sequence of source lines to a stream of commands.
+	#
+	def tokenise(self,src,firstLine = 1):
+		lineNumber = firstLine
+		for line in src:
+			for cmd in self.tokeniseLine(line,lineNumber):
+				yield cmd
+			lineNumber += 1
+	#
+	#		Cut source text into chunks at lines starting with defproc, without tokenising
+	#		it. Returns a list of (text,first line number) pairs.
+	#
+	def chunks(self,text,firstLine = 1):
+		starts = [m.start() for m in self.rxProcedure.finditer(text) if m.start() > 0]
+		starts = [0]+starts+[len(text)]
+		chunks = []
+		for i in range(0,len(starts)-1):
+			chunks.append((text[starts[i]:starts[i+1]],firstLine))
+			firstLine += chunks[-1][0].count("\n")
+		return chunks
@@ -0,0 +1,170 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		lzpack.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		2nd February 2019
+#		Purpose :	Packs the memory image, a page at a time, for the Z80 depacker in
+#					bootloader/lzbootloader.asm
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from imagelib import *
+from z80emu import *
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		The packed data is a sequence of blocks, each starting with a control byte.
+#
+#			$00-$7F 	the next 1-128 bytes are copied (control+1)
+#			$80-$FF 	3-130 bytes (control-$80+3) are copied from offset bytes back,
+#						offset is the word that follows. An offset of zero ends it.
+#
+#		Both are a single LDIR on the Z80, so depacking is quick.
+#
+#		boot.lz is a list of pages, each a byte page number (0 for unpaged memory)
+#		and a word length of the packed data, followed by it. A length of zero means
+#		it is 16k not packed. The list ends with page $FF. Packed data is read into
+#		$4000 and depacked from there, so it must be no longer than MAXPACKED.
+#
+# ***************************************************************************************
+
+MINMATCH = 4 																# shorter isn't worth it
+MAXMATCH = 130
+MAXLITERALS = 128
+MAXPACKED = 0x3E00 															# $4000-$7DFF, stack above
+CHAINLENGTH = 16 															# matches tried at each byte
+
+#
+#		The depacker, the same as Depack in bootloader/lzbootloader.asm. HL is the
+#		packed data and DE where it goes. Jump operands are label names.
+#
+DEPACKER = [
+	("label","depack"),		("ld a,(hl)",None),		("inc hl",None),		("cp n",0x80),
+	("jr nc,e","match"),	("ld c,a",None),		("ld b,n",0),			("inc bc",None),
+	("ldir",None),			("jr e","depack"),
+	("label","match"),		("and n",0x7F),			("add a,n",3),			("ld c,a",None),
+	("ld b,n",0),			("ld a,(hl)",None),		("inc hl",None),		("push hl",None),
+	("ld h,(hl)",None),		("ld l,a",None),		("or h",None),			("jr z,e","done"),
+	("ld a,e",None),		("sub l",None),			("ld l,a",None),		("ld a,d",None),
+	("sbc a,h",None),		("ld h,a",None),		("ldir",None),			("pop hl",None),
+	("inc hl",None),		("jr e","depack"),
+	("label","done"),		("pop hl",None),		("ret",None)
+]
+
+# ***************************************************************************************
+#								Pack and unpack data
+# ***************************************************************************************
+
+def pack(data):
+	packed = bytearray()
+	chains = {}																# 3 bytes => positions
+	literal = 0 															# start of literals
+	i = 0
+	while i < len(data):
+		length,offset = 0,0
+		for p in reversed(chains.get(data[i:i+3],[])):						# most recent first
+			n = 0
+			while n < MAXMATCH and i+n < len(data) and data[p+n] == data[i+n]:
+				n += 1
+			if n > length:
+				length,offset = n,i-p
+				if n == MAXMATCH:
+					break
+		if length < MINMATCH:
+			length = 1
+		else:
+			packLiterals(packed,data[literal:i])
+			packed += bytes([0x80+length-3,offset & 0xFF,offset >> 8])
+			literal = i+length
+		for p in range(i,i+length):											# remember where these are
+			chain = chains.setdefault(data[p:p+3],[])
+			chain.append(p)
+			if len(chain) > CHAINLENGTH:
+				del chain[0]
+		i += length
+	packLiterals(packed,data[literal:])
+	packed += bytes([0x80,0,0])
+	return bytes(packed)
+
+def packLiterals(packed,literals):
+	for start in range(0,len(literals),MAXLITERALS):
+		run = literals[start:start+MAXLITERALS]
+		packed.append(len(run)-1)
+		packed += run
+
+#
+#		Unpack data, as the depacker does.
+#
+def unpack(packed):
+	data = bytearray()
+	i = 0
+	while True:
+		control = packed[i]
+		if control < 0x80:
+			data += packed[i+1:i+control+2]
+			i += control+2
+		else:
+			offset = packed[i+1]+(packed[i+2] << 8)
+			if offset == 0:
+				return bytes(data)
+			for n in range(0,control-0x80+3):								# may overlap
+				data.append(data[-offset])
+			i += 3
+
+# ***************************************************************************************
+#								The Z80 depacker
+# ***************************************************************************************
+
+#
+#		Assemble the depacker at an address, returns the bytes.
+#
+def depackerCode(address):
+	return assembleCode(DEPACKER,address)[0]
+#
+#		Depack on the emulator, returns the data and the T-states taken.
+#
+def depackZ80(packed):
+	machine = Z80Machine()
+	for address,data in [ (0x7E00,depackerCode(0x7E00)),(0x4000,packed) ]:
+		for i in range(0,len(data)):
+			machine.write(address+i,data[i])
+	machine.r[2:6] = [0x80,0x00,0x40,0x00]									# DE = $8000, HL = $4000
+	cycles = machine.call(0x7E00)
+	return bytes(machine.read(0x8000+i) for i in range(0,0x4000)),cycles
+
+# ***************************************************************************************
+#							Write a packed memory image
+# ***************************************************************************************
+
+#
+#		Write the used pages of an image packed, returns report lines, the size
+#		of each page packed and T-states to depack it.
+#
+def savePacked(image,fileName = "boot.lz",check = True):
+	report = []
+	totals = [0,0,0]
+	with open(fileName,"wb") as h:
+		for page in image.usedPages():
+			offset = image.offset(page,0x8000 if page == 0 else 0xC000)
+			data = bytes(image.view[offset:offset+0x4000])
+			packed = pack(data)
+			cycles = 0
+			if len(packed) > MAXPACKED:										# not worth it, store it
+				h.write(bytes([page,0,0]))
+				h.write(data)
+			else:
+				if check:
+					depacked,cycles = depackZ80(packed)
+					if depacked != data:
+						raise MemoryImageException("Page {0} does not depack".format(page))
+				h.write(bytes([page,len(packed) & 0xFF,len(packed) >> 8]))
+				h.write(packed)
+			size = min(len(packed),len(data))
+			report.append("page {0:<3} {1:>6} bytes packed to {2:>6} {3:>6.1f}% {4:>9} T-states".format(page,len(data),size,size*100.0/len(data),cycles))
+			totals = [totals[0]+len(data),totals[1]+size,totals[2]+cycles]
+		h.write(bytes([0xFF]))
+	report.append("total    {0:>6} bytes packed to {1:>6} {2:>6.1f}% {3:>9} T-states".format(totals[0],totals[1],totals[1]*100.0/totals[0],totals[2]))
+	return report
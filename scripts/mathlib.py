@@ -0,0 +1,124 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		mathlib.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		4th February 2019
+#		Purpose :	Runtime library of 16 bit multiply, divide and modulus routines for
+#					the Z80 and Z80N, linked into the image when they are used.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import random
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		The routines work out HL = HL op DE, unsigned, and keep BC, which has the
+#		loop count in FOR loops. A and DE are changed. Divide by zero gives $FFFF,
+#		and leaves the dividend as the remainder.
+#
+#		Each unit is a list of instructions and labels (see assembleCode in z80ir),
+#		the labels being the entry points. The Z80N multiply uses MUL D,E three
+#		times, as only the low 16 bits are kept. The Z80N has no divide, so both
+#		targets divide with the same shift and subtract loop. The loops go round
+#		8 times rather than 16 if the multiplier or dividend is less than 256.
+#
+#		RUNTIMECOSTS is the T-states for each operator as (least,average,most),
+#		which is the call and the routine, not loading DE. python mathlib.py
+#		measures these on the emulator and checks the table and the results.
+#
+# ***************************************************************************************
+
+MULTIPLYZ80 = [
+	("label","multiply"),	("push bc",None),		("ld b,h",None),		("ld c,l",None),
+	("ld hl,nn",0),			("ld a,d",None),		("or a",None),			("ld a,n",16),
+	("jr nz,e","mloop"),	("ld d,e",None),		("ld a,n",8),						# multiplier < 256
+	("label","mloop"),		("add hl,hl",None),		("sla e",None),			("rl d",None),
+	("jr nc,e","mnext"),	("add hl,bc",None),
+	("label","mnext"),		("dec a",None),			("jr nz,e","mloop"),	("pop bc",None),
+	("ret",None)
+]
+
+MULTIPLYZ80N = [
+	("label","multiply"),	("push bc",None),		("ld b,l",None),		("ld c,e",None),
+	("ld e,l",None),		("mul d,e",None),		("ld a,e",None),		("ld d,h",None),	# L*D
+	("ld e,c",None),		("mul d,e",None),		("add a,e",None),		("ld d,b",None),	# H*E
+	("ld e,c",None),		("mul d,e",None),		("add a,d",None),		("ld h,a",None),	# L*E
+	("ld l,e",None),		("pop bc",None),		("ret",None)
+]
+
+DIVIDE = [
+	("label","divide"),		("push bc",None),		("ld b,d",None),		("ld c,e",None),
+	("ex de,hl",None),		("ld hl,nn",0),			("ld a,d",None),		("or a",None),		# DE dividend, HL remainder
+	("ld a,n",16),			("jr nz,e","dloop"),	("ld d,e",None),		("ld e,n",0),		# dividend < 256
+	("ld a,n",8),
+	("label","dloop"),		("sla e",None),			("rl d",None),			("adc hl,hl",None),
+	("jr c,e","dover"),		("sbc hl,bc",None),		("jr nc,e","dbit"),		("add hl,bc",None),	# carry is clear
+	("dec a",None),			("jr nz,e","dloop"),	("jr e","ddone"),
+	("label","dover"),		("and a",None),			("sbc hl,bc",None),					# went past 16 bits
+	("label","dbit"),		("inc e",None),			("dec a",None),			("jr nz,e","dloop"),
+	("label","ddone"),		("ex de,hl",None),		("pop bc",None),		("ret",None),
+	("label","modulus"),	("call nn","divide"),	("ex de,hl",None),		("ret",None)
+]
+
+RUNTIMELIBRARY = { "z80":[MULTIPLYZ80,DIVIDE],"z80n":[MULTIPLYZ80N,DIVIDE] }
+RUNTIMEENTRIES = { "*":"multiply","/":"divide","%":"modulus" }
+
+RUNTIMECOSTS = {
+	"z80":	{ "*":(540,782,1064),"/":(799,1183,1500),"%":(830,1214,1531) },
+	"z80n":	{ "*":(120,120,120),"/":(799,1183,1500),"%":(830,1214,1531) }
+}
+
+#
+#		Get the unit with an entry point in it.
+#
+def runtimeUnit(target,entry):
+	return next(unit for unit in RUNTIMELIBRARY[target] if ("label",entry) in unit)
+
+# ***************************************************************************************
+#							Measure the routines on the emulator
+# ***************************************************************************************
+
+#
+#		Operands to time the routines with, the same each time. Half the random ones
+#		are bytes, as small values are common.
+#
+def sampleOperands(count = 200):
+	generator = random.Random(2019)
+	operand = lambda low: generator.randint(low,generator.choice([0xFF,0xFFFF]))
+	operands = [(a,b) for a in [0,1,0x8000,0xFFFF] for b in [1,3,0x8000,0xFFFF]]
+	return operands+[(operand(0),operand(1)) for i in range(0,count)]
+#
+#		Run an operator on operand pairs. Returns (least,average,most) T-states and
+#		the operand pairs which gave the wrong answer.
+#
+def measureOperator(target,operator,operands):
+	from z80emu import Z80Machine
+	machine = Z80Machine()
+	code,labels = assembleCode(runtimeUnit(target,RUNTIMEENTRIES[operator]),0x8000)
+	for i in range(0,len(code)):
+		machine.write(0x8000+i,code[i])
+	expected = { "*":lambda a,b:(a*b) & 0xFFFF,"/":lambda a,b:a // b,"%":lambda a,b:a % b }[operator]
+	cycles = []
+	wrong = []
+	for a,b in operands:
+		machine.r[2:6] = [b >> 8,b & 0xFF,a >> 8,a & 0xFF]					# DE and HL
+		cycles.append(instructionTime([("call nn",None)])+machine.call(labels[RUNTIMEENTRIES[operator]]))
+		if (machine.r[4] << 8)+machine.r[5] != expected(a,b):
+			wrong.append((a,b))
+	return (min(cycles),(sum(cycles)+len(cycles)//2)//len(cycles),max(cycles)),wrong
+
+if __name__ == "__main__":
+	operands = sampleOperands()
+	print("{0:<6} {1:<9} {2:>6} {3:>8} {4:>6} {5:>6}".format("target","operator","least","average","most","bytes"))
+	for target in sorted(RUNTIMELIBRARY.keys()):
+		for operator in ["*","/","%"]:
+			costs,wrong = measureOperator(target,operator,operands)
+			size = len(assembleCode(runtimeUnit(target,RUNTIMEENTRIES[operator]),0x8000)[0])
+			print("{0:<6} {1:<9} {2:>6} {3:>8} {4:>6} {5:>6}".format(target,operator,costs[0],costs[1],costs[2],size))
+			if costs != RUNTIMECOSTS[target][operator]:
+				print("Mismatch, RUNTIMECOSTS has",RUNTIMECOSTS[target][operator])
+			for a,b in wrong:
+				print("Wrong result ${0:04x} {1} ${2:04x}".format(a,operator,b))
@@ -0,0 +1,160 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		memlib.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		6th February 2019
+#		Purpose :	Runtime library of block memory routines, copy fill and compare,
+#					for the Z80 and Z80N, linked into the image when they are used.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import random
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		The routines take HL, DE and BC, as the parameters of a call would be, and
+#		change all the registers but IX. They are one unit, as they share copyup.
+#
+#			copy 		BC bytes from HL to DE, which can overlap (LDIR or LDDR)
+#			copyup 		BC bytes from HL to DE upwards, as LDIR does
+#			copywords	BC bytes from HL to DE upwards a word at a time, as a loop
+#						of ! does, which is copyup unless DE is HL+1
+#			fill 		BC bytes at HL with E
+#			fillwords 	BC bytes at HL with the word DE
+#			compare 	BC bytes at HL and DE, HL is 0 if they are the same, else
+#						the bytes left from the first difference
+#
+#		Fills store the first byte or word, then copy it up over the rest. On the
+#		Z80N copyup programs the zxnDMA for DMASIZE bytes or more, as the program
+#		takes longer to send than LDIR takes for a few bytes. The DMA copies a byte
+#		at a time upwards, as LDIR does.
+#
+#		Copies and fills of up to UNROLLSIZE bytes which are known to go upwards are
+#		unrolled by the code generator instead.
+#
+#		python memlib.py checks the routines on the emulator, against Python, and
+#		prints the T-states for some lengths.
+#
+# ***************************************************************************************
+
+UNROLLSIZE = 8
+DMASIZE = 32
+
+COMMON = [
+	("label","copy"),		("ld a,b",None),		("or c",None),			("ret z",None),
+	("push hl",None),		("and a",None),			("sbc hl,de",None),		("pop hl",None),	# HL >= DE, upwards
+	("jp nc,nn","copyup"),	("add hl,bc",None),		("dec hl",None),		("ex de,hl",None),	# else from the end
+	("add hl,bc",None),		("dec hl",None),		("ex de,hl",None),		("lddr",None),
+	("ret",None),
+	("label","copywords"),	("ld a,b",None),		("or c",None),			("ret z",None),
+	("push de",None),		("ex de,hl",None),		("scf",None),			("sbc hl,de",None),	# DE-HL-1
+	("ex de,hl",None),		("ld a,d",None),		("or e",None),			("pop de",None),
+	("jp nz,nn","copyup"),
+	("label","wloop"),		("push bc",None),		("ld c,(hl)",None),		("inc hl",None),	# DE is HL+1, words
+	("ld b,(hl)",None),		("inc hl",None),		("ex de,hl",None),		("ld (hl),c",None),
+	("inc hl",None),		("ld (hl),b",None),		("inc hl",None),		("ex de,hl",None),
+	("pop bc",None),		("dec bc",None),		("dec bc",None),		("ld a,b",None),
+	("or c",None),			("jr nz,e","wloop"),	("ret",None),
+	("label","fill"),		("ld a,b",None),		("or c",None),			("ret z",None),
+	("ld (hl),e",None),		("dec bc",None),		("ld d,h",None),		("ld e,l",None),
+	("inc de",None),		("jp nn","copyup"),
+	("label","fillwords"),	("ld a,b",None),		("or c",None),			("ret z",None),
+	("ld (hl),e",None),		("inc hl",None),		("ld (hl),d",None),		("dec hl",None),
+	("dec bc",None),		("dec bc",None),		("ld d,h",None),		("ld e,l",None),
+	("inc de",None),		("inc de",None),		("jp nn","copyup"),
+	("label","compare"),	("ld a,b",None),		("or c",None),			("jr z,e","csame"),
+	("label","cloop"),		("ld a,(de)",None),		("inc de",None),		("cpi",None),
+	("jr nz,e","cdiff"),	("jp pe,nn","cloop"),
+	("label","csame"),		("ld hl,nn",0),			("ret",None),
+	("label","cdiff"),		("ld h,b",None),		("ld l,c",None),		("inc hl",None),
+	("ret",None)
+]
+
+COPYUPZ80 = [
+	("label","copyup"),		("ld a,b",None),		("or c",None),			("ret z",None),
+	("ldir",None),			("ret",None)
+]
+
+COPYUPZ80N = [
+	("label","copyup"),		("ld a,b",None),		("or a",None),			("jr nz,e","dma"),
+	("or c",None),			("ret z",None),			("cp n",DMASIZE),		("jr nc,e","dma"),
+	("ldir",None),			("ret",None),
+	("label","dma"),		("ld (nn),hl","dmasource"),("ld (nn),de","dmatarget"),("ld (nn),bc","dmalength"),
+	("ld hl,nn","dmaprogram"),("ld bc,nn",(16 << 8)+0x6B),("otir",None),	("ret",None),
+	("label","dmaprogram"),	("db",0x83),											# disable
+	("db",0x7D),																		# WR0 A to B, A address, length
+	("label","dmasource"),	("dw",0),
+	("label","dmalength"),	("dw",0),
+	("db",0x54),			("db",0x02),			("db",0x50),			("db",0x02),		# A, B memory, up, 2 cycles
+	("db",0xAD),																		# WR4 continuous, B address
+	("label","dmatarget"),	("dw",0),
+	("db",0x82),			("db",0xCF),			("db",0x87)									# stop at end, load, enable
+]
+
+MEMORYLIBRARY = { "z80":COMMON+COPYUPZ80,"z80n":COMMON+COPYUPZ80N }
+MEMORYENTRIES = [ "copy","copyup","copywords","fill","fillwords","compare" ]
+
+# ***************************************************************************************
+#							Check the routines on the emulator
+# ***************************************************************************************
+
+#
+#		What each routine should do to memory, a bytearray, and what HL should be.
+#
+def expectedResult(entry,memory,hl,de,bc):
+	if entry == "copy":
+		memory[de:de+bc] = memory[hl:hl+bc]
+	elif entry == "copyup" or entry == "copywords":
+		size = 2 if entry == "copywords" else 1
+		for i in range(0,bc,size):
+			memory[de+i:de+i+size] = memory[hl+i:hl+i+size]
+	elif entry == "fill":
+		memory[hl:hl+bc] = bytes([de & 0xFF]) * bc
+	elif entry == "fillwords":
+		memory[hl:hl+bc] = bytes([de & 0xFF,de >> 8]) * (bc // 2)
+	else:
+		different = [i for i in range(0,bc) if memory[hl+i] != memory[de+i]]
+		return bc - different[0] if len(different) > 0 else 0
+	return None
+#
+#		Run each routine on random blocks, which overlap some of the time. Returns
+#		wrong answers, and T-states by entry and length.
+#
+def checkRoutines(target,count = 300):
+	from z80emu import Z80Machine
+	machine = Z80Machine()
+	code,labels = assembleCode(MEMORYLIBRARY[target],0x8000)
+	for i in range(0,len(code)):
+		machine.write(0x8000+i,code[i])
+	generator = random.Random(2019)
+	wrong = []
+	cycles = {}
+	for n in range(0,count):
+		entry = MEMORYENTRIES[n % len(MEMORYENTRIES)]
+		size = generator.choice([0,1,2,UNROLLSIZE,DMASIZE-2,DMASIZE,300])
+		size = size & 0xFFFE if entry.endswith("words") else size
+		hl = 0x9000+generator.randint(0,512)
+		de = hl+generator.choice([-2,-1,0,1,2,3,size])+generator.choice([0,0,1024]) if entry.startswith("co") else generator.randint(0,0xFFFF)
+		memory = bytearray(generator.randint(0,255) for i in range(0,0x10000))
+		memory[0x8000:0x8000+len(code)] = code
+		for address in range(0x8800,0xA000):
+			machine.write(address,memory[address])
+		machine.r[0:6] = [size >> 8,size & 0xFF,de >> 8,de & 0xFF,hl >> 8,hl & 0xFF]
+		cycles[(entry,size)] = instructionTime([("call nn",None)])+machine.call(labels[entry])
+		result = expectedResult(entry,memory,hl,de,size)
+		if any(machine.read(a) != memory[a] for a in range(0x8800,0xA000)) or \
+					(result is not None and (machine.r[4] << 8)+machine.r[5] != result):
+			wrong.append((entry,hl,de,size))
+	return wrong,cycles
+
+if __name__ == "__main__":
+	for target in sorted(MEMORYLIBRARY.keys()):
+		wrong,cycles = checkRoutines(target)
+		print("{0:<6} {1} bytes".format(target,len(assembleCode(MEMORYLIBRARY[target],0x8000)[0])))
+		for entry in MEMORYENTRIES:
+			print("       {0:<10}".format(entry)+" ".join("{0}:{1}".format(size,cycles[(e,size)]) for e,size in sorted(cycles.keys()) if e == entry))
+		for entry,hl,de,size in wrong:
+			print("Wrong result {0} ${1:04x} ${2:04x} {3}".format(entry,hl,de,size))
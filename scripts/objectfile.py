@@ -0,0 +1,167 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		objectfile.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		3rd February 2019
+#		Purpose :	Relocatable object files, a cache of them by source, and a linker
+#					which combines them.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import hashlib,os,pickle,sys
+from assembler import *
+from inliner import *
+from parallel import *
+from recordcodegen import *
+
+# ***************************************************************************************
+#
+#		An object module is the recordings of its procedures (see recordcodegen.py),
+#		which do not depend on the code generator. Anything not known until linking
+#		is symbolic in the recordings: ("global",name) for globals, ("proc",name) for
+#		procedures and ("label",n) inside procedures, so the references to these are
+#		the relocations. A module exports its procedures and $globals, and imports
+#		the procedures it calls but doesn't define.
+#
+#		An object file is OBJECTMAGIC followed by the pickled module. OBJECTVERSION
+#		must change when the recordings made from source would, as it is part of the
+#		cache key.
+#
+# ***************************************************************************************
+
+OBJECTMAGIC = b"HLO\x01"
+OBJECTVERSION = 4
+
+class ObjectModule(object):
+	def __init__(self,name,procs,loops):
+		self.name = name 													# source it came from
+		self.procs = procs 													# [name,ops,entry,globals,calls]
+		self.loops = loops 													# name => (first,last) of its loops
+		self.exports = [p[0] for p in procs]
+		self.globals = sorted({ g for p in procs for g in p[3] })
+		self.imports = sorted({ callee for p in procs for line,callee in p[4] } - set(self.exports))
+	#
+	#		The symbolic references in the recordings, as (procedure,symbol).
+	#
+	def relocations(self):
+		return [(p[0],value) for p in self.procs for op in p[1] for value in op[1:] \
+											if type(value) == tuple and value[0] != "label"]
+	#
+	#		Describe the module, as text lines.
+	#
+	def describe(self):
+		return [ "module     "+self.name,
+				 "exports    "+" ".join(name+"()" for name in self.exports),
+				 "imports    "+" ".join(name+"()" for name in self.imports),
+				 "globals    "+" ".join(self.globals),
+				 "relocations {0}".format(len(self.relocations())) ]
+
+# ***************************************************************************************
+#						Create, write and read object modules
+# ***************************************************************************************
+
+#
+#		Assemble source lines into an object module.
+#
+def compileModule(src,name = "-",firstLine = 1):
+	worker = RelocatableAssemblerWorker()
+	procs = []
+	loops = {}
+	for header,body in worker.procedures(src,firstLine):
+		first = len(worker.loopLines)
+		procs.append(worker.assembleRelocatable(header,body))
+		loops[procs[-1][0]] = worker.loopLines[first:]
+	return ObjectModule(name,procs,loops)
+#
+#		Assemble a source file into an object module, "-" is standard input.
+#
+def compileFile(fileName):
+	if fileName == "-":
+		return compileModule(sys.stdin,fileName)
+	with open(fileName) as h:
+		return compileModule(h,fileName)
+#
+def saveObject(module,fileName):
+	with open(fileName,"wb") as h:
+		h.write(OBJECTMAGIC)
+		pickle.dump(module,h)
+#
+def loadObject(fileName):
+	with open(fileName,"rb") as h:
+		if h.read(len(OBJECTMAGIC)) != OBJECTMAGIC:
+			raise AssemblerException("Not an object file "+fileName)
+		return pickle.load(h)
+
+# ***************************************************************************************
+#
+#		Cache of object modules, keyed on a hash of the source text, so only
+#		source which has changed is assembled.
+#
+# ***************************************************************************************
+
+class ObjectCache(object):
+	def __init__(self,directory):
+		self.directory = directory
+		self.hits = self.misses = 0
+		os.makedirs(directory,exist_ok = True)
+	#
+	#		Get the object module for a source file.
+	#
+	def module(self,fileName):
+		with open(fileName) as h:
+			text = h.read()
+		key = hashlib.sha1("{0}:{1}".format(OBJECTVERSION,text).encode()).hexdigest()
+		objectFile = os.path.join(self.directory,key+".hlo")
+		if os.path.exists(objectFile):
+			self.hits += 1
+			module = loadObject(objectFile)
+			module.name = fileName
+			return module
+		self.misses += 1
+		module = compileModule(text.split("\n"),fileName)
+		saveObject(module,objectFile)
+		return module
+
+# ***************************************************************************************
+#
+#		Links object modules, in the order given, into a code generator. Modules
+#		can only call procedures in earlier modules, as procedures in a module can
+#		only call earlier ones. Procedures can be inlined (see inliner.py).
+#
+# ***************************************************************************************
+
+class ObjectLinker(object):
+	def __init__(self,codeGen,inline = False):
+		self.codeGen = codeGen
+		self.inline = inline
+		self.modules = []
+		self.globals = {}
+		self.loopLines = []													# (first,last) lines of loops
+		self.inlined = {}													# procedure => [sites,T-states saved]
+		self.removed = ([],[])												# procedures,globals removed
+	#
+	def addModule(self,module):
+		self.modules.append(module)
+	#
+	def assembleFile(self,fileName):
+		self.addModule(compileFile(fileName))
+	#
+	def link(self):
+		exported = {}
+		for module in self.modules:											# each procedure defined once
+			for name in module.exports:
+				if name in exported:
+					raise AssemblerException("Procedure "+name+"( in both "+exported[name]+" and "+module.name)
+				exported[name] = module.name
+		procs = [p for m in self.modules for p in m.procs]
+		if self.inline:
+			procs,self.inlined = inlineProcedures(procs,{ name:m.loops[name] for m in self.modules for name in m.loops.keys() })
+		self.globals,self.removed = linkRecordings(procs,self.codeGen)
+		self.loopLines = [loop for m in self.modules for p in m.procs if p[0] not in self.removed[0] for loop in m.loops[p[0]]]
+
+if __name__ == "__main__":
+	for fileName in sys.argv[1:]:
+		for line in loadObject(fileName).describe():
+			print(line)
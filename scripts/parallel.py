@@ -0,0 +1,239 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		parallel.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		24th January 2019
+#		Purpose :	Assembles procedures in parallel on a process pool, then links
+#					them together.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import multiprocessing,sys,time
+from assembler import *
+from democodegen import *
+from recordcodegen import *
+
+# ***************************************************************************************
+#
+#		Procedures are assembled independently into recordings (see recordcodegen.py)
+#		which are relocatable: globals are ("global",name), procedures ("proc",name)
+#		and everything inside the procedure is a label. Each worker also returns the
+#		symbols the procedure defines and uses. The link step allocates the globals,
+#		checks the calls, and plays the recordings back into the real code generator
+#		in source order, resolving the symbols as it goes.
+#
+#		There is no separate pass collecting the symbols first. The recordings are
+#		symbolic, so the workers don't need them, and they are found from the tokens
+#		the workers make anyway. So a call to an unknown procedure is only reported
+#		when linking. The pool only pays for itself with several CPUs and a large
+#		program; with one CPU more processes are slower.
+#
+# ***************************************************************************************
+
+class RelocatableAssemblerWorker(AssemblerWorker):
+	def __init__(self):
+		AssemblerWorker.__init__(self,None)
+	#
+	#		Assemble a procedure, returns (name,ops,entry label,globals used,calls made)
+	#
+	def assembleRelocatable(self,header,body):
+		self.codeGen = RecordingCodeGenerator(lambda: AssemblerException.LINE)
+		self.globals = {}
+		self.globalsUsed = []
+		self.calls = []
+		self.assembleProcedure(header,body)
+		name = header[1][0][1]
+		return (name,self.codeGen.ops,self.globals[name+"("],self.globalsUsed,self.calls)
+	#
+	#		Globals and procedures become symbols, as their addresses are not known yet.
+	#
+	def processTerms(self,tokens):
+		for i in range(0,len(tokens)):
+			kind,value = tokens[i]
+			if (kind == "i" or kind == "a") and value.startswith("$"):		# global variable
+				if value not in self.globals:
+					self.globals[value] = ("global",value)
+					self.globalsUsed.append(value)
+				tokens[i] = ("v" if kind == "i" else "n",self.globals[value])
+			elif kind == "c" and value not in self.blockOperations:			# procedure call
+				self.calls.append((AssemblerException.LINE,value))
+				tokens[i] = ("p",("proc",value))
+		AssemblerWorker.processTerms(self,tokens)
+	#
+	#		Locals are allocated when the procedures are linked, so they can be overlaid.
+	#
+	def allocLocal(self,name):
+		return self.codeGen.allocVar(name)
+	#
+	#		List symbols by name, and labels as Ln, rather than as tuples.
+	#
+	def commandText(self,cmd):
+		return AssemblerWorker.commandText(self,[(kind,self.symbolText(value)) for kind,value in cmd])
+	#
+	def symbolText(self,value):
+		if type(value) != tuple:
+			return value
+		return "L{0}".format(value[1]) if value[0] == "label" else value[1]
+
+# ***************************************************************************************
+#				Worker process, assembles one chunk of source text
+# ***************************************************************************************
+
+def assembleChunk(chunk):
+	text,firstLine = chunk
+	worker = RelocatableAssemblerWorker()
+	procs = []
+	try:
+		for header,body in worker.procedures(text.split("\n"),firstLine):
+			procs.append(worker.assembleRelocatable(header,body))
+	except AssemblerException as e:											# exceptions go back as data
+		return ("error",e.message,AssemblerException.LINE)
+	return ("ok",procs)
+
+# ***************************************************************************************
+#								Parallel Assembler
+# ***************************************************************************************
+
+class ParallelAssembler(object):
+	def __init__(self,codeGen,processes = None):
+		self.codeGen = codeGen
+		self.processes = processes if processes is not None else multiprocessing.cpu_count()
+		self.lexer = HLALexer()
+		self.globals = {}
+		self.removed = ([],[])												# procedures,globals removed
+	#
+	#		Assemble source text, or a list of lines.
+	#
+	def assemble(self,src):
+		text = src if type(src) == str else "\n".join(src)
+		chunks = self.lexer.chunks(text)
+		if self.processes > 1:
+			with multiprocessing.Pool(self.processes) as pool:
+				results = pool.map(assembleChunk,chunks,chunksize = max(1,len(chunks) // (self.processes * 4)))
+		else:
+			results = [assembleChunk(c) for c in chunks]
+		procs = []
+		for r in results:
+			if r[0] == "error":												# report the first error
+				AssemblerException.LINE = r[2]
+				raise AssemblerException(r[1])
+			procs += r[1]
+		self.link(procs)
+	#
+	#		Link the procedures together.
+	#
+	def link(self,procs):
+		globals,self.removed = linkRecordings(procs,self.codeGen)
+		self.globals.update(globals)
+
+# ***************************************************************************************
+#
+#		Link recorded procedures, (name,ops,entry,globals used,calls), into a code
+#		generator. The calls are checked, and procedures the _boot procedures never
+#		reach are left out, unless removeUnused is False. Globals are allocated
+#		first, and the strings are pooled, then the procedures are played back in
+#		order, with their locals overlaid (see FrameAllocator). Returns the globals
+#		and procedures, with their addresses, and the procedures and globals removed.
+#
+# ***************************************************************************************
+
+def linkRecordings(procs,codeGen,removeUnused = True):
+	checkCalls(procs)
+	removed = ([],[])
+	if removeUnused:
+		procs,removed = removeUnreachable(procs)
+	symbols = {}
+	globals = {}
+	for name,ops,entry,globalsUsed,calls in procs:							# allocate all globals first
+		for g in globalsUsed:
+			if ("global",g) not in symbols:
+				symbols[("global",g)] = codeGen.allocVar(g)
+				globals[g] = symbols[("global",g)]
+	codeGen.poolStrings(recordedStrings(procs))
+	frames = FrameAllocator(codeGen.allocVar)
+	for name,ops,entry,globalsUsed,calls in procs:
+		frames.startFrame([callName for line,callName in calls])
+		labels = playBack(ops,codeGen,symbols,frames.allocate)
+		frames.endFrame(name)
+		symbols[("proc",name)] = labels[entry]
+		globals[name+"("] = labels[entry]
+	return globals,removed
+#
+#		Check procedures only call procedures defined before them.
+#
+def checkCalls(procs):
+	known = set()
+	for name,ops,entry,globalsUsed,calls in procs:
+		for line,callName in calls:
+			if callName not in known:
+				unknownCall(procs,name,callName,line)
+		known.add(name)
+#
+#		Remove the procedures which can't be reached from the _boot procedures,
+#		which are the program, and globals only they use. Their strings go too,
+#		as they are in the recordings. If there are no _boot procedures nothing is
+#		removed. Returns the procedures kept, and the names of the procedures and
+#		globals removed.
+#
+def removeUnreachable(procs):
+	calls = { name:[callee for line,callee in procCalls] for name,ops,entry,globalsUsed,procCalls in procs }
+	toVisit = [name for name in calls.keys() if name.endswith("_boot")]
+	if len(toVisit) == 0:
+		return procs,([],[])
+	reached = set()
+	while len(toVisit) > 0:
+		name = toVisit.pop()
+		if name not in reached:
+			reached.add(name)
+			toVisit += calls[name]
+	kept = [p for p in procs if p[0] in reached]
+	allGlobals = [g for p in procs for g in p[3]]
+	usedGlobals = { g for p in kept for g in p[3] }
+	removed = ([p[0] for p in procs if p[0] not in reached],
+				[g for i,g in enumerate(allGlobals) if g not in usedGlobals and g not in allGlobals[:i]])
+	return kept,removed
+#
+#		Report what was removed, as a list of text lines.
+#
+def removedReport(removed):
+	lines = []
+	if len(removed[0]) > 0:
+		lines.append("removed procedure(s) "+" ".join(name+"()" for name in removed[0]))
+	if len(removed[1]) > 0:
+		lines.append("removed global(s) "+" ".join(removed[1]))
+	return lines
+#
+#		Report a call to a procedure not defined before the caller. If the callee
+#		calls back to the caller it is recursion, otherwise it is unknown.
+#
+def unknownCall(procs,caller,callee,line):
+	calls = { p[0]:[c for l,c in p[4]] for p in procs }
+	paths = [[callee]]
+	visited = set()
+	while len(paths) > 0:													# look for a way back
+		path = paths.pop(0)
+		if path[-1] == caller:
+			AssemblerException.LINE = line
+			raise AssemblerException("Recursive call "+" -> ".join(n+"(" for n in [caller]+path))
+		if path[-1] not in visited:
+			visited.add(path[-1])
+			paths += [path+[c] for c in calls.get(path[-1],[])]
+	AssemblerException.LINE = line
+	raise AssemblerException("Unknown identifier "+callee+"(")
+
+#
+#		The strings used by recorded procedures, in order.
+#
+def recordedStrings(procs):
+	return [op[2] for p in procs for op in p[1] if op[0] == "createStringConstant"]
+
+if __name__ == "__main__":
+	import lexbench
+	src = "\n".join(lexbench.createSource(int(sys.argv[1]) if len(sys.argv) > 1 else 100000))
+	for processes in sorted({1,2,4,multiprocessing.cpu_count()}):
+		pa = ParallelAssembler(lexbench.CountingCodeGenerator(),processes)
+		start = time.perf_counter()
+		pa.assemble(src)
+		print("{0:>3} processes {1:>8.2f}s".format(processes,time.perf_counter()-start))
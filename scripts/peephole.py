@@ -0,0 +1,143 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		peephole.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		26th January 2019
+#		Purpose :	Peephole optimiser for generated Z80 code.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		Instructions are held here until something needs to know the address, then
+#		the code generator takes them. Every time an instruction arrives the rules
+#		are tried on the end of the pending instructions. A rule is a name, a
+#		pattern of mnemonics (alternatives seperated by |), a test on the matched
+#		instructions, and a function giving the replacement instructions. Labels
+#		and jumps are held here too, rules never match across them.
+#
+#		Flags from arithmetic are never used, tests are always done on HL, so rules
+#		do not have to preserve them.
+#
+# ***************************************************************************************
+
+class PeepholeOptimiser(object):
+	def __init__(self,enabled = True,currentLine = None):
+		self.enabled = enabled
+		self.currentLine = currentLine if currentLine is not None else lambda: None
+		self.pending = []
+		self.lines = []														# source line of each pending item
+		self.statistics = {}												# rule => [count,bytes,tstates]
+		loadHL = "ld hl,nn|ld hl,(nn)"
+		self.addRules([
+			[ "store then load",["ld (nn),hl","ld hl,(nn)"],
+					lambda i: i[0][1] == i[1][1],lambda i: [i[0]] ],
+			[ "load then store",["ld hl,(nn)","ld (nn),hl"],
+					lambda i: i[0][1] == i[1][1],lambda i: [i[0]] ],
+			[ "dead load",[loadHL,loadHL],
+					lambda i: True,lambda i: [i[1]] ],
+			[ "push then pop",["push hl","pop hl"],
+					lambda i: True,lambda i: [] ],
+		]+self.operandRules("bc")+self.operandRules("de"))
+	#
+	#		Rules for constants loaded into the operand register, which is BC, or DE
+	#		inside FOR loops.
+	#
+	def operandRules(self,reg):
+		load,add,subtract = "ld "+reg+",nn","add hl,"+reg,"sbc hl,"+reg
+		return [
+			[ "add zero",[load,add],
+					lambda i: i[0][1] & 0xFFFF == 0,lambda i: [] ],
+			[ "subtract zero",[load,"xor a",subtract],
+					lambda i: i[0][1] & 0xFFFF == 0,lambda i: [] ],
+			[ "add small constant",[load,add],
+					lambda i: self.smallConstant(i[0][1]) is not None,lambda i: self.incDec(i[0][1]) ],
+			[ "subtract small constant",[load,"xor a",subtract],
+					lambda i: self.smallConstant(-i[0][1]) is not None,lambda i: self.incDec(-i[0][1]) ],
+			[ "subtract constant",[load,"xor a",subtract],
+					lambda i: True,lambda i: [(load,(-i[0][1]) & 0xFFFF),(add,None)] ],
+		]
+	#
+	#		Add rules, indexed by the last mnemonic in the pattern.
+	#
+	def addRules(self,rules):
+		self.rules = {}
+		for name,pattern,test,replace in rules:
+			pattern = [set(p.split("|")) for p in pattern]
+			for last in pattern[-1]:
+				if last not in self.rules:
+					self.rules[last] = []
+				self.rules[last].append((name,pattern,test,replace))
+	#
+	#		Constants that are better done with inc hl/dec hl, returns count or None
+	#
+	def smallConstant(self,value):
+		value = value & 0xFFFF
+		return value if value <= 2 else (value - 0x10000 if value >= 0xFFFE else None)
+	#
+	def incDec(self,value):
+		count = self.smallConstant(value)
+		return [("inc hl" if count > 0 else "dec hl",None)] * abs(count)
+	#
+	#		Add an instruction
+	#
+	def emit(self,mnemonic,operand = None):
+		self.pending.append((mnemonic,operand))
+		self.lines.append(self.currentLine())
+		if self.enabled:
+			while self.optimise():
+				pass
+	#
+	#		Try the rules against the end of the pending list. Returns True if one
+	#		was applied.
+	#
+	def optimise(self):
+		if len(self.pending) == 0 or self.pending[-1][0] not in self.rules:
+			return False
+		for name,pattern,test,replace in self.rules[self.pending[-1][0]]:
+			size = len(pattern)
+			if len(self.pending) >= size:
+				matched = self.pending[-size:]
+				if all(matched[i][0] in pattern[i] for i in range(0,size)) and test(matched):
+					replacement = replace(matched)
+					self.pending[-size:] = replacement
+					self.lines[-size:] = self.lines[-1:] * len(replacement)	# belongs to the latest line
+					self.record(name,instructionSize(matched) - instructionSize(replacement),
+									 instructionTime(matched) - instructionTime(replacement))
+					return True
+		return False
+	#
+	#		Add a label or jump, which rules do not match.
+	#
+	def add(self,item):
+		self.pending.append(item)
+		self.lines.append(self.currentLine())
+	#
+	#		Take all the pending instructions, and the lines they came from.
+	#
+	def take(self):
+		pending,lines = self.pending,self.lines
+		self.pending,self.lines = [],[]
+		return pending,lines
+	#
+	#		Record a saving, made here or elsewhere.
+	#
+	def record(self,name,byteCount,tStates):
+		if name not in self.statistics:
+			self.statistics[name] = [0,0,0]
+		self.statistics[name][0] += 1
+		self.statistics[name][1] += byteCount
+		self.statistics[name][2] += tStates
+	#
+	#		Report on what the rules have saved.
+	#
+	def report(self):
+		report = []
+		for name in sorted(self.statistics.keys()):
+			count,byteCount,tStates = self.statistics[name]
+			report.append("{0:<24} {1:>6} times {2:>7} bytes {3:>8} T-states".format(name,count,byteCount,tStates))
+		return report
@@ -0,0 +1,186 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		recordcodegen.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		24th January 2019
+#		Purpose :	Code generator which records calls, to be played back later into
+#					a real code generator.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from assembler import *
+
+# ***************************************************************************************
+#
+#		Addresses are not known while recording, so the recorder hands out labels,
+#		("label",n), instead. Other symbolic addresses, such as ("global",name) or
+#		("proc",name), can be used as values and are resolved on playback from a
+#		symbol table. The recording is a list of tuples, (method,parameters ...),
+#		which pickles, so it can be created in another process. If currentLine is
+#		given, ("line",n) is recorded when the source line changes, and playing it
+#		back sets AssemblerException.LINE, so code is listed against its line.
+#
+# ***************************************************************************************
+
+class RecordingCodeGenerator(object):
+	def __init__(self,currentLine = None):
+		self.ops = []
+		self.labelCount = 0
+		self.currentLine = currentLine 										# gets the source line
+		self.line = None
+	#
+	#		Record an operation, and the source line if it has changed.
+	#
+	def record(self,op):
+		if self.currentLine is not None and self.currentLine() != self.line:
+			self.line = self.currentLine()
+			self.ops.append(("line",self.line))
+		self.ops.append(op)
+	#
+	#		Create a new label
+	#
+	def newLabel(self):
+		self.labelCount += 1
+		return ("label",self.labelCount)
+	#
+	#		Get current address
+	#
+	def getAddress(self):
+		label = self.newLabel()
+		self.record(("getAddress",label))
+		return label
+	#
+	#		Get word size
+	#
+	def getWordSize(self):
+		return 2
+	#
+	#		Load a constant or variable into the accumulator.
+	#
+	def loadDirect(self,isConstant,value):
+		self.record(("loadDirect",isConstant,value))
+	#
+	#		store A to an address
+	#
+	def storeDirect(self,address):
+		self.record(("storeDirect",address))
+	#
+	#		save A temporarily for writing later
+	#
+	def saveAccumulator(self):
+		self.record(("saveAccumulator",))
+	#
+	#		save value saved by 'save Accumulator' at address A.
+	#
+	def saveIndirect(self):
+		self.record(("saveIndirect",))
+	#
+	#		Do a binary operation on a constant or variable on the accumulator
+	#
+	def binaryOperation(self,operator,isConstant,value):
+		self.record(("binaryOperation",operator,isConstant,value))
+	#
+	#		Start and end a FOR loop, the loop is a label.
+	#
+	def loopStart(self,count,index):
+		label = self.newLabel()
+		self.record(("loopStart",label,count,index))
+		return label
+	#
+	def loopEnd(self,loop):
+		self.record(("loopEnd",loop))
+	#
+	#		Allocate a variable
+	#
+	def allocVar(self,name = None):
+		label = self.newLabel()
+		self.record(("allocVar",label,name))
+		return label
+	#
+	#		Load parameter constant/variable to a temporary area,
+	#
+	def loadParamRegister(self,regNumber,isConstant,value):
+		self.record(("loadParamRegister",regNumber,isConstant,value))
+	#
+	#		Copy parameter to an actual variable
+	#
+	def storeParamRegister(self,regNumber,address):
+		self.record(("storeParamRegister",regNumber,address))
+	#
+	#		Copy a parameter register to the accumulator
+	#
+	def copyParamRegister(self,regNumber):
+		self.record(("copyParamRegister",regNumber))
+	#
+	#		Create a string constant
+	#
+	def createStringConstant(self,string):
+		label = self.newLabel()
+		self.record(("createStringConstant",label,string))
+		return label
+	#
+	#		Compile a jump instruction, the patch address is a label.
+	#
+	def jumpInstruction(self,test):
+		label = self.newLabel()
+		self.record(("jumpInstruction",label,test))
+		return label
+	#
+	#		Set Jump Address for a jump already compiled.
+	#
+	def setJumpAddress(self,jumpAddress,target):
+		self.record(("setJumpAddress",jumpAddress,target))
+	#
+	#		Call a subroutine
+	#
+	def callSubroutine(self,address):
+		self.record(("callSubroutine",address))
+	#
+	#		Jump to a subroutine, which returns for this one.
+	#
+	def tailCall(self,address):
+		self.record(("tailCall",address))
+	#
+	#		Block copy, fill and compare.
+	#
+	def copyMemory(self,count,kind):
+		self.record(("copyMemory",count,kind))
+	#
+	def fillMemory(self,count,words):
+		self.record(("fillMemory",count,words))
+	#
+	def compareMemory(self,count):
+		self.record(("compareMemory",count))
+	#
+	#		Return from subroutine.
+	#
+	def returnSubroutine(self):
+		self.record(("returnSubroutine",))
+
+# ***************************************************************************************
+#
+#		Play a recording back into a code generator. Symbols maps symbolic addresses
+#		onto real ones. Returns the label table.
+#
+# ***************************************************************************************
+
+def playBack(ops,codeGen,symbols,allocVar = None):
+	labels = {}
+	returnsAddress = { "getAddress","allocVar","createStringConstant","jumpInstruction","loopStart" }
+	def resolve(value):
+		if type(value) != tuple:											# not symbolic
+			return value
+		return labels[value] if value[0] == "label" else symbols[value]
+	for op in ops:
+		method = op[0]
+		if method == "line":
+			AssemblerException.LINE = op[1]
+		elif method == "allocVar" and allocVar is not None:					# locals allocated elsewhere
+			labels[op[1]] = allocVar(op[2])
+		elif method in returnsAddress:
+			labels[op[1]] = getattr(codeGen,method)(*[resolve(p) for p in op[2:]])	# these return an address
+		else:
+			getattr(codeGen,method)(*[resolve(p) for p in op[1:]])
+	return labels
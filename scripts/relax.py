@@ -0,0 +1,164 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		relax.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		27th January 2019
+#		Purpose :	Lays out code containing jumps, choosing JR or JP.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		Code is a list of instructions (mnemonic,operand), labels ("label",handle)
+#		and jumps ["jump",condition,target,handle]. Condition is "z","nz", "b" (djnz)
+#		or "" and target is an address, a label handle or None if not known yet.
+#
+#		Each jump is given a form :
+#			none 	the target is the next instruction, so no jump is needed
+#			ret 	the target is a ret, so it becomes a (conditional) ret
+#			jr 		a relative jump, if it is in range
+#			jp 		an absolute jump, if not, or the target isn't known yet
+#
+#		All jumps start as jr and are changed to jp when they are out of range, with
+#		the addresses recalculated, until nothing changes. Jumps only ever get
+#		longer, so this always finishes.
+#
+# ***************************************************************************************
+
+class BranchRelaxer(object):
+	def __init__(self,readByte,statistics = None):
+		self.readByte = readByte 											# reads (page,address) laid out
+		self.statistics = statistics 										# peephole optimiser to record in.
+		self.forms = {	"none":	{ "":[],"z":[],"nz":[] },						# instructions for each form
+						"ret":	{ "":["ret"],"z":["ret z"],"nz":["ret nz"] },
+						"jr":	{ "":["jr e"],"z":["jr z,e"],"nz":["jr nz,e"],"b":["djnz e"] },
+						"jp":	{ "":["jp nn"],"z":["jp z,nn"],"nz":["jp nz,nn"],"b":["dec b","jp nz,nn"] } }
+	#
+	#		Lay out code at base address in a page. labels maps handles already laid
+	#		out to addresses, and has the new ones added. Returns the code bytes, a
+	#		list of (handle,operand address) for jumps whose target isn't known yet,
+	#		and the offset of each item in the code.
+	#
+	def layout(self,code,base,labels,page = 0):
+		self.labels = labels
+		self.base = base
+		self.page = page
+		jumps = [item for item in code if item[0] == "jump"]
+		forms = {}
+		for i in range(0,len(code)):										# decide forms that don't depend
+			if code[i][0] == "jump":										# on distance.
+				forms[code[i][3]] = self.initialForm(code,i,labels)
+		changed = True
+		while changed:														# lengthen until it settles
+			positions = self.positions(code,base,forms,labels)
+			changed = False
+			for jump in jumps:
+				if forms[jump[3]] == "jr":
+					offset = self.target(jump,positions) - (positions[jump[3]]+2)
+					if offset < -128 or offset > 127:
+						forms[jump[3]] = "jp"
+						changed = True
+		labels.update(positions)
+		return self.assemble(code,forms,positions)
+	#
+	#		Work out the form of a jump before considering distances.
+	#
+	def initialForm(self,code,index,labels):
+		jump = code[index]
+		if jump[2] is None:													# not known, so jp to patch
+			return "jp"
+		if jump[1] == "b":													# djnz always has to count
+			return "jr"
+		i = index + 1														# jumping to the next instruction ?
+		while i < len(code) and code[i][0] == "label":
+			if code[i][1] == jump[2]:
+				return "none"
+			i += 1
+		if self.isReturn(code,jump[2],labels):								# jumping to a return ?
+			return "ret"
+		return "jr"															# assume short, until not
+	#
+	#		Check if a target is a ret instruction. Targets already laid out are only
+	#		read if they are before this code in its page, anything else in the image
+	#		may be left from earlier code.
+	#
+	def isReturn(self,code,target,labels):
+		if type(target) == int:												# (page << 16)+address
+			return (target >> 16) == self.page and self.isWrittenReturn(target & 0xFFFF)
+		if target in labels:												# labels are in this page
+			return self.isWrittenReturn(labels[target] & 0xFFFF)
+		for i in range(0,len(code)):										# find the label
+			if code[i][0] == "label" and code[i][1] == target:
+				while i < len(code) and code[i][0] == "label":
+					i += 1
+				return i < len(code) and code[i][0] == "ret"
+		return False
+	#
+	def isWrittenReturn(self,address):
+		return address < self.base and self.readByte(self.page,address) == 0xC9
+	#
+	#		Work out the address of labels and jumps. Jumps are stored by handle.
+	#
+	def positions(self,code,base,forms,labels):
+		positions = {}
+		address = base
+		for item in code:
+			if item[0] == "label":
+				positions[item[1]] = address
+			elif item[0] == "jump":
+				positions[item[3]] = address
+				address += instructionSize([(m,None) for m in self.forms[forms[item[3]]][item[1]]])
+			else:
+				address += instructionSize([item])
+		return positions
+	#
+	#		Get the address of a jump target.
+	#
+	def target(self,jump,positions):
+		target = jump[2]
+		if type(target) == int:
+			return target & 0xFFFF
+		return positions[target] if target in positions else self.labels[target] & 0xFFFF
+	#
+	#		Create the code bytes, recording what was saved over always using jp.
+	#
+	def assemble(self,code,forms,positions):
+		bytes = []
+		unresolved = []
+		offsets = []
+		for item in code:
+			offsets.append(len(bytes))
+			if item[0] == "jump":
+				form = forms[item[3]]
+				mnemonics = self.forms[form][item[1]]
+				for m in mnemonics[:-1]:										# dec b before jp
+					bytes += encodeInstruction((m,None))
+				if form == "jr":
+					offset = self.target(item,positions) - (positions[item[3]]+2)
+					bytes += encodeInstruction((mnemonics[-1],offset & 0xFF))
+					self.record("relative jump",2 if item[1] == "b" else 1,{ "":-2,"b":1 }.get(item[1],0))
+				elif form == "jp":
+					if item[2] is None:
+						prefix = instructionSize([(m,None) for m in mnemonics[:-1]])
+						unresolved.append((item[3],positions[item[3]]+prefix+1))
+						bytes += encodeInstruction((mnemonics[-1],0))
+					else:
+						bytes += encodeInstruction((mnemonics[-1],self.target(item,positions)))
+				elif form == "ret":
+					bytes += encodeInstruction((mnemonics[-1],None))
+					self.record("jump to return",3,10 if item[1] == "" else 9)
+				else:
+					self.record("jump removed",3,10)
+			elif item[0] != "label":
+				bytes += encodeInstruction(item)
+		return bytes,unresolved,offsets
+	#
+	#		Record a saving
+	#
+	def record(self,name,byteCount,tStates):
+		if self.statistics is not None:
+			self.statistics.record(name,byteCount,tStates)
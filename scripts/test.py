@@ -1,5 +1,6 @@
 from assembler import *
 from democodegen import *
+from tracesink import *
 
 if __name__ == "__main__":
 	src = """
@@ -25,8 +26,10 @@ if __name__ == "__main__":
 		for(42):a=a+index:next
 	endproc
 	""".split("\n")
+	installTraceSink(FileSink())
 	cg = DemoCodeGenerator()
 	aw = AssemblerWorker(cg)		
 	aw.assemble(src)
+	Trace.sink.close()
 	print(aw.globals)
 	#aw.codeGen.image.save()
@@ -0,0 +1,132 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		tracesink.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		31st January 2019
+#		Purpose :	Trace sinks, which receive the listing, command and phase timing
+#					events from the assembler and code generators.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import sys
+
+# ***************************************************************************************
+#
+#		Events have a level. A sink receives those at or below its level, and the
+#		senders check Trace.sink.level before doing anything, so with the default
+#		sink (level TRACE_NONE) nothing is formatted or timed.
+#
+#			TRACE_ERRORS 	errors			("error",message)
+#			TRACE_PHASES 	phase times 	phase(name,seconds)
+#			TRACE_COMMANDS 	each command 	("command",text)
+#			TRACE_LISTING 	listing lines 	("listing",text)
+#
+# ***************************************************************************************
+
+TRACE_NONE = 0
+TRACE_ERRORS = 1
+TRACE_PHASES = 2
+TRACE_COMMANDS = 3
+TRACE_LISTING = 4
+
+TRACE_LEVELS = { "none":TRACE_NONE,"errors":TRACE_ERRORS,"phases":TRACE_PHASES,
+				 "commands":TRACE_COMMANDS,"listing":TRACE_LISTING }
+
+# ***************************************************************************************
+#								Sink which does nothing
+# ***************************************************************************************
+
+class TraceSink(object):
+	def __init__(self,level = TRACE_NONE):
+		self.level = level
+		self.phases = {}													# name => total seconds
+	#
+	#		An event, kind is "error" "command" or "listing".
+	#
+	def event(self,kind,text):
+		pass
+	#
+	#		Time taken by a phase, these are totalled.
+	#
+	def phase(self,name,seconds):
+		self.phases[name] = self.phases.get(name,0.0)+seconds
+	#
+	#		Phase totals as text lines.
+	#
+	def phaseReport(self):
+		return ["{0:<12} {1:>10.2f}ms".format(name,self.phases[name]*1000) for name in sorted(self.phases.keys())]
+	#
+	#		Finished with the sink.
+	#
+	def close(self):
+		pass
+
+# ***************************************************************************************
+#							Sink which keeps events in a list
+# ***************************************************************************************
+
+class MemorySink(TraceSink):
+	def __init__(self,level = TRACE_LISTING):
+		TraceSink.__init__(self,level)
+		self.events = []													# (kind,text)
+	def event(self,kind,text):
+		self.events.append((kind,text))
+	#
+	#		Text of events of one kind.
+	#
+	def text(self,kind):
+		return [t for k,t in self.events if k == kind]
+
+# ***************************************************************************************
+#		Sink which writes events to a file, buffered, a name, an open file or stdout
+# ***************************************************************************************
+
+class FileSink(TraceSink):
+	def __init__(self,target = None,level = TRACE_LISTING,bufferSize = 256):
+		TraceSink.__init__(self,level)
+		self.ownsFile = isinstance(target,str)
+		self.handle = open(target,"w") if self.ownsFile else (target or sys.stdout)
+		self.bufferSize = bufferSize
+		self.buffer = []
+	def event(self,kind,text):
+		self.buffer.append(text if kind == "listing" else self.decorate(kind,text))
+		if len(self.buffer) >= self.bufferSize:
+			self.flush()
+	#
+	#		How non listing events look in the file.
+	#
+	def decorate(self,kind,text):
+		if kind == "command":
+			return "========= "+text+" ========="
+		if kind == "error":
+			return "***** "+text+" *****"
+		return kind+" "+text
+	#
+	#		Write out buffered events.
+	#
+	def flush(self):
+		if len(self.buffer) > 0:
+			self.handle.write("\n".join(self.buffer)+"\n")
+			self.buffer = []
+		self.handle.flush()
+	def close(self):
+		self.flush()
+		if self.ownsFile:
+			self.handle.close()
+
+# ***************************************************************************************
+#						The sink in use, shared like AssemblerException.LINE
+# ***************************************************************************************
+
+class Trace(object):
+	sink = TraceSink()
+
+#
+#		Install a sink, returning the previous one.
+#
+def installTraceSink(sink):
+	previous = Trace.sink
+	Trace.sink = sink
+	return previous
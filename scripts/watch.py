@@ -0,0 +1,238 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		watch.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		23rd January 2019
+#		Purpose :	Watches source files and reassembles only the procedures that
+#					have changed.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import hashlib,os,sys,time
+from assembler import *
+from democodegen import *
+
+# ***************************************************************************************
+#
+#		Incremental assembler. The first build assembles everything. After that, a
+#		procedure whose body has changed is assembled again at the end of the code,
+#		and its original entry point is patched to jump there, so callers and every
+#		other procedure are left as they are. Anything else (procedures added other
+#		than at the end, removed or reordered) causes a full build, as does a changed
+#		procedure needing more words for locals, as they are overlaid by its callers',
+#		or one whose code is too short to hold the jump.
+#
+# ***************************************************************************************
+
+class IncrementalAssembler(object):
+	def __init__(self,codeGenClass,maxWaste = None,imageFile = "boot.img"):
+		self.codeGenClass = codeGenClass 									# creates code generators
+		self.maxWaste = maxWaste 											# rebuild if this much dead code
+		self.imageFile = imageFile 											# image written, None if not
+		self.jumpSize = self.trampolineSize()								# size of jump to new code
+		self.procs = None 													# no build yet.
+		self.reader = AssemblerWorker(None)									# splits source into procedures
+		self.chunks = {}													# source text => procedures
+	#
+	#		Build from a list of source texts, returns the number of procedures assembled
+	#
+	def build(self,sources):
+		chunks = {}
+		procs = []
+		for text in sources:
+			procs += self.readProcedures(text,chunks)
+		self.chunks = chunks												# forget removed text.
+		names = [p[0] for p in procs]
+		if self.procs is None or names[:len(self.procs)] != [p["name"] for p in self.procs] or \
+								(self.maxWaste is not None and self.waste > self.maxWaste):
+			return self.fullBuild(procs)
+		return self.incrementalBuild(procs)
+	#
+	#		Split a source text into procedures. The text is cut into chunks at lines
+	#		starting with defproc, and only chunks not seen in the last build are
+	#		tokenised. Returns a list of [name,hash,header,body,line offset]
+	#
+	def readProcedures(self,text,chunks):
+		procs = []
+		for chunk,line in self.reader.lexer.chunks(text):
+			if chunk in chunks:												# repeated text, same as before
+				cached = chunks[chunk]
+			elif chunk in self.chunks:										# text seen last build
+				cached = self.chunks[chunk]
+			else:															# new text, tokenise it
+				cached = [line,[]]
+				for header,body in self.reader.procedures(chunk.split("\n"),line):
+					cached[1].append([header[1][0][1],self.hashProcedure(header,body),header,body])
+			chunks[chunk] = cached
+			procs += [p+[line-cached[0]] for p in cached[1]]
+		return procs
+	#
+	#		Hash a procedure, ignoring line numbers
+	#
+	def hashProcedure(self,header,body):
+		return hashlib.sha1(repr([header[1]]+[cmd[1] for cmd in body]).encode()).hexdigest()
+	#
+	#		Assemble a procedure. The cached tokens are copied as assembly replaces
+	#		identifiers in place, and line numbers are moved to where the text is now.
+	#
+	def assembleProcedure(self,proc):
+		name,hashCode,header,body,offset = proc
+		header = (header[0]+offset,list(header[1]))
+		body = [(cmd[0]+offset,list(cmd[1])) for cmd in body]
+		self.worker.assembleProcedure(header,body)
+		return self.worker.globals[name+"("]
+	#
+	#		Assemble everything from scratch.
+	#
+	def fullBuild(self,procs):
+		self.procs = None
+		self.codeGen = self.codeGenClass()
+		self.worker = AssemblerWorker(self.codeGen)
+		built = []
+		for proc in procs:
+			entry = self.assembleProcedure(proc)
+			built.append(self.procedureInfo(proc[0],proc[1],entry))
+		self.procs = built
+		self.end = self.codeGen.getAddress()								# where new code goes
+		self.waste = 0
+		self.writeImage()
+		return len(built)
+	#
+	#		Assemble changed and new procedures only.
+	#
+	def incrementalBuild(self,procs):
+		changed = 0
+		for i in range(0,len(procs)):
+			name,hashCode = procs[i][0],procs[i][1]
+			if i < len(self.procs) and self.procs[i]["hash"] == hashCode:	# unchanged
+				continue
+			if i < len(self.procs) and self.procs[i]["trampoline"] is None and \
+						self.procs[i]["end"] - self.procs[i]["entry"] < self.jumpSize:
+				return self.fullBuild(procs)								# no room for the jump
+			self.checkCalls(procs,i)										# only call earlier procedures
+			globalNames = set(self.worker.globals.keys())					# so failed builds can be undone
+			self.codeGen.setAddress(self.end)
+			frameEnd = self.worker.frames.ends.get(name)
+			try:
+				entry = self.assembleProcedure(procs[i])
+			except AssemblerException:
+				for g in set(self.worker.globals.keys())-globalNames:
+					del self.worker.globals[g]
+				if frameEnd is None:										# nor its locals, as last built
+					self.worker.frames.ends.pop(name,None)
+				else:
+					self.worker.frames.ends[name] = frameEnd
+				raise
+			if frameEnd is not None and self.worker.frames.ends[name] > frameEnd:
+				return self.fullBuild(procs)								# locals now overlap its callers'
+			end = self.codeGen.getAddress()
+			if i < len(self.procs):											# replacing a procedure
+				info = self.procs[i]
+				self.waste += info["end"] - info["code"]					# previous code is now dead
+				self.worker.globals[name+"("] = info["entry"]				# callers still use old entry
+				if info["trampoline"] is None:								# jump from old entry to new code
+					self.codeGen.setAddress(info["entry"])
+					info["trampoline"] = self.codeGen.jumpInstruction("")
+					self.codeGen.setAddress(end)							# written now so it can be patched
+				self.codeGen.setJumpAddress(info["trampoline"],entry)
+				info.update({ "hash":hashCode,"code":entry,"end":end })
+			else:															# new procedure at the end
+				self.procs.append(self.procedureInfo(name,hashCode,entry))
+			self.end = end
+			changed += 1
+		if changed > 0:
+			self.writeImage()
+		return changed
+	#
+	#		Work out how big the jump from an old entry is, with a code generator of
+	#		its own so nothing is written to the one building.
+	#
+	def trampolineSize(self):
+		probe = self.codeGenClass()
+		start = probe.getAddress()
+		probe.jumpInstruction("")
+		if hasattr(probe,"flush"):											# write a pending jump
+			probe.flush()
+		return probe.getAddress() - start
+	#
+	#		Create the information kept about an assembled procedure. Entry is where it is
+	#		called, code and end where its latest code is.
+	#
+	def procedureInfo(self,name,hashCode,entry):
+		return { "name":name,"hash":hashCode,"entry":entry,"code":entry,"end":self.codeGen.getAddress(),"trampoline":None }
+	#
+	#		Check a procedure only calls procedures defined before it, as a full build would.
+	#
+	def checkCalls(self,procs,index):
+		later = { p[0] for p in procs[index:] }
+		for cmd in procs[index][3]:
+			for kind,value in cmd[1]:
+				if kind == "c" and value in later:
+					AssemblerException.LINE = cmd[0]+procs[index][4]
+					raise AssemblerException("Unknown identifier "+value+"(")
+	#
+	#		Write the image out, if the code generator has one.
+	#
+	def writeImage(self):
+		if hasattr(self.codeGen,"image"):
+			self.codeGen.flush()
+			if self.imageFile is not None:
+				self.codeGen.image.save(self.imageFile)
+
+# ***************************************************************************************
+#							Poll the files, rebuild on change
+# ***************************************************************************************
+
+def watch(fileNames,codeGenClass,interval = 0.25):
+	builder = IncrementalAssembler(codeGenClass)
+	lastChange = None
+	while True:
+		change = [os.stat(f).st_mtime_ns for f in fileNames]
+		if change != lastChange:
+			lastChange = change
+			start = time.perf_counter()
+			sources = []
+			for f in fileNames:
+				with open(f) as h:
+					sources.append(h.read())
+			try:
+				count = builder.build(sources)
+				print("Assembled {0} procedure(s) in {1:.1f}ms".format(count,(time.perf_counter()-start)*1000))
+			except AssemblerException as e:
+				print("Build failed, {0} at line {1}.".format(e.message,e.line))
+		time.sleep(interval)
+
+# ***************************************************************************************
+#				Check rebuilds on the emulator, returns what was wrong
+# ***************************************************************************************
+
+def checkRebuilds():
+	from z80codegen import Z80CodeGenerator
+	from z80emu import Z80Machine
+	wrong = []
+	before = [ "defproc a()","endproc","defproc b_boot()","$result = 7","endproc" ]
+	after = [ "defproc a()","$result = 1","endproc","defproc b_boot()","$result = 7","endproc" ]
+	builder = IncrementalAssembler(Z80CodeGenerator,imageFile = None)
+	builder.build(["\n".join(before)])
+	builder.build(["\n".join(after)])									# a() is a 1 byte ret before
+	machine = Z80Machine()
+	machine.loadImage(bytes(builder.codeGen.image.memory))
+	result = builder.worker.globals["$result"]
+	for name,expected in [("a",1),("b_boot",7)]:
+		machine.call(builder.worker.globals[name+"("] & 0xFFFF)
+		if machine.readWord(result) != expected:
+			wrong.append("{0}() gives {1}, not {2}".format(name,machine.readWord(result),expected))
+	return wrong
+
+if __name__ == "__main__":
+	if len(sys.argv) < 2:
+		print("python watch.py <source file> ... | -check")
+		sys.exit(1)
+	if sys.argv[1:] == ["-check"]:
+		wrong = checkRebuilds()
+		for w in wrong:
+			print("Wrong "+w)
+		sys.exit(1 if len(wrong) > 0 else 0)
+	watch(sys.argv[1:],DemoCodeGenerator)
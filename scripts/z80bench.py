@@ -0,0 +1,90 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		z80bench.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		29th January 2019
+#		Purpose :	Assembles the benchmark programs, runs them on the emulator and
+#					compares the T-states against the last recorded ones.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+import contextlib,json,os,sys
+from assembler import *
+from z80codegen import *
+from z80emu import *
+
+# ***************************************************************************************
+#
+#		Each benchmark is a .hla file in benchmarks. Its xxxx_boot() procedures are
+#		run in order, as the main program would, and the T-states counted. The
+#		value of $result is checked too, so a faster wrong answer is noticed.
+#
+#		python z80bench.py [-update] [benchmark ...]
+#
+# ***************************************************************************************
+
+BENCHMARKDIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)),"benchmarks")
+BASELINE = os.path.join(BENCHMARKDIRECTORY,"cycles.json")
+
+#
+#		Assemble a source file and run it. Boot is the procedure to run, or None to
+#		run all the _boot procedures. Returns T-states and $result.
+#
+def runProgram(fileName,boot = None):
+	codeGen = Z80CodeGenerator()
+	worker = AssemblerWorker(codeGen)
+	with open(os.devnull,"w") as sink:
+		with contextlib.redirect_stdout(sink):
+			worker.assembleFile(fileName)
+	codeGen.flush()
+	machine = Z80Machine()
+	machine.loadImage(bytes(codeGen.image.memory))
+	if boot is not None:
+		entries = [ worker.globals[boot+"("] ]
+	else:
+		entries = sorted(address for name,address in worker.globals.items() if name.endswith("_boot("))
+	cycles = 0
+	for address in entries:
+		if (address >> 16) != 0:											# map the page in
+			machine.setMMU(6,address >> 16)
+			machine.setMMU(7,(address >> 16)+1)
+		cycles += machine.call(address & 0xFFFF)
+	result = machine.readWord(worker.globals["$result"]) if "$result" in worker.globals else None
+	return cycles,result
+#
+#		Run the benchmarks, returns their results by name.
+#
+def runBenchmarks(names):
+	results = {}
+	for name in names:
+		cycles,result = runProgram(os.path.join(BENCHMARKDIRECTORY,name+".hla"))
+		results[name] = { "cycles":cycles,"result":result }
+	return results
+
+if __name__ == "__main__":
+	args = sys.argv[1:]
+	update = "-update" in args
+	names = [x for x in args if x != "-update"]
+	if len(names) == 0:
+		names = sorted(f[:-4] for f in os.listdir(BENCHMARKDIRECTORY) if f.endswith(".hla"))
+	baseline = json.load(open(BASELINE)) if os.path.exists(BASELINE) else {}
+	results = runBenchmarks(names)
+	failed = False
+	print("{0:<12} {1:>12} {2:>12} {3:>8} {4:>8}".format("benchmark","T-states","previous","change","result"))
+	for name in names:
+		cycles,result = results[name]["cycles"],results[name]["result"]
+		previous = baseline.get(name)
+		change = ""
+		if previous is not None:
+			change = "{0:+.1f}%".format((cycles - previous["cycles"]) * 100.0 / previous["cycles"])
+			if previous["result"] != result:
+				change = "WRONG"
+				failed = True
+		print("{0:<12} {1:>12} {2:>12} {3:>8} {4:>8}".format(name,cycles,"" if previous is None else previous["cycles"],change,str(result)))
+	if update:
+		baseline.update(results)
+		with open(BASELINE,"w") as h:
+			json.dump(baseline,h,indent = 1,sort_keys = True)
+	sys.exit(1 if failed else 0)
@@ -9,17 +9,114 @@
 # ***************************************************************************************
 # ***************************************************************************************
 
+from assembler import *
+from imagelib import *
+from mathlib import *
+from memlib import *
+from peephole import *
+from relax import *
+
 # ***************************************************************************************
+#
 #							This is the Z80 Code Generator
+#
+#		The accumulator is HL. Operands are loaded into BC. Addresses are the page
+#		number << 16 + the Z80 address, page 0 is unpaged memory. Variables are
+#		allocated in unpaged memory by the image.
+#
+#		Jumps are not written until their targets are known, so they can be JR or
+#		JP. While a forward jump is unresolved getAddress() returns a label handle
+#		rather than an address, which is only used as a jump target.
+#
+#		FOR loops keep their count in B (using DJNZ) if it is a constant up to 256,
+#		otherwise in BC. Inside loops operands go in DE instead, and BC is saved
+#		round calls and nested loops.
+#
+#		Multiply, divide and modulus call routines in mathlib.py, with the operand
+#		in DE. The target is "z80n", which multiplies using MUL D,E, or "z80". The
+#		routines used are linked into unpaged memory with the data, so they can be
+#		called from any page.
+#
+#		Block copies, fills and compares call routines in memlib.py, with the
+#		addresses in HL and DE and the count in BC, except short copies upwards and
+#		fills, which are unrolled.
+#
 # ***************************************************************************************
 
 class Z80CodeGenerator(object):
-	def __init__(self):
-		pass
-	#
-	#		Get current address
+	def __init__(self,optimise = True,target = "z80n"):
+		self.image = MemoryImage()
+		self.target = target 												# z80 or z80n
+		self.runtime = {}													# routine => address linked
+		self.runtimeSize = 0
+		self.peephole = PeepholeOptimiser(optimise,lambda: AssemblerException.LINE)	# instructions go via this
+		self.emit = self.peephole.emit
+		self.relaxer = BranchRelaxer(self.image.read,self.peephole)
+		self.unresolved = 0 												# forward jumps not known
+		self.nextHandle = 0
+		self.jumps = {}														# handle => pending jump
+		self.labelAddresses = {}											# handle => address laid out
+		self.laidOut = {}													# handle => (page,operand) for patching
+		self.patches = []													# patches to labels not laid out
+		self.loops = []														# FOR loops being compiled
+		self.counterSaved = False 											# loop count pushed for a call
+		self.lineCode = []													# [page,start,end,line] of code
+		self.paramRegisters = [ "hl","de","bc","ix" ]						# registers for parameters
+		self.logicOps = { "&":"and","|":"or","^":"xor" }
+	#
+	#		Get current address. If a forward jump is waiting for a target this is a
+	#		label, otherwise anything pending is written and it is the real address.
 	#
 	def getAddress(self):
+		if self.unresolved > 0:
+			handle = self.newHandle("label")
+			self.peephole.add(("label",handle))
+			return handle
+		self.flush()
+		return (self.image.getCodePage() << 16)+self.image.getCodeAddress()
+	#
+	#		Set current address
+	#
+	def setAddress(self,address):
+		self.flush()
+		self.image.setCodePointer(address >> 16,address & 0xFFFF)
+	#
+	#		Write out anything pending, choosing the jump forms. Jumps without targets
+	#		are written as JP and patched when they are known.
+	#
+	def flush(self):
+		code,lines = self.peephole.take()
+		if len(code) == 0:
+			return
+		page,base = self.image.getCodePage(),self.image.getCodeAddress()
+		bytes,unresolved,offsets = self.relaxer.layout(code,base,self.labelAddresses,page)
+		self.image.cBytes(bytes)
+		self.recordLines(page,base,lines,offsets+[len(bytes)])
+		for handle,operand in unresolved:
+			self.laidOut[handle] = (page,operand)
+		self.jumps = {}
+		self.unresolved = 0
+		patches = self.patches
+		self.patches = []
+		for jump,target in patches:
+			self.setJumpAddress(jump,target)
+	#
+	#		Record which source lines the code just written came from.
+	#
+	def recordLines(self,page,base,lines,offsets):
+		for i in range(0,len(lines)):
+			start,end = base+offsets[i],base+offsets[i+1]
+			last = self.lineCode[-1] if len(self.lineCode) > 0 else None
+			if last is not None and last[0] == page and last[2] == start and last[3] == lines[i]:
+				last[2] = end
+			elif end > start:
+				self.lineCode.append([page,start,end,lines[i]])
+	#
+	#		Create a new handle for a label or jump.
+	#
+	def newHandle(self,kind):
+		self.nextHandle += 1
+		return (kind,self.nextHandle)
 	#
 	#		Get word size
 	#
@@ -29,74 +126,296 @@ class Z80CodeGenerator(object):
 	#		Load a constant or variable into the accumulator.
 	#
 	def loadDirect(self,isConstant,value):
-		pass
+		self.emit("ld hl,nn" if isConstant else "ld hl,(nn)",value & 0xFFFF)
 	#
 	#		store A to an address
 	#
 	def storeDirect(self,address):
-		pass
+		self.emit("ld (nn),hl",address & 0xFFFF)
 	#
 	#		save A temporarily for writing later
 	#
 	def saveAccumulator(self):
-		pass
+		self.emit("push hl")
 	#
 	#		save value saved by 'save Accumulator' at address A.
 	#
 	def saveIndirect(self):
-		pass
+		self.emit("pop de")
+		self.emit("ld (hl),e")
+		self.emit("inc hl")
+		self.emit("ld (hl),d")
 	#
 	#		Do a binary operation on a constant or variable on the accumulator
-	#							+ - * / % 		& | ^ 		!
+	#							+ - * / % 		& | ^ 		! ?
+	#		<< and >> are shifts by a constant, created by the assembler.
 	#
 	def binaryOperation(self,operator,isConstant,value):
-		pass
-	#
-	#		Push and restore A on stack for FOR/NEXT
-	#
-	def pushA(self):
-		pass
-	#
-	def popA(self):
-		pass
-	#
-	#		Allocate count bytes of meory, default is word size
+		if operator == "!" or operator == "?":								# indirection, add then read
+			self.binaryOperation("+",isConstant,value)
+			if operator == "?":
+				self.emit("ld l,(hl)")
+				self.emit("ld h,n",0)
+			else:
+				self.emit("ld a,(hl)")
+				self.emit("inc hl")
+				self.emit("ld h,(hl)")
+				self.emit("ld l,a")
+			return
+		#
+		if operator == "<<" or operator == ">>":							# constant shifts
+			self.shift(operator == "<<",value & 15)
+			return
+		#
+		if operator in RUNTIMEENTRIES:										# multiply, divide, modulus
+			self.emit("ld de"+(",nn" if isConstant else ",(nn)"),value & 0xFFFF)
+			self.emit("call nn",self.runtimeAddress(RUNTIMEENTRIES[operator]))
+			return
+		#
+		reg = "de" if len(self.loops) > 0 else "bc"							# BC has the loop count
+		self.emit("ld "+reg+(",nn" if isConstant else ",(nn)"),value & 0xFFFF)
+		if operator == "+":
+			self.emit("add hl,"+reg)
+			return
+		if operator == "-":
+			self.emit("xor a")
+			self.emit("sbc hl,"+reg)
+			return
+		if operator in self.logicOps:										# do it a byte at a time
+			op = self.logicOps[operator]
+			self.emit("ld a,h")
+			self.emit(op+" "+reg[0])
+			self.emit("ld h,a")
+			self.emit("ld a,l")
+			self.emit(op+" "+reg[1])
+			self.emit("ld l,a")
+			return
+		assert False,"Operator "+operator+" not supported"
+	#
+	#		Shift HL left or right (logical) by a constant number of bits.
+	#
+	def shift(self,left,count):
+		if count >= 8:														# move a whole byte
+			self.emit("ld h,l" if left else "ld l,h")
+			self.emit("ld l,n" if left else "ld h,n",0)
+			count -= 8
+		for i in range(0,count):
+			if left:
+				self.emit("add hl,hl")
+			else:
+				self.emit("srl h")
+				self.emit("rr l")
+	#
+	#		Get the address of a runtime routine, linking the library unit it is in the
+	#		first time one of its routines is used.
+	#
+	def runtimeAddress(self,entry):
+		if entry not in self.runtime:
+			unit = MEMORYLIBRARY[self.target] if entry in MEMORYENTRIES else runtimeUnit(self.target,entry)
+			size = len(assembleCode(unit,0x8000)[0])
+			address = self.image.allocateData(size)
+			code,labels = assembleCode(unit,address)
+			for i in range(0,size):
+				self.image.write(0,address+i,code[i])
+			self.runtime.update({ name:labels[name] for name in list(RUNTIMEENTRIES.values())+MEMORYENTRIES if name in labels })
+			self.runtimeSize += size
+		return self.runtime[entry]
+	#
+	#		Average T-states of a call to an address beyond the call itself, which is
+	#		the routine if it is a runtime routine, otherwise 0.
+	#
+	def runtimeCost(self,address):
+		for operator,entry in RUNTIMEENTRIES.items():
+			if self.runtime.get(entry) == address:
+				return RUNTIMECOSTS[self.target][operator][1]-instructionTime([("call nn",None)])
+		return 0
+	#
+	#		Copy a block from HL to DE. The count is a constant, or None if it is in BC.
+	#		Kind is "move", which can overlap, "up", which copies upwards as LDIR does,
+	#		or "words", which copies a word at a time upwards.
+	#
+	def copyMemory(self,count,kind):
+		if kind == "up" and count is not None and count <= UNROLLSIZE:
+			for i in range(0,count):
+				self.emit("ldi")
+		else:
+			self.blockCall(count,{ "move":"copy","up":"copyup","words":"copywords" }[kind])
+		self.restoreCounter()
+	#
+	#		Fill a block at HL with E, or the word DE.
+	#
+	def fillMemory(self,count,words):
+		if count is not None and count <= UNROLLSIZE:
+			for i in range(0,count):
+				self.emit("ld (hl),"+("d" if words and i % 2 != 0 else "e"))
+				if i < count-1:
+					self.emit("inc hl")
+		else:
+			self.blockCall(count,"fillwords" if words else "fill")
+		self.restoreCounter()
+	#
+	#		Compare blocks at HL and DE, the accumulator is 0 if they are the same.
+	#
+	def compareMemory(self,count):
+		self.blockCall(count,"compare")
+		self.restoreCounter()
+	#
+	#		Call a block routine, loading BC with the count if it is a constant.
+	#
+	def blockCall(self,count,entry):
+		self.saveCounter()
+		if count is not None:
+			self.emit("ld bc,nn",count & 0xFFFF)
+		self.emit("call nn",self.runtimeAddress(entry))
+	#
+	#		Start a FOR loop. The count is a constant, or None if it is in HL. Index is
+	#		the address to write the count to, None if not needed.
+	#
+	def loopStart(self,count,index):
+		nested = len(self.loops) > 0
+		if nested:															# keep the enclosing count
+			self.emit("push bc")
+		short = count is not None and (count-1) & 0xFFFF < 256				# 1-256 times
+		if short:
+			self.emit("ld b,n",count & 0xFF)
+		elif count is not None:
+			self.emit("ld bc,nn",count & 0xFFFF)
+		else:
+			self.emit("ld b,h")
+			self.emit("ld c,l")
+		loop = [short,self.getAddress(),nested]
+		if not short:
+			self.emit("dec bc")
+		if index is not None:												# index is count-1 to 0
+			if short:
+				self.emit("ld l,b")
+				self.emit("dec l")
+				self.emit("ld h,n",0)
+				self.emit("ld (nn),hl",index & 0xFFFF)
+			else:
+				self.emit("ld (nn),bc",index & 0xFFFF)
+		self.loops.append(loop)
+		return loop
+	#
+	#		End a FOR loop, going round again if the count isn't zero.
+	#
+	def loopEnd(self,loop):
+		self.loops.pop()
+		short,address,nested = loop
+		if not short:
+			self.emit("ld a,b")
+			self.emit("or c")
+		self.setJumpAddress(self.addJump("b" if short else "nz"),address)
+		if nested:
+			self.emit("pop bc")
+	#
+	#		Allocate a variable in unpaged memory
 	#
 	def allocVar(self,name = None):
-		pass
+		return self.image.allocateData(self.getWordSize())
 	#
 	#		Load parameter constant/variable to a temporary area,
 	#
 	def loadParamRegister(self,regNumber,isConstant,value):
-		pass
+		self.saveCounter()
+		register = self.paramRegisters[regNumber]
+		self.emit("ld "+register+(",nn" if isConstant else ",(nn)"),value & 0xFFFF)
 	#
 	#		Copy parameter to an actual variable
 	#
 	def storeParamRegister(self,regNumber,address):
-		pass
+		self.emit("ld (nn),"+self.paramRegisters[regNumber],address & 0xFFFF)
 	#
-	#		Create a string constant (done outside procedures)
+	#		Copy a parameter register to the accumulator, HL is already there.
+	#
+	def copyParamRegister(self,regNumber):
+		if regNumber == 1:
+			self.emit("ex de,hl")
+		elif regNumber == 2:
+			self.emit("ld h,b")
+			self.emit("ld l,c")
+		elif regNumber == 3:
+			self.emit("push ix")
+			self.emit("pop hl")
+	#
+	#		Create a string constant, which is in the image's string pool.
 	#
 	def createStringConstant(self,string):
-		pass
+		return self.image.stringAddress(string)
 	#
-	#	Compile a loop instruction. Test are z, nz, p or "" (unconditional). No target
-	#	address is provided at compile time.
+	#		Put all the strings a program uses in the pool at once, so they share more.
 	#
-	def jumpInstruction(self,test):
-		pass
+	def poolStrings(self,strings):
+		self.image.poolStrings(strings)
 	#
-	#		Set Jump Address for a jump already compile.
+	#	Compile a loop instruction. Test are z, nz, p or "" (unconditional). No target
+	#	address is provided at compile time, a handle for the jump is returned.
 	#
-	def setJumpAddress(self,jumpAddress,target):
-		pass
+	def jumpInstruction(self,test):
+		if test == "z" or test == "nz":
+			self.emit("ld a,h")
+			self.emit("or l")
+		elif test == "p":
+			self.emit("bit 7,h")
+			test = "z"
+		return self.addJump(test)
+	#
+	#		Add a jump on a condition flag, or djnz if it is "b".
+	#
+	def addJump(self,condition):
+		handle = self.newHandle("jump")
+		self.jumps[handle] = ["jump",condition,None,handle]
+		self.peephole.add(self.jumps[handle])
+		self.unresolved += 1
+		return handle
+	#
+	#		Set Jump Address for a jump already compiled. If it is still pending the
+	#		form is decided later, otherwise the JP is patched.
+	#
+	def setJumpAddress(self,jump,target):
+		if jump in self.jumps:
+			if self.jumps[jump][2] is None:
+				self.unresolved -= 1
+			self.jumps[jump][2] = target
+			return
+		if type(target) != int:												# a label
+			if target not in self.labelAddresses:
+				self.patches.append((jump,target))
+				return
+			target = self.labelAddresses[target]
+		page,operand = self.laidOut[jump]
+		self.image.writeWord(page,operand,target & 0xFFFF)
 	#
 	#		Call a subroutine
 	#
 	def callSubroutine(self,address):
-		pass
+		assert (address >> 16) == 0 or (address >> 16) == self.image.getCodePage(),"Cross page call, link with banklinker.py"
+		self.saveCounter()
+		self.emit("call nn",address & 0xFFFF)
+		self.restoreCounter()
+	#
+	#		Jump to a subroutine, which returns for this one. It is never in a loop,
+	#		so the count isn't saved.
+	#
+	def tailCall(self,address):
+		assert (address >> 16) == 0 or (address >> 16) == self.image.getCodePage(),"Cross page call, link with banklinker.py"
+		self.setJumpAddress(self.addJump(""),address)
+	#
+	#		In a loop, the count has to be saved before loading parameters for a call.
+	#
+	def saveCounter(self):
+		if len(self.loops) > 0 and not self.counterSaved:
+			self.emit("push bc")
+			self.counterSaved = True
+	#
+	#		Get the loop count back after a call.
+	#
+	def restoreCounter(self):
+		if self.counterSaved:
+			self.emit("pop bc")
+			self.counterSaved = False
 	#
 	#		Return from subroutine.
 	#
 	def returnSubroutine(self):
-		pass
+		self.emit("ret")
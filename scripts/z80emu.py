@@ -0,0 +1,847 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		z80emu.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		29th January 2019
+#		Purpose :	Headless Z80/Z80N emulator, for running and timing generated code.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from imagelib import *
+from z80opcodes import *
+
+# ***************************************************************************************
+#
+#		Memory is the Next's 8k pages, mapped into the Z80's address space by the
+#		MMU registers (Next registers $50-$57). boot.img is loaded as bootloader.asm
+#		does, $8000-$BFFF then pages 32-95 two at a time into $C000-$FFFF, leaving
+#		pages 94 and 95 mapped there.
+#
+#		Registers B C D E H L F A are held in a list, in the order of the register
+#		numbers in opcodes, with F in the place of (HL). T-states come from the
+#		opcode table in z80opcodes, so they agree with the cost report.
+#
+#		Interrupts are not emulated. Ports read $FF and writes are ignored, apart from
+#		the Next register ports $243B/$253B and the zxnDMA port $6B (see ZXNDMA).
+#
+# ***************************************************************************************
+
+class Z80EmulatorException(Exception):
+	def __init__(self,message):
+		Exception.__init__(self,message)
+		self.message = message
+
+FLAG_S,FLAG_Z,FLAG_H,FLAG_PV,FLAG_N,FLAG_C = 0x80,0x40,0x10,0x04,0x02,0x01
+
+class Z80Machine(object):
+	PAGECOUNT = 224 														# 8k pages, 1.75Mb as on a Next
+	ROMPAGE = 0xFF 															# MMU value for ROM
+
+	def __init__(self):
+		self.memory = bytearray(0x2000 * (Z80Machine.PAGECOUNT+1))			# last page stands in for ROM
+		self.mmu = [ Z80Machine.ROMPAGE,Z80Machine.ROMPAGE,10,11,4,5,0,1 ]	# as the Next starts up
+		self.offsets = [0] * 8
+		for slot in range(0,8):
+			self.setMMU(slot,self.mmu[slot])
+		self.nextRegisters = {}
+		self.nextRegisterSelect = 0
+		self.dma = ZXNDMA(self)
+		self.r = [0] * 8													# B C D E H L F A
+		self.alternate = [0] * 8
+		self.ix = self.iy = self.sp = self.pc = 0
+		self.i = self.refresh = 0
+		self.iff = False
+		self.halted = False
+		self.cycles = 0
+		self.parity = [ FLAG_PV if bin(n).count("1") % 2 == 0 else 0 for n in range(0,256) ]
+		self.sz = [ (n & FLAG_S) | (FLAG_Z if n == 0 else 0) for n in range(0,256) ]
+		self.szp = [ self.sz[n] | self.parity[n] for n in range(0,256) ]
+		self.buildTimings()
+	#
+	#		T-states from the opcode table, as [taken,not taken] lists by opcode.
+	#
+	def buildTimings(self):
+		def timings(prefix):
+			return [ list(Z80OPCODES[prefix+(n,)][2:]) if prefix+(n,) in Z80OPCODES else None for n in range(0,256) ]
+		self.tMain = timings(())
+		self.tIndex = timings((0xDD,))
+		self.tBit = timings((0xCB,))
+		self.tIndexBit = timings((0xDD,0xCB))
+		self.tExtended = timings((0xED,))
+		self.memoryOperand = [ False ] * 256									# opcodes with (hl) which become (ix+d)
+		for n in range(0,256):
+			x,y,z = n >> 6,(n >> 3) & 7,n & 7
+			self.memoryOperand[n] = (x == 1 and (y == 6 or z == 6) and n != 0x76) or (x == 2 and z == 6) or \
+										(x == 0 and z >= 4 and z <= 6 and y == 6)
+
+	# ***********************************************************************************
+	#									Memory
+	# ***********************************************************************************
+
+	def setMMU(self,slot,page):
+		if page != Z80Machine.ROMPAGE and page >= Z80Machine.PAGECOUNT:
+			raise Z80EmulatorException("Bad page {0}".format(page))
+		self.mmu[slot] = page
+		self.offsets[slot] = (Z80Machine.PAGECOUNT if page == Z80Machine.ROMPAGE else page) * 0x2000
+	#
+	def read(self,address):
+		return self.memory[self.offsets[address >> 13]+(address & 0x1FFF)]
+	#
+	def write(self,address,byte):
+		self.memory[self.offsets[address >> 13]+(address & 0x1FFF)] = byte & 0xFF
+	#
+	def readWord(self,address):
+		return self.read(address) + (self.read((address+1) & 0xFFFF) << 8)
+	#
+	def writeWord(self,address,word):
+		self.write(address,word)
+		self.write((address+1) & 0xFFFF,word >> 8)
+	#
+	#		Load a memory image as the bootloader does, from data or a file name. A
+	#		.nex file is loaded as the Next loads it.
+	#
+	def loadImage(self,image):
+		if type(image) == str:
+			image = open(image,"rb").read()
+		if image[0:4] == b"Next":
+			return self.loadNex(image)
+		self.writePages(4,image[0:0x4000])									# $8000-$BFFF
+		for page in range(MemoryImage.FIRSTPAGE,MemoryImage.LASTPAGE+1,2):
+			offset = ((page - MemoryImage.FIRSTPAGE) // 2 + 1) * 0x4000
+			self.writePages(page,image[offset:offset+0x4000])
+			self.setMMU(6,page)
+			self.setMMU(7,page+1)
+	#
+	#		Load the 16k banks in a .nex file, in the order they are stored, and map
+	#		the entry bank in at $C000.
+	#
+	def loadNex(self,image):
+		offset = 512
+		for bank in [5,2,0,1,3,4]+list(range(6,112)):
+			if image[18+bank] != 0:
+				self.writePages(bank*2,image[offset:offset+0x4000])
+				offset += 0x4000
+		self.setMMU(6,image[139]*2)
+		self.setMMU(7,image[139]*2+1)
+	#
+	def writePages(self,page,data):
+		self.memory[page*0x2000:page*0x2000+len(data)] = data
+
+	# ***********************************************************************************
+	#									Running code
+	# ***********************************************************************************
+
+	#
+	#		Call the code at address with the stack at stack, until it returns to the
+	#		sentinel address. Returns the T-states taken.
+	#
+	def call(self,address,stack = 0x7F00,sentinel = 0x0000,maxCycles = 100000000):
+		self.sp = (stack - 2) & 0xFFFF
+		self.writeWord(self.sp,sentinel)
+		self.pc = address & 0xFFFF
+		return self.run(sentinel,maxCycles)
+	#
+	#		Run until the PC is the sentinel, or HALT. Returns the T-states taken.
+	#
+	def run(self,sentinel,maxCycles = 100000000):
+		start = self.cycles
+		limit = self.cycles + maxCycles
+		self.halted = False
+		while self.pc != sentinel and not self.halted:
+			taken = self.step()												# may add DMA T-states
+			self.cycles += taken
+			if self.cycles > limit:
+				raise Z80EmulatorException("Did not stop after {0} T-states, PC ${1:04x}".format(maxCycles,self.pc))
+		return self.cycles - start
+	#
+	#		Fetch bytes at PC
+	#
+	def fetch(self):
+		byte = self.memory[self.offsets[self.pc >> 13]+(self.pc & 0x1FFF)]
+		self.pc = (self.pc + 1) & 0xFFFF
+		return byte
+	#
+	def fetchWord(self):
+		low = self.fetch()
+		return low + (self.fetch() << 8)
+	#
+	def fetchOffset(self):
+		byte = self.fetch()
+		return byte - 256 if byte >= 128 else byte
+	#
+	#		Execute one instruction, returning the T-states.
+	#
+	def step(self):
+		self.refresh = (self.refresh & 0x80) | ((self.refresh + 1) & 0x7F)
+		opcode = self.fetch()
+		if opcode == 0xCB:
+			return self.bitInstruction(self.fetch(),None)
+		if opcode == 0xED:
+			return self.extendedInstruction(self.fetch())
+		self.index = 0														# 0 HL, 1 IX, 2 IY
+		if opcode == 0xDD or opcode == 0xFD:
+			self.index = 1 if opcode == 0xDD else 2
+			opcode = self.fetch()
+			if opcode == 0xCB:												# DD CB d op
+				address = (self.indexRegister() + self.fetchOffset()) & 0xFFFF
+				return self.bitInstruction(self.fetch(),address)
+			if self.tIndex[opcode] is None:									# prefix does nothing
+				self.pc = (self.pc - 1) & 0xFFFF
+				return 4
+			timing = self.tIndex[opcode]
+			self.address = (self.indexRegister() + self.fetchOffset()) & 0xFFFF if self.memoryOperand[opcode] else None
+		else:
+			timing = self.tMain[opcode]
+			self.address = None
+		return timing[0] if self.execute(opcode) else timing[1]
+
+	# ***********************************************************************************
+	#								Register access
+	# ***********************************************************************************
+
+	def indexRegister(self):
+		return [ (self.r[4] << 8) | self.r[5],self.ix,self.iy ][self.index]
+	#
+	def setIndexRegister(self,value):
+		value &= 0xFFFF
+		if self.index == 0:
+			self.r[4],self.r[5] = value >> 8,value & 0xFF
+		elif self.index == 1:
+			self.ix = value
+		else:
+			self.iy = value
+	#
+	#		8 bit register by number, 6 is memory at (HL) or (IX+d). With an index
+	#		prefix and no memory operand, H and L are IXH and IXL.
+	#
+	def getRegister(self,n):
+		if n == 6:
+			return self.read(self.address if self.address is not None else (self.r[4] << 8) | self.r[5])
+		if self.index != 0 and self.address is None and (n == 4 or n == 5):
+			value = self.indexRegister()
+			return value >> 8 if n == 4 else value & 0xFF
+		return self.r[n]
+	#
+	def setRegister(self,n,value):
+		value &= 0xFF
+		if n == 6:
+			self.write(self.address if self.address is not None else (self.r[4] << 8) | self.r[5],value)
+		elif self.index != 0 and self.address is None and (n == 4 or n == 5):
+			current = self.indexRegister()
+			self.setIndexRegister((value << 8) | (current & 0xFF) if n == 4 else (current & 0xFF00) | value)
+		else:
+			self.r[n] = value
+	#
+	#		Register pairs, 0-3 are BC DE HL SP, or AF instead of SP for push/pop.
+	#
+	def getPair(self,n,af = False):
+		if n == 2:
+			return self.indexRegister()
+		if n == 3:
+			return (self.r[7] << 8) | self.r[6] if af else self.sp
+		return (self.r[n*2] << 8) | self.r[n*2+1]
+	#
+	def setPair(self,n,value,af = False):
+		value &= 0xFFFF
+		if n == 2:
+			self.setIndexRegister(value)
+		elif n == 3:
+			if af:
+				self.r[7],self.r[6] = value >> 8,value & 0xFF
+			else:
+				self.sp = value
+		else:
+			self.r[n*2],self.r[n*2+1] = value >> 8,value & 0xFF
+	#
+	def push(self,value):
+		self.sp = (self.sp - 2) & 0xFFFF
+		self.writeWord(self.sp,value)
+	#
+	def pop(self):
+		value = self.readWord(self.sp)
+		self.sp = (self.sp + 2) & 0xFFFF
+		return value
+	#
+	#		Test condition 0-7, NZ Z NC C PO PE P M
+	#
+	def condition(self,n):
+		flag = [ FLAG_Z,FLAG_C,FLAG_PV,FLAG_S ][n >> 1]
+		return ((self.r[6] & flag) != 0) == ((n & 1) != 0)
+
+	# ***********************************************************************************
+	#								Arithmetic and logic
+	# ***********************************************************************************
+
+	def add8(self,a,value,carry = 0):
+		result = a + value + carry
+		self.r[6] = self.sz[result & 0xFF] | ((a ^ value ^ result) & FLAG_H) | \
+						(((a ^ ~value) & (a ^ result) & 0x80) >> 5) | (result >> 8)
+		return result & 0xFF
+	#
+	def sub8(self,a,value,carry = 0):
+		result = a - value - carry
+		self.r[6] = self.sz[result & 0xFF] | ((a ^ value ^ result) & FLAG_H) | \
+						(((a ^ value) & (a ^ result) & 0x80) >> 5) | FLAG_N | (FLAG_C if result < 0 else 0)
+		return result & 0xFF
+	#
+	def alu(self,operation,value):
+		a,carry = self.r[7],self.r[6] & FLAG_C
+		if operation == 0:
+			self.r[7] = self.add8(a,value)
+		elif operation == 1:
+			self.r[7] = self.add8(a,value,carry)
+		elif operation == 2:
+			self.r[7] = self.sub8(a,value)
+		elif operation == 3:
+			self.r[7] = self.sub8(a,value,carry)
+		elif operation == 4:
+			self.r[7] = a & value
+			self.r[6] = self.szp[self.r[7]] | FLAG_H
+		elif operation == 5:
+			self.r[7] = a ^ value
+			self.r[6] = self.szp[self.r[7]]
+		elif operation == 6:
+			self.r[7] = a | value
+			self.r[6] = self.szp[self.r[7]]
+		else:
+			self.sub8(a,value)
+	#
+	def inc8(self,value):
+		result = (value + 1) & 0xFF
+		self.r[6] = (self.r[6] & FLAG_C) | self.sz[result] | (FLAG_H if (value & 0x0F) == 0x0F else 0) | \
+						(FLAG_PV if value == 0x7F else 0)
+		return result
+	#
+	def dec8(self,value):
+		result = (value - 1) & 0xFF
+		self.r[6] = (self.r[6] & FLAG_C) | FLAG_N | self.sz[result] | (FLAG_H if (value & 0x0F) == 0 else 0) | \
+						(FLAG_PV if value == 0x80 else 0)
+		return result
+	#
+	def add16(self,a,value):
+		result = a + value
+		self.r[6] = (self.r[6] & (FLAG_S|FLAG_Z|FLAG_PV)) | (((a ^ value ^ result) >> 8) & FLAG_H) | (result >> 16)
+		return result & 0xFFFF
+	#
+	def adc16(self,a,value,subtract):
+		carry = self.r[6] & FLAG_C
+		result = a - value - carry if subtract else a + value + carry
+		overflow = ((a ^ value) & (a ^ result)) if subtract else ((a ^ ~value) & (a ^ result))
+		self.r[6] = ((result >> 8) & FLAG_S) | (FLAG_Z if result & 0xFFFF == 0 else 0) | \
+						(((a ^ value ^ result) >> 8) & FLAG_H) | ((overflow >> 13) & FLAG_PV) | \
+						(FLAG_N if subtract else 0) | (FLAG_C if result < 0 or result > 0xFFFF else 0)
+		return result & 0xFFFF
+	#
+	#		CB rotates and shifts 0-7, RLC RRC RL RR SLA SRA SLL SRL
+	#
+	def rotate(self,operation,value):
+		carry = self.r[6] & FLAG_C
+		if operation == 0:
+			result,carry = ((value << 1) | (value >> 7)),value >> 7
+		elif operation == 1:
+			result,carry = ((value >> 1) | (value << 7)),value & 1
+		elif operation == 2:
+			result,carry = (value << 1) | carry,value >> 7
+		elif operation == 3:
+			result,carry = (value >> 1) | (carry << 7),value & 1
+		elif operation == 4:
+			result,carry = value << 1,value >> 7
+		elif operation == 5:
+			result,carry = (value >> 1) | (value & 0x80),value & 1
+		elif operation == 6:
+			result,carry = (value << 1) | 1,value >> 7
+		else:
+			result,carry = value >> 1,value & 1
+		result &= 0xFF
+		self.r[6] = self.szp[result] | carry
+		return result
+	#
+	def daa(self):
+		a,f = self.r[7],self.r[6]
+		correction,carry = 0,f & FLAG_C
+		if (f & FLAG_H) or (a & 0x0F) > 9:
+			correction = 0x06
+		if carry or a > 0x99:
+			correction |= 0x60
+			carry = FLAG_C
+		if f & FLAG_N:
+			half = FLAG_H if (f & FLAG_H) and (a & 0x0F) < 6 else 0
+			a = (a - correction) & 0xFF
+		else:
+			half = FLAG_H if (a & 0x0F) > 9 else 0
+			a = (a + correction) & 0xFF
+		self.r[7] = a
+		self.r[6] = self.szp[a] | half | (f & FLAG_N) | carry
+
+	# ***********************************************************************************
+	#						Unprefixed (and DD/FD prefixed) opcodes
+	# ***********************************************************************************
+
+	#
+	#		Execute an opcode, returns False if a condition was not met.
+	#
+	def execute(self,opcode):
+		r = self.r
+		x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+		p,q = y >> 1,y & 1
+		if x == 1:															# LD r,r' and HALT
+			if opcode == 0x76:
+				self.halted = True
+				self.pc = (self.pc - 1) & 0xFFFF
+			else:
+				self.setRegister(y,self.getRegister(z))
+			return True
+		if x == 2:															# ALU A,r
+			self.alu(y,self.getRegister(z))
+			return True
+		if x == 0:
+			if z == 0:
+				if y == 0:													# NOP
+					pass
+				elif y == 1:												# EX AF,AF'
+					self.exchange([6,7])
+				elif y == 2:												# DJNZ
+					offset = self.fetchOffset()
+					r[0] = (r[0] - 1) & 0xFF
+					if r[0] == 0:
+						return False
+					self.pc = (self.pc + offset) & 0xFFFF
+				else:														# JR and JR cc
+					offset = self.fetchOffset()
+					if y >= 4 and not self.condition(y-4):
+						return False
+					self.pc = (self.pc + offset) & 0xFFFF
+			elif z == 1:
+				if q == 0:													# LD rr,nn
+					self.setPair(p,self.fetchWord())
+				else:														# ADD HL,rr
+					self.setPair(2,self.add16(self.getPair(2),self.getPair(p)))
+			elif z == 2:
+				if p < 2:													# LD (BC),A etc.
+					address = self.getPair(p)
+					if q == 0:
+						self.write(address,r[7])
+					else:
+						r[7] = self.read(address)
+				else:
+					address = self.fetchWord()
+					if p == 2:
+						if q == 0:
+							self.writeWord(address,self.getPair(2))
+						else:
+							self.setPair(2,self.readWord(address))
+					elif q == 0:
+						self.write(address,r[7])
+					else:
+						r[7] = self.read(address)
+			elif z == 3:													# INC rr DEC rr
+				self.setPair(p,self.getPair(p) + (1 if q == 0 else -1))
+			elif z == 4:
+				self.setRegister(y,self.inc8(self.getRegister(y)))
+			elif z == 5:
+				self.setRegister(y,self.dec8(self.getRegister(y)))
+			elif z == 6:
+				self.setRegister(y,self.fetch())
+			else:
+				a,f = r[7],r[6]
+				if y == 0:													# RLCA
+					r[7] = ((a << 1) | (a >> 7)) & 0xFF
+					r[6] = (f & (FLAG_S|FLAG_Z|FLAG_PV)) | (a >> 7)
+				elif y == 1:												# RRCA
+					r[7] = ((a >> 1) | (a << 7)) & 0xFF
+					r[6] = (f & (FLAG_S|FLAG_Z|FLAG_PV)) | (a & 1)
+				elif y == 2:												# RLA
+					r[7] = ((a << 1) | (f & FLAG_C)) & 0xFF
+					r[6] = (f & (FLAG_S|FLAG_Z|FLAG_PV)) | (a >> 7)
+				elif y == 3:												# RRA
+					r[7] = (a >> 1) | ((f & FLAG_C) << 7)
+					r[6] = (f & (FLAG_S|FLAG_Z|FLAG_PV)) | (a & 1)
+				elif y == 4:
+					self.daa()
+				elif y == 5:												# CPL
+					r[7] = a ^ 0xFF
+					r[6] = f | FLAG_H | FLAG_N
+				elif y == 6:												# SCF
+					r[6] = (f & (FLAG_S|FLAG_Z|FLAG_PV)) | FLAG_C
+				else:														# CCF
+					r[6] = ((f & (FLAG_S|FLAG_Z|FLAG_PV)) | ((f & FLAG_C) << 4)) ^ FLAG_C
+			return True
+		#
+		if z == 0:															# RET cc
+			if not self.condition(y):
+				return False
+			self.pc = self.pop()
+		elif z == 1:
+			if q == 0:														# POP rr
+				self.setPair(p,self.pop(),True)
+			elif p == 0:													# RET
+				self.pc = self.pop()
+			elif p == 1:													# EXX
+				self.exchange([0,1,2,3,4,5])
+			elif p == 2:													# JP (HL)
+				self.pc = self.getPair(2)
+			else:															# LD SP,HL
+				self.sp = self.getPair(2)
+		elif z == 2:														# JP cc,nn
+			address = self.fetchWord()
+			if self.condition(y):
+				self.pc = address
+		elif z == 3:
+			if y == 0:														# JP nn
+				self.pc = self.fetchWord()
+			elif y == 2:													# OUT (n),A
+				self.output((r[7] << 8) | self.fetch(),r[7])
+			elif y == 3:													# IN A,(n)
+				r[7] = self.input((r[7] << 8) | self.fetch())
+			elif y == 4:													# EX (SP),HL
+				value = self.readWord(self.sp)
+				self.writeWord(self.sp,self.getPair(2))
+				self.setPair(2,value)
+			elif y == 5:													# EX DE,HL
+				r[2],r[3],r[4],r[5] = r[4],r[5],r[2],r[3]
+			else:															# DI EI
+				self.iff = y == 7
+		elif z == 4:														# CALL cc,nn
+			address = self.fetchWord()
+			if not self.condition(y):
+				return False
+			self.push(self.pc)
+			self.pc = address
+		elif z == 5:
+			if q == 0:														# PUSH rr
+				self.push(self.getPair(p,True))
+			else:															# CALL nn
+				address = self.fetchWord()
+				self.push(self.pc)
+				self.pc = address
+		elif z == 6:														# ALU A,n
+			self.alu(y,self.fetch())
+		else:																# RST
+			self.push(self.pc)
+			self.pc = y * 8
+		return True
+	#
+	#		Swap registers with the alternate set.
+	#
+	def exchange(self,registers):
+		for n in registers:
+			self.r[n],self.alternate[n] = self.alternate[n],self.r[n]
+
+	# ***********************************************************************************
+	#						CB opcodes, and DD CB / FD CB if address given
+	# ***********************************************************************************
+
+	def bitInstruction(self,opcode,address):
+		x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+		self.index = 0
+		self.address = address
+		value = self.getRegister(6 if address is not None else z)
+		if x == 1:															# BIT
+			self.r[6] = (self.r[6] & FLAG_C) | FLAG_H | (self.sz[value & (1 << y)] & FLAG_S) | \
+							((FLAG_Z|FLAG_PV) if value & (1 << y) == 0 else 0)
+		else:
+			if x == 0:
+				value = self.rotate(y,value)
+			elif x == 2:
+				value &= ~(1 << y)
+			else:
+				value |= (1 << y)
+			if address is not None:											# (ix+d), copied to register too
+				self.setRegister(6,value)
+				self.address = None
+				if z != 6:
+					self.r[z] = value & 0xFF
+			else:
+				self.setRegister(z,value)
+		return (self.tIndexBit if address is not None else self.tBit)[opcode][0]
+
+	# ***********************************************************************************
+	#								ED opcodes, with Z80N
+	# ***********************************************************************************
+
+	def extendedInstruction(self,opcode):
+		r = self.r
+		self.index = 0
+		self.address = None
+		timing = self.tExtended[opcode]
+		if timing is None:													# undefined, does nothing
+			return 8
+		x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+		p,q = y >> 1,y & 1
+		if x == 1:
+			if z == 0:														# IN r,(C)
+				value = self.input(self.getPair(0))
+				r[6] = (r[6] & FLAG_C) | self.szp[value]
+				if y != 6:
+					r[y] = value
+			elif z == 1:													# OUT (C),r
+				self.output(self.getPair(0),0 if y == 6 else r[y])
+			elif z == 2:													# SBC HL,rr ADC HL,rr
+				self.setPair(2,self.adc16(self.getPair(2),self.getPair(p),q == 0))
+			elif z == 3:													# LD (nn),rr LD rr,(nn)
+				address = self.fetchWord()
+				if q == 0:
+					self.writeWord(address,self.getPair(p))
+				else:
+					self.setPair(p,self.readWord(address))
+			elif z == 4:													# NEG
+				r[7] = self.sub8(0,r[7])
+			elif z == 5:													# RETN RETI
+				self.pc = self.pop()
+			elif z == 6:													# IM n
+				pass
+			elif y < 4:														# LD I,A LD R,A LD A,I LD A,R
+				if y == 0:
+					self.i = r[7]
+				elif y == 1:
+					self.refresh = r[7]
+				else:
+					r[7] = self.i if y == 2 else self.refresh
+					r[6] = (r[6] & FLAG_C) | self.sz[r[7]] | (FLAG_PV if self.iff else 0)
+			elif y < 6:														# RRD RLD
+				address = self.getPair(2)
+				value = self.read(address)
+				if y == 4:
+					self.write(address,((r[7] << 4) | (value >> 4)))
+					r[7] = (r[7] & 0xF0) | (value & 0x0F)
+				else:
+					self.write(address,((value << 4) | (r[7] & 0x0F)))
+					r[7] = (r[7] & 0xF0) | (value >> 4)
+				r[6] = (r[6] & FLAG_C) | self.szp[r[7]]
+			return timing[0]
+		if x == 2 and y >= 4 and z <= 3:
+			return timing[0] if self.blockInstruction(y,z) else timing[1]
+		return timing[0] if self.nextInstruction(opcode) else timing[1]
+	#
+	#		Block instructions. y is 4-7 for I D IR DR, z is LD CP IN OUT. Returns
+	#		True if it repeats.
+	#
+	def blockInstruction(self,y,z):
+		r = self.r
+		step = 1 if (y & 1) == 0 else -1
+		hl,de = self.getPair(2),self.getPair(1)
+		count = (self.getPair(0) - 1) & 0xFFFF
+		if z == 0:															# LDI LDD LDIR LDDR
+			self.write(de,self.read(hl))
+			self.setPair(1,de + step)
+			self.setPair(0,count)
+			r[6] = (r[6] & (FLAG_S|FLAG_Z|FLAG_C)) | (FLAG_PV if count != 0 else 0)
+			repeat = count != 0
+		elif z == 1:														# CPI CPD CPIR CPDR
+			value = self.read(hl)
+			result = (r[7] - value) & 0xFF
+			self.setPair(0,count)
+			r[6] = (r[6] & FLAG_C) | self.sz[result] | ((r[7] ^ value ^ result) & FLAG_H) | FLAG_N | \
+						(FLAG_PV if count != 0 else 0)
+			repeat = count != 0 and result != 0
+		else:																# INI OUTI etc. count in B
+			r[0] = (r[0] - 1) & 0xFF
+			if z == 2:
+				self.write(hl,self.input(self.getPair(0)))
+			else:
+				self.output(self.getPair(0),self.read(hl))
+			r[6] = FLAG_N | (FLAG_Z if r[0] == 0 else 0)
+			repeat = r[0] != 0
+		self.setPair(2,hl + step)
+		repeat = repeat and y >= 6
+		if repeat:
+			self.pc = (self.pc - 2) & 0xFFFF
+		return repeat
+	#
+	#		Z80N opcodes. Returns True unless a repeat did not repeat.
+	#
+	def nextInstruction(self,opcode):
+		r = self.r
+		if opcode == 0x23:													# SWAPNIB
+			r[7] = ((r[7] << 4) | (r[7] >> 4)) & 0xFF
+		elif opcode == 0x24:												# MIRROR A
+			r[7] = int("{0:08b}".format(r[7])[::-1],2)
+		elif opcode == 0x27:												# TEST n
+			value = r[7] & self.fetch()
+			r[6] = self.szp[value] | FLAG_H
+		elif opcode >= 0x28 and opcode <= 0x2C:								# barrel shifts of DE by B
+			de,count = self.getPair(1),r[0] & 0x1F
+			if opcode == 0x28:
+				de = de << count
+			elif opcode == 0x29:
+				de = (de - 0x10000 if de & 0x8000 else de) >> count
+			elif opcode == 0x2A:
+				de = de >> count
+			elif opcode == 0x2B:
+				de = ((de | ~0xFFFF) >> count)
+			else:
+				count &= 15
+				de = (de << count) | (de >> (16 - count))
+			self.setPair(1,de)
+		elif opcode == 0x30:												# MUL D,E
+			self.setPair(1,r[2] * r[3])
+		elif opcode >= 0x31 and opcode <= 0x33:								# ADD rr,A
+			pair = [2,1,0][opcode - 0x31]
+			self.setPair(pair,self.getPair(pair) + r[7])
+		elif opcode >= 0x34 and opcode <= 0x36:								# ADD rr,nn
+			pair = [2,1,0][opcode - 0x34]
+			self.setPair(pair,self.getPair(pair) + self.fetchWord())
+		elif opcode == 0x8A:												# PUSH nn, which is big endian
+			high = self.fetch()
+			self.push((high << 8) | self.fetch())
+		elif opcode == 0x90:												# OUTINB
+			self.output(self.getPair(0),self.read(self.getPair(2)))
+			self.setPair(2,self.getPair(2) + 1)
+		elif opcode == 0x91:												# NEXTREG n,n
+			register = self.fetch()
+			self.nextRegister(register,self.fetch())
+		elif opcode == 0x92:												# NEXTREG n,A
+			self.nextRegister(self.fetch(),r[7])
+		elif opcode == 0x93 or opcode == 0x94 or opcode == 0x95:			# screen helpers
+			self.screenInstruction(opcode)
+		elif opcode == 0x98:												# JP (C)
+			self.pc = (self.pc & 0xC000) | (self.input(self.getPair(0)) << 6)
+		elif opcode in [0xA4,0xAC,0xB4,0xBC,0xB7]:							# LDIX LDDX LDIRX LDDRX LDPIRX
+			return self.transferInstruction(opcode)
+		elif opcode == 0xA5:												# LDWS
+			value = self.read(self.getPair(2))
+			self.write(self.getPair(1),value)
+			r[5] = (r[5] + 1) & 0xFF
+			r[2] = self.inc8(r[2])
+		return True
+	#
+	#		LDIX and friends, which do not copy bytes equal to A.
+	#
+	def transferInstruction(self,opcode):
+		r = self.r
+		hl,de = self.getPair(2),self.getPair(1)
+		if opcode == 0xB7:													# LDPIRX, pattern from 8 byte block
+			value = self.read((hl & 0xFFF8) | (de & 7))
+		else:
+			value = self.read(hl)
+		if value != r[7]:
+			self.write(de,value)
+		step = -1 if opcode == 0xAC or opcode == 0xBC else 1
+		if opcode != 0xB7:
+			self.setPair(2,hl + step)
+		self.setPair(1,de + 1)
+		count = (self.getPair(0) - 1) & 0xFFFF
+		self.setPair(0,count)
+		if opcode in [0xB4,0xBC,0xB7] and count != 0:
+			self.pc = (self.pc - 2) & 0xFFFF
+			return True
+		return opcode in [0xA4,0xAC]
+	#
+	#		PIXELDN PIXELAD SETAE, for the Spectrum screen layout.
+	#
+	def screenInstruction(self,opcode):
+		r = self.r
+		if opcode == 0x93:
+			hl = self.getPair(2)
+			if (hl & 0x0700) != 0x0700:
+				hl += 0x100
+			elif (hl & 0xE0) != 0xE0:
+				hl = (hl & 0xF8FF) + 0x20
+			else:
+				hl = (hl & 0xF81F) + 0x800
+			self.setPair(2,hl)
+		elif opcode == 0x94:
+			d,e = r[2],r[3]
+			self.setPair(2,0x4000 | ((d & 0xC0) << 5) | ((d & 0x07) << 8) | ((d & 0x38) << 2) | (e >> 3))
+		else:
+			r[7] = 0x80 >> (r[3] & 7)
+	#
+	#		Ports and Next registers. The MMU registers change the memory mapping.
+	#
+	def input(self,port):
+		if port == 0x253B:
+			if self.nextRegisterSelect >= 0x50 and self.nextRegisterSelect <= 0x57:
+				return self.mmu[self.nextRegisterSelect - 0x50]				# however it was set
+			return self.nextRegisters.get(self.nextRegisterSelect,0)
+		return 0xFF
+	#
+	def output(self,port,value):
+		if port == 0x243B:
+			self.nextRegisterSelect = value
+		elif port == 0x253B:
+			self.nextRegister(self.nextRegisterSelect,value)
+		elif (port & 0xFF) == 0x6B:
+			self.cycles += self.dma.write(value)							# the bus is the DMA's while it runs
+	#
+	def nextRegister(self,register,value):
+		self.nextRegisters[register] = value
+		if register >= 0x50 and register <= 0x57:
+			self.setMMU(register - 0x50,value)
+
+# ***************************************************************************************
+#
+#		The zxnDMA, in its zxn mode at port $6B, which transfers exactly the block
+#		length. Writes program the registers WR0-WR6, each byte's following bytes
+#		being decoded as they arrive. Only what a memory or port transfer needs is
+#		kept, interrupts and the mask and match bytes are read and ignored. When the
+#		DMA is enabled after a load, the whole block is transferred at once.
+#
+#		A byte takes the cycle length of each port, 2 3 or 4 T-states, from its
+#		timing byte, 3 if not given. The Z80 is stopped meanwhile, so write()
+#		returns those T-states.
+#
+# ***************************************************************************************
+
+class ZXNDMA(object):
+	def __init__(self,machine):
+		self.machine = machine
+		self.following = []													# fields for the next bytes
+		self.ports = [[0,1,False,3],[0,1,False,3]]							# A,B: address,step,io,cycles
+		self.length = 0
+		self.aToB = True
+		self.loaded = None 													# (source,target) port when loaded
+	#
+	#		Write a byte to the DMA, returns the T-states of any transfer it starts.
+	#
+	def write(self,value):
+		if len(self.following) > 0:											# a byte following a register
+			field = self.following.pop(0)
+			if field[0] == "timing":
+				self.ports[field[1]][3] = { 0:4,1:3,2:2 }.get(value & 3,4)
+				if value & 0x20:											# prescalar follows
+					self.following.insert(0,("ignore",))
+			elif field[0] == "address":
+				port = self.ports[field[1]]
+				port[0] = (port[0] & ~(0xFF << field[2]) | (value << field[2])) & 0xFFFF
+			elif field[0] == "length":
+				self.length = (self.length & ~(0xFF << field[1]) | (value << field[1])) & 0xFFFF
+			return 0
+		if value & 0x80 == 0:
+			if value & 3 != 0:												# WR0 direction, port A, length
+				self.aToB = (value & 4) != 0
+				self.following = [f for bit,f in [(8,("address",0,0)),(16,("address",0,8)),(32,("length",0)),(64,("length",8))] if value & bit]
+			elif value & 7 == 4 or value & 7 == 0:							# WR1 port A, WR2 port B
+				n = 0 if value & 7 == 4 else 1
+				self.ports[n][1] = { 0:-1,0x10:1 }.get(value & 0x30,0)		# decrement, increment, fixed
+				self.ports[n][2] = (value & 8) != 0
+				if value & 0x40:
+					self.following = [("timing",n)]
+		elif value & 3 == 0:												# WR3 mask and match
+			self.following = [("ignore",)] * (((value >> 3) & 1)+((value >> 4) & 1))
+		elif value & 3 == 1:												# WR4 mode, port B
+			self.following = [f for bit,f in [(4,("address",1,0)),(8,("address",1,8)),(16,("ignore",))] if value & bit]
+		elif value & 3 == 3:												# WR6 commands
+			if value == 0xCF:												# load
+				self.loaded = (0,1) if self.aToB else (1,0)
+			elif value == 0x87 and self.loaded is not None:					# enable
+				return self.transfer()
+			elif value == 0xBB:												# read mask follows
+				self.following = [("ignore",)]
+		return 0
+	#
+	#		Transfer the block, returning the T-states it took.
+	#
+	def transfer(self):
+		source,target = [list(self.ports[n]) for n in self.loaded]
+		self.loaded = None
+		for i in range(0,self.length):
+			value = self.machine.input(source[0]) if source[2] else self.machine.read(source[0])
+			if target[2]:
+				self.machine.output(target[0],value)
+			else:
+				self.machine.write(target[0],value)
+			source[0] = (source[0]+source[1]) & 0xFFFF
+			target[0] = (target[0]+target[1]) & 0xFFFF
+		return self.length * (source[3]+target[3])
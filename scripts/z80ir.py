@@ -0,0 +1,116 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		z80ir.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		26th January 2019
+#		Purpose :	Z80 instructions as used by the code generator.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+# ***************************************************************************************
+#
+#		An instruction is a tuple (mnemonic,operand), the operand is None if there
+#		isn't one. The table gives the opcode bytes, the operand size in bytes and
+#		the T-states for each mnemonic (taken, for conditional jumps and returns).
+#		nextreg n,n has the register in the low byte of the operand, the value in
+#		the high byte.
+#
+# ***************************************************************************************
+
+Z80INSTRUCTIONS = {
+	"ld hl,nn":		([0x21],2,10),		"ld hl,(nn)":	([0x2A],2,16),		"ld (nn),hl":	([0x22],2,16),
+	"ld de,nn":		([0x11],2,10),		"ld de,(nn)":	([0xED,0x5B],2,20),	"ld (nn),de":	([0xED,0x53],2,20),
+	"ld bc,nn":		([0x01],2,10),		"ld bc,(nn)":	([0xED,0x4B],2,20),	"ld (nn),bc":	([0xED,0x43],2,20),
+	"ld ix,nn":		([0xDD,0x21],2,14),	"ld ix,(nn)":	([0xDD,0x2A],2,20),	"ld (nn),ix":	([0xDD,0x22],2,20),
+	"push hl":		([0xE5],0,11),		"pop hl":		([0xE1],0,10),		"pop de":		([0xD1],0,10),
+	"push de":		([0xD5],0,11),		"ex de,hl":		([0xEB],0,4),
+	"ld (hl),e":	([0x73],0,7),		"ld (hl),d":	([0x72],0,7),		"ld a,(hl)":	([0x7E],0,7),
+	"ld l,(hl)":	([0x6E],0,7),		"ld h,(hl)":	([0x66],0,7),		"ld h,n":		([0x26],1,7),
+	"inc hl":		([0x23],0,6),		"dec hl":		([0x2B],0,6),
+	"ld l,a":		([0x6F],0,4),		"ld a,h":		([0x7C],0,4),		"ld h,a":		([0x67],0,4),
+	"ld a,l":		([0x7D],0,4),		"and b":		([0xA0],0,4),		"and c":		([0xA1],0,4),
+	"or b":			([0xB0],0,4),		"or c":			([0xB1],0,4),		"or l":			([0xB5],0,4),
+	"xor b":		([0xA8],0,4),		"xor c":		([0xA9],0,4),		"xor a":		([0xAF],0,4),
+	"add hl,hl":	([0x29],0,11),		"srl h":		([0xCB,0x3C],0,8),	"rr l":			([0xCB,0x1D],0,8),
+	"ld h,l":		([0x65],0,4),		"ld l,h":		([0x6C],0,4),		"ld l,n":		([0x2E],1,7),
+	"add hl,bc":	([0x09],0,11),		"sbc hl,bc":	([0xED,0x42],0,15),	"bit 7,h":		([0xCB,0x7C],0,8),
+	"jp nn":		([0xC3],2,10),		"jp z,nn":		([0xCA],2,10),		"jp nz,nn":		([0xC2],2,10),
+	"jr e":			([0x18],1,12),		"jr z,e":		([0x28],1,12),		"jr nz,e":		([0x20],1,12),
+	"call nn":		([0xCD],2,17),		"ret":			([0xC9],0,10),		"ret z":		([0xC8],0,11),
+	"ret nz":		([0xC0],0,11),		"djnz e":		([0x10],1,13),		"dec b":		([0x05],0,4),
+	"ld b,n":		([0x06],1,7),		"ld b,h":		([0x44],0,4),		"ld c,l":		([0x4D],0,4),
+	"dec bc":		([0x0B],0,6),		"ld a,b":		([0x78],0,4),		"ld l,b":		([0x68],0,4),
+	"dec l":		([0x2D],0,4),		"push bc":		([0xC5],0,11),		"pop bc":		([0xC1],0,10),
+	"add hl,de":	([0x19],0,11),		"sbc hl,de":	([0xED,0x52],0,15),
+	"and d":		([0xA2],0,4),		"and e":		([0xA3],0,4),		"or d":			([0xB2],0,4),
+	"or e":			([0xB3],0,4),		"xor d":		([0xAA],0,4),		"xor e":		([0xAB],0,4),
+	"push af":		([0xF5],0,11),		"pop af":		([0xF1],0,10),		"ld a,n":		([0x3E],1,7),
+	"inc a":		([0x3C],0,4),		"inc b":		([0x04],0,4),		"out (c),a":	([0xED,0x79],0,12),
+	"in a,(c)":		([0xED,0x78],0,12),	"nextreg n,a":	([0xED,0x92],1,17),	"nextreg n,n":	([0xED,0x91],2,20),
+	"cp n":			([0xFE],1,7),		"jr nc,e":		([0x30],1,12),		"ld c,a":		([0x4F],0,4),
+	"inc bc":		([0x03],0,6),		"ldir":			([0xED,0xB0],0,21),	"and n":		([0xE6],1,7),
+	"add a,n":		([0xC6],1,7),		"or h":			([0xB4],0,4),		"ld a,e":		([0x7B],0,4),
+	"sub l":		([0x95],0,4),		"ld a,d":		([0x7A],0,4),		"sbc a,h":		([0x9C],0,4),
+	"mul d,e":		([0xED,0x30],0,8),	"sla e":		([0xCB,0x23],0,8),	"rl d":			([0xCB,0x12],0,8),
+	"adc hl,hl":	([0xED,0x6A],0,15),	"jr c,e":		([0x38],1,12),		"and a":		([0xA7],0,4),
+	"inc e":		([0x1C],0,4),		"dec a":		([0x3D],0,4),		"ld e,l":		([0x5D],0,4),
+	"ld d,h":		([0x54],0,4),		"ld e,c":		([0x59],0,4),		"ld d,b":		([0x50],0,4),
+	"ld b,l":		([0x45],0,4),		"ld c,e":		([0x4B],0,4),		"ld b,d":		([0x42],0,4),
+	"ld l,e":		([0x6B],0,4),		"add a,e":		([0x83],0,4),		"add a,d":		([0x82],0,4),
+	"or a":			([0xB7],0,4),		"ld d,e":		([0x53],0,4),		"ld e,n":		([0x1E],1,7),
+	"ld h,b":		([0x60],0,4),		"ld l,c":		([0x69],0,4),		"push ix":		([0xDD,0xE5],0,15),
+	"ldi":			([0xED,0xA0],0,16),	"lddr":			([0xED,0xB8],0,21),	"cpi":			([0xED,0xA1],0,16),
+	"otir":			([0xED,0xB3],0,21),	"ld a,(de)":	([0x1A],0,7),		"inc de":		([0x13],0,6),
+	"jp pe,nn":		([0xEA],2,10),		"scf":			([0x37],0,4),		"ld b,(hl)":	([0x46],0,7),
+	"ld c,(hl)":	([0x4E],0,7),		"ld (hl),b":	([0x70],0,7),		"ld (hl),c":	([0x71],0,7),
+	"jp nc,nn":		([0xD2],2,10),
+}
+
+DATASIZES = { "db":1,"dw":2 }											# data in routines
+
+#
+#		Encode an instruction as a list of bytes
+#
+def encodeInstruction(instruction):
+	opcode,operandSize,tStates = Z80INSTRUCTIONS[instruction[0]]
+	if operandSize == 0:
+		return opcode
+	if operandSize == 1:
+		return opcode+[instruction[1] & 0xFF]
+	return opcode+[instruction[1] & 0xFF,(instruction[1] >> 8) & 0xFF]
+#
+#		Size and timing of an instruction or list of instructions
+#
+def instructionSize(instructions):
+	return sum(len(Z80INSTRUCTIONS[i[0]][0])+Z80INSTRUCTIONS[i[0]][1] for i in instructions)
+
+def instructionTime(instructions):
+	return sum(Z80INSTRUCTIONS[i[0]][2] for i in instructions)
+
+#
+#		Assemble a routine at an address. The routine is a list of instructions and
+#		("label",name), jump and call operands can be label names. ("db",n) and
+#		("dw",nn) are data. Returns the bytes and the address of each label.
+#
+def assembleCode(code,address):
+	labels = {}
+	pc = address
+	for mnemonic,operand in code:
+		if mnemonic == "label":
+			labels[operand] = pc
+		else:
+			pc += DATASIZES[mnemonic] if mnemonic in DATASIZES else instructionSize([(mnemonic,operand)])
+	data = []
+	for mnemonic,operand in code:
+		if mnemonic != "label":
+			if type(operand) == str:										# to a label
+				operand = labels[operand]
+				if mnemonic.startswith("jr ") or mnemonic.startswith("djnz "):	# relative jump
+					operand -= address+len(data)+instructionSize([(mnemonic,operand)])
+			if mnemonic in DATASIZES:
+				data += [operand & 0xFF,(operand >> 8) & 0xFF][:DATASIZES[mnemonic]]
+			else:
+				data += encodeInstruction((mnemonic,operand))
+	return bytes(data),labels
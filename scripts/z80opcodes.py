@@ -0,0 +1,237 @@
+# ***************************************************************************************
+# ***************************************************************************************
+#
+#		Name : 		z80opcodes.py
+#		Author :	Paul Robson (paul@robsons.org.uk)
+#		Date : 		28th January 2019
+#		Purpose :	Size and timing of every Z80 opcode, with the Z80N extensions.
+#
+# ***************************************************************************************
+# ***************************************************************************************
+
+from z80ir import *
+
+# ***************************************************************************************
+#
+#		The table is keyed on the opcode bytes, which is the prefixes and opcode, with
+#		DD CB d op and FD CB d op keyed as (DD,CB,op). Each entry is the mnemonic, the
+#		total size in bytes, the T-states, and the T-states for conditional jumps,
+#		calls, returns and repeats when not taken. It covers the opcodes listed in
+#		documents/z80oplist.txt, including the undocumented ones, and the extra
+#		opcodes of the Z80N in the Spectrum Next.
+#
+#		Operands are named as in z80ir, nn is a word, n a byte, e a relative offset
+#		and d an index displacement.
+#
+# ***************************************************************************************
+
+REGISTERS = [ "b","c","d","e","h","l","(hl)","a" ]
+PAIRS = [ "bc","de","hl","sp" ]
+PAIRS2 = [ "bc","de","hl","af" ]
+CONDITIONS = [ "nz","z","nc","c","po","pe","p","m" ]
+ALU = [ "add a,","adc a,","sub ","sbc a,","and ","xor ","or ","cp " ]
+ROTATES = [ "rlc","rrc","rl","rr","sla","sra","sll","srl" ]
+
+Z80NOPCODES = {
+	(0xED,0x23):("swapnib",2,8,8),			(0xED,0x24):("mirror a",2,8,8),
+	(0xED,0x27):("test n",3,11,11),			(0xED,0x28):("bsla de,b",2,8,8),
+	(0xED,0x29):("bsra de,b",2,8,8),		(0xED,0x2A):("bsrl de,b",2,8,8),
+	(0xED,0x2B):("bsrf de,b",2,8,8),		(0xED,0x2C):("brlc de,b",2,8,8),
+	(0xED,0x30):("mul d,e",2,8,8),			(0xED,0x31):("add hl,a",2,8,8),
+	(0xED,0x32):("add de,a",2,8,8),			(0xED,0x33):("add bc,a",2,8,8),
+	(0xED,0x34):("add hl,nn",4,16,16),		(0xED,0x35):("add de,nn",4,16,16),
+	(0xED,0x36):("add bc,nn",4,16,16),		(0xED,0x8A):("push nn",4,23,23),
+	(0xED,0x90):("outinb",2,16,16),			(0xED,0x91):("nextreg n,n",4,20,20),
+	(0xED,0x92):("nextreg n,a",3,17,17),	(0xED,0x93):("pixeldn",2,8,8),
+	(0xED,0x94):("pixelad",2,8,8),			(0xED,0x95):("setae",2,8,8),
+	(0xED,0x98):("jp (c)",2,13,13),			(0xED,0xA4):("ldix",2,16,16),
+	(0xED,0xA5):("ldws",2,14,14),			(0xED,0xAC):("lddx",2,16,16),
+	(0xED,0xB4):("ldirx",2,21,16),			(0xED,0xB7):("ldpirx",2,21,16),
+	(0xED,0xBC):("lddrx",2,21,16),
+}
+
+# ***************************************************************************************
+#
+#		Build the table. The unprefixed opcodes are built three times, for HL, IX
+#		and IY, keeping those which the index prefix changes.
+#
+# ***************************************************************************************
+
+def buildOpcodeTable(z80n = True):
+	table = {}
+	for prefix,index in [ ((),"hl"),((0xDD,),"ix"),((0xFD,),"iy") ]:
+		for opcode in range(0,256):
+			entry = unprefixedOpcode(opcode,index)
+			if entry is not None:
+				table[prefix+(opcode,)] = entry
+		for opcode in range(0,256):
+			table[prefix+(0xCB,opcode)] = bitOpcode(opcode,index)
+	for opcode in range(0,256):
+		entry = extendedOpcode(opcode)
+		if entry is not None:
+			table[(0xED,opcode)] = entry
+	if z80n:
+		table.update(Z80NOPCODES)
+	return table
+
+#
+#		Unprefixed opcode, or DD/FD prefixed if index is ix or iy. Returns None if
+#		there is no such opcode or the prefix makes no difference.
+#
+def unprefixedOpcode(opcode,index):
+	x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+	p,q = y >> 1,y & 1
+	usesPair = usesMemory = usesHalf = False
+	size,tNot = 1,None
+	if x == 0:
+		if z == 0:
+			mnemonic,size,t,tNot = [ ("nop",1,4,4),("ex af,af'",1,4,4),("djnz e",2,13,8),("jr e",2,12,12) ][y] if y < 4 else \
+									("jr "+CONDITIONS[y-4]+",e",2,12,7)
+		elif z == 1:
+			mnemonic,size,t = ("ld "+PAIRS[p]+",nn",3,10) if q == 0 else ("add hl,"+PAIRS[p],1,11)
+			usesPair = p == 2 or q == 1
+		elif z == 2:
+			mnemonic,size,t = [ ("ld (bc),a",1,7),("ld a,(bc)",1,7),("ld (de),a",1,7),("ld a,(de)",1,7),
+								("ld (nn),hl",3,16),("ld hl,(nn)",3,16),("ld (nn),a",3,13),("ld a,(nn)",3,13) ][y]
+			usesPair = p == 2
+		elif z == 3:
+			mnemonic,t = ("inc " if q == 0 else "dec ")+PAIRS[p],6
+			usesPair = p == 2
+		elif z == 4 or z == 5:
+			mnemonic,t = ("inc " if z == 4 else "dec ")+REGISTERS[y],11 if y == 6 else 4
+			usesMemory,usesHalf = y == 6,y == 4 or y == 5
+		elif z == 6:
+			mnemonic,size,t = "ld "+REGISTERS[y]+",n",2,10 if y == 6 else 7
+			usesMemory,usesHalf = y == 6,y == 4 or y == 5
+		else:
+			mnemonic,t = [ "rlca","rrca","rla","rra","daa","cpl","scf","ccf" ][y],4
+	elif x == 1:
+		if opcode == 0x76:
+			mnemonic,t = "halt",4
+		else:
+			mnemonic,t = "ld "+REGISTERS[y]+","+REGISTERS[z],7 if y == 6 or z == 6 else 4
+			usesMemory = y == 6 or z == 6
+			usesHalf = not usesMemory and (y in [4,5] or z in [4,5])
+	elif x == 2:
+		mnemonic,t = ALU[y]+REGISTERS[z],7 if z == 6 else 4
+		usesMemory,usesHalf = z == 6,z == 4 or z == 5
+	else:
+		if z == 0:
+			mnemonic,t,tNot = "ret "+CONDITIONS[y],11,5
+		elif z == 1:
+			if q == 0:
+				mnemonic,t = "pop "+PAIRS2[p],10
+				usesPair = p == 2
+			else:
+				mnemonic,t = [ ("ret",10),("exx",4),("jp (hl)",4),("ld sp,hl",6) ][p]
+				usesPair = p >= 2
+		elif z == 2:
+			mnemonic,size,t = "jp "+CONDITIONS[y]+",nn",3,10
+		elif z == 3:
+			if y == 1:														# CB prefix
+				return None
+			mnemonic,size,t = [ ("jp nn",3,10),None,("out (n),a",2,11),("in a,(n)",2,11),
+								("ex (sp),hl",1,19),("ex de,hl",1,4),("di",1,4),("ei",1,4) ][y]
+			usesPair = y == 4
+		elif z == 4:
+			mnemonic,size,t,tNot = "call "+CONDITIONS[y]+",nn",3,17,10
+		elif z == 5:
+			if q == 0:
+				mnemonic,t = "push "+PAIRS2[p],11
+				usesPair = p == 2
+			elif p == 0:
+				mnemonic,size,t = "call nn",3,17
+			else:															# DD ED FD prefixes
+				return None
+		elif z == 6:
+			mnemonic,size,t = ALU[y]+"n",2,7
+		else:
+			mnemonic,t = "rst {0:02x}h".format(y*8),11
+	tNot = t if tNot is None else tNot
+	if index == "hl":
+		return (mnemonic,size,t,tNot)
+	if usesMemory:															# (hl) becomes (ix+d)
+		t = t + (9 if opcode == 0x36 else 12)
+		return (mnemonic.replace("(hl)","("+index+"+d)"),size+2,t,t)
+	if usesPair:															# hl becomes ix
+		return (mnemonic.replace("hl",index),size+1,t+4,t+4)
+	if usesHalf:															# h and l become ixh ixl
+		operands = mnemonic.split(" ",1)
+		operands[1] = ",".join(index+r if r in ["h","l"] else r for r in operands[1].split(","))
+		return (" ".join(operands),size+1,t+4,t+4)
+	return None
+
+#
+#		CB opcodes, or DD CB d op and FD CB d op if index is ix or iy.
+#
+def bitOpcode(opcode,index):
+	x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+	operation = ROTATES[y]+" " if x == 0 else [ None,"bit ","res ","set " ][x]+str(y)+","
+	if index == "hl":
+		t = (12 if x == 1 else 15) if z == 6 else 8
+		return (operation+REGISTERS[z],2,t,t)
+	t = 20 if x == 1 else 23												# always work on (ix+d)
+	mnemonic = operation+"("+index+"+d)"
+	if z != 6 and x != 1:													# result copied to register
+		mnemonic = mnemonic+"->"+REGISTERS[z]
+	return (mnemonic,4,t,t)
+
+#
+#		ED opcodes, None if the opcode is not defined.
+#
+def extendedOpcode(opcode):
+	x,y,z = opcode >> 6,(opcode >> 3) & 7,opcode & 7
+	p,q = y >> 1,y & 1
+	if x == 1:
+		if z == 0:
+			return ("in "+("f" if y == 6 else REGISTERS[y])+",(c)",2,12,12)
+		if z == 1:
+			return ("out (c),"+("0" if y == 6 else REGISTERS[y]),2,12,12)
+		if z == 2:
+			return (("sbc" if q == 0 else "adc")+" hl,"+PAIRS[p],2,15,15)
+		if z == 3:
+			return ("ld (nn),"+PAIRS[p] if q == 0 else "ld "+PAIRS[p]+",(nn)",4,20,20)
+		if z == 4:
+			return ("neg",2,8,8)
+		if z == 5:
+			return ("reti" if y == 1 else "retn",2,14,14)
+		if z == 6:
+			return ("im "+"00120012"[y],2,8,8)
+		return [ ("ld i,a",2,9,9),("ld r,a",2,9,9),("ld a,i",2,9,9),("ld a,r",2,9,9),
+				 ("rrd",2,18,18),("rld",2,18,18),("nop",2,8,8),("nop",2,8,8) ][y]
+	if x == 2 and z <= 3 and y >= 4:
+		mnemonic = [ [ "ldi","cpi","ini","outi" ],[ "ldd","cpd","ind","outd" ],
+					 [ "ldir","cpir","inir","otir" ],[ "lddr","cpdr","indr","otdr" ] ][y-4][z]
+		return (mnemonic,2,21,16) if y >= 6 else (mnemonic,2,16,16)
+	return None
+
+Z80OPCODES = buildOpcodeTable()
+
+#
+#		Decode the instruction at an address, read(address) returns a byte. Returns
+#		the table entry. An unknown opcode raises KeyError.
+#
+def decodeInstruction(read,address):
+	opcode = read(address)
+	if opcode == 0xDD or opcode == 0xFD:
+		second = read(address+1)
+		key = (opcode,0xCB,read(address+3)) if second == 0xCB else (opcode,second)
+		if key not in Z80OPCODES:											# prefix does nothing
+			return ("nop*",1,4,4)
+	elif opcode == 0xCB or opcode == 0xED:
+		key = (opcode,read(address+1))
+	else:
+		key = (opcode,)
+	return Z80OPCODES[key]
+
+# ***************************************************************************************
+#		Check the table agrees with the instructions the code generator uses.
+# ***************************************************************************************
+
+if __name__ == "__main__":
+	print("{0} opcodes".format(len(Z80OPCODES)))
+	for mnemonic in sorted(Z80INSTRUCTIONS.keys()):
+		code = encodeInstruction((mnemonic,0))
+		entry = decodeInstruction(lambda a: code[a],0)
+		if entry[0] != mnemonic or entry[1] != instructionSize([(mnemonic,None)]) or entry[2] != instructionTime([(mnemonic,None)]):
+			print("Mismatch",mnemonic,entry)